@@ -1,6 +1,10 @@
 
 import os
 import math
+import gzip
+import hashlib
+import shutil
+import struct
 
 import luigi
 from bioluigi.slurm import SlurmExecutableTask, SlurmTask
@@ -19,6 +23,11 @@ python = "source /usr/users/ga004/buntingd/FP_dev/dev/bin/activate"
 # Ugly hack
 script_dir = os.path.join(os.path.split(__file__)[0], 'scripts')
 
+bgzip = '/tgac/software/production/tabix/0.2.6/x86_64/bin/bgzip'
+tabix = '/tgac/software/production/tabix/0.2.6/x86_64/bin/tabix'
+# Size of the reads from the input and of the pipe buffers to the bgzip processes when scattering
+SCATTER_BLOCK_SIZE = 2**22
+
 
 class ScatterVCF(SlurmTask):
 
@@ -38,60 +47,23 @@ class ScatterVCF(SlurmTask):
 
     def work(self):
         import subprocess
-        import itertools
         import gzip
 
         zipped = get_ext(self.input().path)[1] == '.vcf.gz'
         if zipped:
-
-            proc = subprocess.run("zgrep -ve'#' < {} |  wc -l ".format(self.input().path),
-                                  shell=True, universal_newlines=True,
-                                  stdout=subprocess.PIPE)
-
-            # Create subprocesses to perform the compression
-            bgzip_procs = [subprocess.Popen('/tgac/software/production/tabix/0.2.6/x86_64/bin/bgzip -c > {0}'.format(fout.path),
-                                          shell=True, stdin=subprocess.PIPE, bufsize=1, universal_newlines=True)
+            # Create subprocesses to perform the compression, with large pipe buffers
+            bgzip_procs = [subprocess.Popen('{0} -c > {1}'.format(bgzip, fout.path),
+                                            shell=True, stdin=subprocess.PIPE, bufsize=SCATTER_BLOCK_SIZE)
                            for fout in self.output()]
             fouts = [p.stdin for p in bgzip_procs]
-
-            file_context = gzip.open(self.input().path, 'rt')
         else:
-            proc = subprocess.run("grep -ve'#' < {} | wc -l  ".format(self.input().path),
-                                  shell=True, universal_newlines=True,
-                                  stdout=subprocess.PIPE)
-            fouts = [f.open('w') for f in self.output()]
-            file_context = self.input().open('r')
-
-        flen = int(proc.stdout.strip())
-        print("FILE LENGTH = {}".format(flen))
-        output_cycle = itertools.chain.from_iterable([itertools.repeat(p, flen // len(fouts))
-                                                      for p in fouts])
-        header, got_header = '', False
-
-        with file_context as fin:
-            for line in fin:
-                # Catch the header
-                if got_header is False:
-                    if line[0] == '#':
-                        header += line
-                        continue
-                    elif header is '':
-                        raise Exception("No header on input VCF stream")
-                    else:
-                        got_header = True
-                        for f in fouts:
-                            f.write(header)
-                try:
-                    # Main output
-                    next(output_cycle).write(line)
-                except StopIteration:
-                    # Clean up any remaining line to last file
-                    fouts[-1].write(line)
+            fouts = [luigi.LocalTarget(f.path, format=luigi.format.Nop).open('w') for f in self.output()]
+
+        with open(self.input().path, 'rb', buffering=SCATTER_BLOCK_SIZE) as raw:
+            split_vcf(gzip.GzipFile(fileobj=raw) if zipped else raw, raw, fouts)
 
         if zipped:
-            # Create subprocesses to perform the compression
             for i, p in enumerate(bgzip_procs):
-                p.stdin.flush()
                 p.stdin.close()
                 p.wait()
                 if p.returncode != 0:
@@ -101,149 +73,547 @@ class ScatterVCF(SlurmTask):
                 f.close()
 
 
+def split_vcf(fin, raw, fouts, block_size=SCATTER_BLOCK_SIZE):
+    '''Split the VCF stream ``fin`` into contiguous runs of records, writing the header and one run
+       to each of ``fouts``, in a single pass. ``raw`` is the underlying file ``fin`` decompresses,
+       how far through ``raw`` we are gives an estimate of the decompressed size of the whole VCF, so
+       the shards are balanced by size without counting the records first. The shard boundaries are
+       checked on every record, so a VCF smaller than one block is still split'''
+    size = os.fstat(raw.fileno()).st_size
+    header = []
+    for line in iter(fin.readline, b''):
+        if not line.startswith(b'#'):
+            break
+        header.append(line)
+    else:
+        line = b''
+    if not header:
+        raise Exception("No header on input VCF stream")
+    header = b''.join(header)
+    for f in fouts:
+        f.write(header)
+
+    shard, pending = 0, line
+    read = len(header) + len(line)
+    while True:
+        block = fin.read(block_size)
+        if not block:
+            fouts[shard].write(pending)
+            break
+        # Offset of the start of pending in fin, and the estimated size of fin
+        start = read - len(pending)
+        read += len(block)
+        total = read * size / max(raw.tell(), 1)
+
+        # Only split on whole lines, carrying the partial last line into the next block
+        block = pending + block
+        end = block.rfind(b'\n') + 1
+        a = 0
+        while shard < len(fouts) - 1:
+            # Cut after the first record that ends past this shard's share of the records
+            boundary = len(header) + (total - len(header)) * (shard + 1) / len(fouts)
+            nl = block.find(b'\n', max(a, int(boundary) - start - 1), end)
+            if nl < 0:
+                break
+            fouts[shard].write(block[a:nl + 1])
+            a = nl + 1
+            shard += 1
+        fouts[shard].write(block[a:end])
+        pending = block[end:]
+
+
+# First line of a virtual shard written by ScatterVCFRegions, followed by the path of the parent VCF
+SHARD_MAGIC = '##parent='
+# htslib stores per contig record counts in this pseudo-bin of the tabix index
+TABIX_PSEUDO_BIN = 37450
+
+
+class ScatterVCFRegions(ScatterVCF):
+    '''Virtual scatter: instead of rewriting the VCF into N shards, each shard is a small file pointing
+       at the parent VCF plus a BED file (shard + '.bed') of the whole contigs it covers. The contigs are
+       split into contiguous runs balanced by record count, read from the tabix index so only the index
+       and the VCF header are read. Downstream tasks use :func:`vcf_shard` to get the parent VCF and
+       the regions to pass to bcftools -R / GATK -L. Falls back to a physical scatter if there are
+       fewer contigs than shards'''
+
+    def work(self):
+        import subprocess
+
+        vcf = os.path.abspath(self.input().path)
+        if get_ext(vcf)[1] != '.vcf.gz':
+            return super().work()
+        if not os.path.exists(vcf + '.tbi'):
+            subprocess.run('{0} -f -p vcf {1}'.format(tabix, vcf), shell=True, check=True)
+
+        weights = [(c, w) for c, w in read_tabix_index(vcf + '.tbi') if w > 0]
+        if len(weights) < len(self.output()):
+            logger.info("Only {0} contigs for {1} shards, scattering {2} physically".format(len(weights), len(self.output()), vcf))
+            return super().work()
+
+        lengths = vcf_contig_lengths(vcf)
+        for out, contigs in zip(self.output(), split_contiguous(weights, len(self.output()))):
+            with open(out.path + '.bed', 'w') as bed:
+                bed.writelines("{0}\t0\t{1}\n".format(c, lengths.get(c, 2**29 - 1)) for c in contigs)
+            with out.open('w') as fout:
+                fout.write(SHARD_MAGIC + vcf + '\n')
+
+
+def vcf_shard(path):
+    '''Returns (vcf, bed) for the shard of a VCF at ``path``. For virtual shards from :class:`ScatterVCFRegions`
+       this is the parent VCF and the BED file of regions to restrict to, otherwise it is (path, None)'''
+    with open(path, 'rb') as f:
+        head = f.readline()
+    if not head.startswith(SHARD_MAGIC.encode()):
+        return path, None
+    return head.decode().strip()[len(SHARD_MAGIC):], path + '.bed'
+
+
+def read_tabix_index(path, exact=False):
+    '''Parse the tabix index ``path``, returns [(contig, weight)] in file order. The weight is the number of
+       records, if the index was written by htslib, otherwise the number of compressed bytes the contig spans,
+       or None if ``exact``'''
+    with gzip.open(path, 'rb') as f:
+        data = f.read()
+    magic, n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm = struct.unpack_from('<4s8i', data, 0)
+    if magic != b'TBI\x01':
+        raise ValueError("{0} is not a tabix index".format(path))
+    offset = 36
+    names = [n.decode() for n in data[offset:offset + l_nm].split(b'\0')[:n_ref]]
+    offset += l_nm
+
+    weights = []
+    for name in names:
+        n_bin, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        beg, end, count = None, None, None
+        for i in range(n_bin):
+            bin_, n_chunk = struct.unpack_from('<Ii', data, offset)
+            chunks = struct.unpack_from('<{0}Q'.format(2 * n_chunk), data, offset + 8)
+            offset += 8 + 16 * n_chunk
+            if bin_ == TABIX_PSEUDO_BIN:
+                # Chunks are (start offset, end offset), (n_mapped, n_unmapped)
+                count = chunks[2]
+                continue
+            beg = min(chunks[0::2]) if beg is None else min(beg, *chunks[0::2])
+            end = max(chunks[1::2]) if end is None else max(end, *chunks[1::2])
+        n_intv, = struct.unpack_from('<i', data, offset)
+        offset += 4 + 8 * n_intv
+
+        if count is None and not exact:
+            # BGZF virtual offsets are compressed offset << 16 | offset in the block
+            count = 0 if beg is None else (end >> 16) - (beg >> 16) + 1
+        weights.append((name, count))
+    return weights
+
+
+def vcf_contig_lengths(vcf):
+    '''Read the contig lengths from the ##contig header lines of ``vcf``'''
+    lengths = {}
+    with gzip.open(vcf, 'rt') as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            if line.startswith('##contig=<'):
+                fields = dict(kv.split('=', 1) for kv in line.strip()[len('##contig=<'):-1].split(',') if '=' in kv)
+                if 'length' in fields:
+                    lengths[fields['ID']] = int(fields['length'])
+    return lengths
+
+
+def split_contiguous(weights, n):
+    '''Split [(item, weight)] into ``n`` contiguous, non-empty runs of items with roughly equal total weight'''
+    total = sum(w for _, w in weights)
+    runs, cumulative = [[] for i in range(n)], 0
+    shard = 0
+    for i, (item, w) in enumerate(weights):
+        # Move on once this shard has its share, as long as every later shard can still get an item
+        if runs[shard] and shard < n - 1 and (cumulative >= total * (shard + 1) / n or len(weights) - i == n - shard - 1):
+            shard += 1
+        runs[shard].append(item)
+        cumulative += w
+    return runs
+
+
+class ScatterConfig(luigi.Config):
+    '''Settings for scattering, in the [ScatterConfig] section of the luigi config.
+
+       :param bed_weights: cost of each interval when ScatterBED partitions a BED file. Either a VCF.gz
+                           from a previous callset (cost is the number of variants, from its tabix index)
+                           or a BED file with the cost eg historical runtime in the 4th column.
+                           Costs are spread over each contig per bp. Empty to weight by length
+       :param genotypes_per_shard: target size of a shard for :func:`scatter_width`, records x samples
+       :param min_shards: fewest shards :func:`scatter_width` will choose
+       :param max_shards: most shards :func:`scatter_width` will choose
+       :param hd5_gather: how GatherHD5s combines shards, "virtual" or "chunks", see :mod:`fieldpathogenomics.hd5`
+       :param hc_shards: number of regions of the CallingMask each library's HaplotypeCaller is split into,
+                         1 to call the whole BAM in one job
+       :param chunk_store: also write each callset as a chunked store, see :mod:`fieldpathogenomics.chunkstore`,
+                           and read it rather than the HDF5 files where supported'''
+    bed_weights = luigi.Parameter(default='')
+    genotypes_per_shard = luigi.IntParameter(default=2 * 10**8)
+    min_shards = luigi.IntParameter(default=1)
+    max_shards = luigi.IntParameter(default=200)
+    hd5_gather = luigi.ChoiceParameter(choices=['chunks', 'virtual'], default='virtual')
+    hc_shards = luigi.IntParameter(default=1)
+    chunk_store = luigi.BoolParameter(default=False)
+
+
 class ScatterBED(luigi.Task, CheckTargetNonEmpty):
+    '''Split a BED file of intervals into N shards of near-equal expected cost, see :func:`contiguous_partition`.
+       Each shard is a run of consecutive intervals, so with a sorted BED the shards' outputs are in order
+       and GatherVCF can concatenate them without merging'''
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
     def run(self):
         with self.input().open() as fin:
-            inp = [(l, int(l.split()[2]) - int(l.split()[1])) for l in fin]
+            lines = [l for l in fin if l.strip() and not l.startswith(('#', 'track', 'browser'))]
+        intervals = [(l.split()[0], int(l.split()[1]), int(l.split()[2])) for l in lines]
 
-        total_seq_len = sum([x[1] for x in inp])
-        perfile = math.ceil(total_seq_len / len(self.output()))
+        weights = interval_weights(intervals, ScatterConfig().bed_weights)
+        shards, loads = contiguous_partition(weights, len(self.output()))
+        logger.info("ScatterBED split {0} intervals into {1} shards, predicted imbalance "
+                    "(max/mean cost) {2:.3f}".format(len(lines), len(loads), imbalance(loads)))
+        if any(len(s) == 0 for s in shards):
+            logger.warning("ScatterBED has more shards than intervals, some shards are empty")
 
-        inp_iter = iter(inp)
-        files = 0
-        for i, out in enumerate(self.output()):
-            count = 0
+        for out, shard in zip(self.output(), shards):
             with out.open('w') as fout:
-                for l, c in inp_iter:
-                    fout.write(l)
-                    count += c
-                    if count > perfile:
-                        break
+                fout.writelines(lines[i] for i in shard)
 
-                files += 1
-                if files == len(self.output()):
-                    # If we're on the final file dump the rest
-                    fout.writelines([x[0] for x in inp_iter])
 
+def interval_weights(intervals, path=''):
+    '''Expected cost of each (contig, start, end) in ``intervals``. With no ``path`` this is the length, otherwise
+       the cost per bp of each contig is read from ``path``, a VCF.gz (variants counted from the tabix index)
+       or a BED file with the cost in the 4th column. Contigs missing from ``path`` get the average cost per bp'''
+    lengths = [end - start for contig, start, end in intervals]
+    if not path:
+        return lengths
 
-class GatherVCF(SlurmExecutableTask, CheckTargetNonEmpty):
+    cost, bp = {}, {}
+    if path.endswith('.vcf.gz'):
+        contig_lengths = vcf_contig_lengths(path)
+        for contig, count in read_tabix_index(path + '.tbi'):
+            cost[contig] = count
+            bp[contig] = contig_lengths.get(contig, 0)
+    else:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 4 or line.startswith(('#', 'track', 'browser')):
+                    continue
+                cost[fields[0]] = cost.get(fields[0], 0) + float(fields[3])
+                bp[fields[0]] = bp.get(fields[0], 0) + int(fields[2]) - int(fields[1])
+
+    default = sum(cost.values()) / max(sum(bp.values()), 1)
+    density = {c: cost[c] / bp[c] if bp[c] else default for c in cost}
+    return [density.get(contig, default) * l for (contig, start, end), l in zip(intervals, lengths)]
+
+
+def contiguous_partition(weights, n):
+    '''Split the items with costs ``weights`` into ``n`` runs of consecutive items with roughly equal
+       total cost, see :func:`split_contiguous`. Returns a list of the item indices in each shard and the
+       total cost of each shard. Shards are only empty if there are fewer items than shards'''
+    if len(weights) < n:
+        shards = [[i] for i in range(len(weights))] + [[] for i in range(n - len(weights))]
+    else:
+        shards = split_contiguous(list(enumerate(weights)), n)
+    return shards, [sum(weights[i] for i in s) for s in shards]
+
+
+def imbalance(loads):
+    '''Ratio of the largest to the mean shard cost, 1 is perfectly balanced'''
+    mean = sum(loads) / len(loads) if loads else 0
+    return max(loads) / mean if mean else 1.0
+
+
+def count_records(vcf):
+    '''Number of records in ``vcf`` from its tabix index, or None if it isn't indexed or the
+       index doesn't hold record counts'''
+    if not os.path.exists(vcf + '.tbi'):
+        return None
+    counts = [c for _, c in read_tabix_index(vcf + '.tbi', exact=True)]
+    return None if None in counts else sum(counts)
+
+
+def bed_length(bed):
+    '''Total bp covered by the intervals in ``bed``'''
+    with open(bed) as f:
+        return sum(int(l.split()[2]) - int(l.split()[1]) for l in f
+                   if l.strip() and not l.startswith(('#', 'track', 'browser')))
+
+
+def scatter_width(records=None, samples=1, vcf=None, default=5, max_shards=None):
+    '''Scatter width policy: the number of shards for a stage over ``records`` VCF records of ``samples``
+       samples, so that each shard holds about genotypes_per_shard (see :class:`ScatterConfig`) genotypes.
+       Small stages get fewer shards and so pay less SLURM scheduling overhead, large ones more parallelism.
+
+       :param records: estimated number of records, used if ``vcf`` isn't given or can't be counted
+       :param vcf: input VCF, if it exists its records are counted from the tabix index
+       :param default: width to use if there is no estimate at all
+       :param max_shards: upper limit, overriding the one in ScatterConfig'''
+    config = ScatterConfig()
+    if vcf is not None and os.path.exists(vcf):
+        records = count_records(vcf) or records
+    if records is None:
+        return default
+    n = math.ceil(records * samples / config.genotypes_per_shard)
+    return max(config.min_shards, min(n, max_shards or config.max_shards))
+
+
+# Number of times content_chunks re-splits a run that is too long before splitting it evenly
+CONTENT_CHUNK_SALTS = 16
+
+
+def _hash(s):
+    return int(hashlib.sha1(s.encode()).hexdigest(), 16)
+
+
+def is_leaf(node):
+    '''Whether the reduction tree ``node`` is a group of items rather than of other nodes'''
+    return all(isinstance(x, str) for x in node)
+
+
+def node_items(node):
+    '''All the items under the reduction tree ``node``, sorted'''
+    if is_leaf(node):
+        return sorted(node)
+    return sorted(x for child in node for x in node_items(child))
+
+
+def node_name(node, salt=''):
+    '''Name for ``node`` that depends only on the items under it and ``salt``, not how they are grouped'''
+    return hashlib.sha1('\n'.join([salt] + node_items(node)).encode()).hexdigest()[:16]
+
+
+def content_chunks(items, fan_in, key=str, salt=0):
+    '''Split ``items`` into runs ending wherever the hash of key(item) is 0 mod ``fan_in``. Runs longer than
+       ``fan_in`` are split again the same way with the hash salted, so every run has at most ``fan_in`` items.
+       Runs average about ``fan_in`` items and where they end depends only on the items themselves, so
+       inserting an item changes only the run it lands in'''
+    runs, run = [], []
+    for item in items:
+        run.append(item)
+        k = key(item) if salt == 0 else "{0}/{1}".format(salt, key(item))
+        if _hash(k) % fan_in == 0:
+            runs.append(run)
+            run = []
+    if run:
+        runs.append(run)
+
+    chunks = []
+    for r in runs:
+        if len(r) <= fan_in:
+            chunks.append(r)
+        elif salt < CONTENT_CHUNK_SALTS:
+            chunks += content_chunks(r, fan_in, key=key, salt=salt + 1)
+        else:
+            # No cut with any salt, vanishingly unlikely
+            chunks += even_chunks(r, fan_in)
+    return chunks
+
+
+def even_chunks(items, fan_in):
+    '''Split ``items`` into as few runs of at most ``fan_in`` items as possible, as even as possible'''
+    n = math.ceil(len(items) / fan_in)
+    return [items[len(items) * i // n:len(items) * (i + 1) // n] for i in range(n)]
+
+
+def reduction_tree(items, fan_in):
+    '''Group the strings ``items`` into a tree, each node having at most ``fan_in`` children, for combining
+       them hierarchically. Leaves are tuples of items, higher nodes tuples of nodes. Adding items
+       only changes the leaves they fall in and the ancestors of those leaves, see :func:`content_chunks`.
+       Returns the top nodes of the tree, at most ``fan_in`` of them'''
+    if fan_in < 2:
+        raise ValueError("fan_in must be at least 2")
+    nodes = [tuple(c) for c in content_chunks(sorted(set(items)), fan_in)]
+    level = 0
+    while len(nodes) > fan_in:
+        level += 1
+        # Keyed on the last item under each node, which only changes if an item is added at the end
+        # of its leaf, salted so the chunks at each level end in different places
+        chunks = content_chunks(nodes, fan_in, key=lambda n: "{0}:{1}".format(level, node_items(n)[-1]))
+        if len(chunks) == len(nodes):
+            # Every node ended a chunk, vanishingly unlikely unless fan_in is tiny. Group them
+            # evenly instead so the tree always gets smaller
+            chunks = even_chunks(nodes, fan_in)
+        nodes = [c[0] if len(c) == 1 else tuple(c) for c in chunks]
+    return nodes
+
+
+class GatherVCF(SlurmTask, CheckTargetNonEmpty):
+    '''Gather VCF shards in python, no JVM. Shards already in order are concatenated block by block
+       without recompressing, otherwise they are k-way merged, see :func:`fieldpathogenomics.bgzf.gather_vcfs`.
+       The output is tabix indexed, so ScatterVCFRegions can scatter it again'''
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Set the SLURM request params for this task
-        self.mem = 8000
+        self.mem = 1000
         self.n_cpu = 1
         self.partition = "tgac-medium"
 
-    def work_script(self):
-        return '''#!/bin/bash
-                picard='{picard}'
-                source vcftools-0.1.13;
-                source jre-8u92
+    def work(self):
+        from fieldpathogenomics.bgzf import gather_vcfs
+        gather_vcfs([x.path for x in self.input()], self.output().path, threads=self.n_cpu)
 
-                set -eo pipefail
-                $picard MergeVcfs O={output}.temp.vcf.gz {in_flags}
 
-                mv {output}.temp.vcf.gz {output}
+class GatherGVCF(SlurmTask, CheckTargetNonEmpty):
+    '''Gather uncompressed (g)VCF shards, eg from HaplotypeCaller over disjoint regions, by merging
+       their records in order, see :func:`fieldpathogenomics.bgzf.merge_plain_vcfs`'''
 
-                '''.format(picard=picard.format(mem=self.mem * self.n_cpu),
-                           output=self.output().path,
-                           in_flags="\\\n".join([" I= " + x.path for x in self.input()])
-                           )
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Set the SLURM request params for this task
+        self.mem = 1000
+        self.n_cpu = 1
+        self.partition = "nbi-short"
+
+    def work(self):
+        from fieldpathogenomics.bgzf import merge_plain_vcfs
+        merge_plain_vcfs([x.path for x in self.input()], self.output().path)
 
 
 class GatherHD5s(SlurmTask):
+    '''Concatenate HDF5 shards along the variants axis, see :func:`fieldpathogenomics.hd5.gather_hd5s`.
+       With ``ScatterConfig().hd5_gather`` = 'virtual', the default, the output is a set of Virtual Datasets
+       over the shards, which must then be kept. With 'chunks' the shards are copied into the output,
+       compressed chunks without decoding them only while the shards line up with the output's chunks'''
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Set the SLURM request params for this task
-        self.mem = 8000
+        self.mem = 2000
         self.n_cpu = 1
         self.partition = "tgac-medium"
 
     def work(self):
-        import dask.array as da
-        import numpy as np
-        import h5py
-        from luigi.file import atomic_file
-
-        fs = [h5py.File(f.path, mode='r') for f in self.input()]
-
-        # Verify all H5s have the same structure
-        datasets, groups, samples = [[] for x in fs], [[] for x in fs], [[] for x in fs]
-        for i, f in enumerate(fs):
-            f.visititems(lambda n, o: datasets[i].append(n) if isinstance(o, h5py.Dataset) else groups[i].append(n))
-            samples[i] = f['samples'][:]
-        if not all([set(datasets[0]) == set(x) for x in datasets]) and np.all(samples == samples[0], axis=0):
-            raise Exception("All HDF5 files must have the same groups/datasets/samples!")
-        datasets, groups, samples = datasets[0], groups[0], samples[0]
-
-        # Drop Samples dataset and handle separately
-        datasets = [x for x in datasets if x != 'samples']
-        combined = {d: da.concatenate([da.from_array(f[d], chunks=100000) for f in fs]) for d in datasets}
-
-        shapes = [(np.sum([f.get(d).shape for f in fs], axis=0)[0], *fs[0].get(d).shape[1:]) for d in datasets]
-        dtypes = [fs[0].get(d).dtype for d in datasets]
-
-        # Handles Samples dataset
-        datasets.append('samples')
-        combined.update({'samples': da.from_array(fs[0]['samples'], chunks=1)})
-        shapes.append(samples.shape)
-        dtypes.append(samples.dtype)
-
-        af = atomic_file(self.output().path)
-        fout = h5py.File(af.tmp_path, 'w')
-
-        # Set up group structure
-        for g in groups:
-            fout.create_group(g)
-
-        # Create the datasets
-        out_datasets = {}
-        for p, dtype, shape in zip(datasets, dtypes, shapes):
-            g, d = os.path.split(p)
-            out_datasets[p] = (fout[g] if g else fout).create_dataset(d, shape=shape, dtype=dtype,
-                                                                      chunks=True, compression='gzip')
-        for k in combined.keys():
-            s = da.store(combined[k], out_datasets[k], compute=False)
-            s.compute(num_workers=self.n_cpu)
-            print("Done " + k)
-
-        af.move_to_final_destination()
-
-
-class GatherCat(SlurmExecutableTask, CheckTargetNonEmpty):
+        from fieldpathogenomics.hd5 import gather_hd5s
+        gather_hd5s([f.path for f in self.input()], self.output().path, mode=ScatterConfig().hd5_gather)
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        # Set the SLURM request params for this task
-        self.mem = 4000
-        self.n_cpu = 1
-        self.partition = "tgac-short"
 
-    def work_script(self):
-        return '''#!/bin/bash
-                cat {inputs} > {output}.temp
-                mv {output} {output}
+class GatherStores(luigi.Task):
+    '''Gather chunked stores by moving the shards into the output, no data is copied and the shards
+       are consumed, see :func:`fieldpathogenomics.chunkstore.gather_stores`'''
 
-                '''.format(output=self.output().path,
-                           inputs=" \\\n".join([x.path for x in self.input()])
-                           )
+    def run(self):
+        from fieldpathogenomics.chunkstore import gather_stores
+        gather_stores([f.path for f in self.input()], self.output().path)
+
+
+def _copy_range(fin, fout, offset, end=None):
+    '''Copy bytes ``offset`` to ``end`` (default EOF) of the binary file ``fin`` onto the end of ``fout``,
+       in the kernel with sendfile where possible. Raises IOError if ``fin`` ends before ``end``'''
+    if end is None:
+        end = os.fstat(fin.fileno()).st_size
+    fout.flush()
+    try:
+        while offset < end:
+            sent = os.sendfile(fout.fileno(), fin.fileno(), offset, min(end - offset, 2**30))
+            if sent == 0:
+                break
+            offset += sent
+    except (AttributeError, OSError):
+        # No sendfile on this platform/filesystem
+        fin.seek(offset)
+        while offset < end:
+            block = fin.read(min(end - offset, SCATTER_BLOCK_SIZE))
+            if not block:
+                break
+            fout.write(block)
+            offset += len(block)
+    if offset < end:
+        raise IOError("{0} ended at byte {1}, expected {2}".format(fin.name, offset, end))
+
+
+def _skip_lines(fin, n):
+    '''Read ``n`` lines from the binary file object ``fin``, returns them and leaves ``fin`` after them'''
+    return b''.join(fin.readline() for i in range(n))
+
+
+def _bgzf_skip_lines(fin, n):
+    '''Skip the first ``n`` lines of the BGZF file ``fin``, returns (lines, rest, offset) where ``rest`` is the
+       data after them in the same block and ``offset`` the start of the next compressed block'''
+    from fieldpathogenomics.bgzf import read_blocks
+    data, offset, pos = b'', 0, 0
+    for raw, block in read_blocks(fin):
+        data += block
+        offset += len(raw)
+        while n > 0:
+            nl = data.find(b'\n', pos)
+            if nl < 0:
+                break
+            pos, n = nl + 1, n - 1
+        if n == 0:
+            break
+    return data[:pos], data[pos:], offset
+
+
+def concat_files(inputs, output, header_lines=0):
+    '''Concatenate the files ``inputs`` into ``output``, keeping the first ``header_lines`` lines
+       of the first file only. Plain files are copied with sendfile starting from the byte offset after
+       the header. Gzip files are written as one gzip member per input, BGZF blocks are copied as-is
+       except the one containing the end of the header, so the output is BGZF if all the inputs are.
+       Writes to a temporary file then moves it into place'''
+    from fieldpathogenomics.bgzf import BGZF_EOF, compress_block
+
+    def kind(path):
+        with open(path, 'rb') as f:
+            magic = f.read(16)
+        if magic[:2] != b'\x1f\x8b':
+            return 'plain'
+        return 'bgzf' if magic[12:14] == b'BC' else 'gzip'
+
+    kinds = [kind(path) for path in inputs]
+    if len(set(k == 'plain' for k in kinds)) > 1:
+        raise ValueError("Can't concatenate a mix of compressed and plain files")
+
+    temp = output + '.temp'
+    with open(temp, 'wb', buffering=SCATTER_BLOCK_SIZE) as fout:
+        for i, (path, k) in enumerate(zip(inputs, kinds)):
+            skip = header_lines if i > 0 else 0
+            with open(path, 'rb', buffering=SCATTER_BLOCK_SIZE) as fin:
+                if k == 'plain':
+                    _skip_lines(fin, skip)
+                    _copy_range(fin, fout, fin.tell())
+
+                elif k == 'bgzf':
+                    offset = 0
+                    if skip:
+                        header, rest, offset = _bgzf_skip_lines(fin, skip)
+                        if rest:
+                            fout.write(compress_block(rest))
+                    # Drop the EOF marker, it's written once at the end
+                    end = os.fstat(fin.fileno()).st_size
+                    fin.seek(max(end - len(BGZF_EOF), 0))
+                    if fin.read() == BGZF_EOF:
+                        end -= len(BGZF_EOF)
+                    _copy_range(fin, fout, offset, end)
+
+                elif skip:
+                    # Plain gzip has to be decompressed to find the end of the header
+                    with gzip.GzipFile(fileobj=fin) as gin, \
+                         gzip.GzipFile(fileobj=fout, mode='wb', compresslevel=6) as gout:
+                        _skip_lines(gin, skip)
+                        shutil.copyfileobj(gin, gout, SCATTER_BLOCK_SIZE)
+                else:
+                    _copy_range(fin, fout, 0)
+
+        if 'bgzf' in kinds:
+            fout.write(BGZF_EOF)
+    os.rename(temp, output)
+
+
+class GatherCat(luigi.Task, CheckTargetNonEmpty):
+    '''Concatenate the input files, see :func:`concat_files`'''
+
+    def run(self):
+        concat_files([x.path for x in self.input()], self.output().path)
 
 
 class GatherTSV(luigi.Task, CheckTargetNonEmpty):
     '''Gather TSV files making sure to only record the header line once'''
 
     def run(self):
-        with self.output().open('w') as fout:
-            for i, inp in enumerate(self.input()):
-                with inp.open('r') as fin:
-                    lines = fin.readlines()
-                    if i == 0:
-                        fout.writelines(lines)
-                    else:
-                        fout.writelines(lines[1:])
+        concat_files([x.path for x in self.input()], self.output().path, header_lines=1)
@@ -0,0 +1,416 @@
+'''
+Pure python BGZF (block gzip) reading/writing and tabix indexing, enough to gather VCF shards
+without starting a JVM.
+
+gather_vcfs() concatenates the shards' BGZF blocks as-is when they are already in order, like
+bcftools concat --naive, otherwise it does a streaming k-way merge by (contig, pos).
+Either way the tabix index is built in the same pass.
+'''
+import os
+import zlib
+import heapq
+import struct
+import bisect
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+logger = logging.getLogger('luigi-interface')
+
+# Most uncompressed data htslib puts in one block
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_HEADER = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# tabix constants
+TBX_VCF = 2
+TBX_MIN_SHIFT = 14
+TBX_PSEUDO_BIN = 37450
+
+
+class NotBGZF(ValueError):
+    pass
+
+
+class OutOfOrder(ValueError):
+    pass
+
+
+def read_blocks(fh):
+    '''Yield (raw block, uncompressed data) for each BGZF block in the binary file object ``fh``'''
+    while True:
+        header = fh.read(18)
+        if not header:
+            return
+        if len(header) < 18 or header[:4] != BGZF_HEADER[:4] or header[10:14] != b'\x06\x00BC':
+            raise NotBGZF("{0} is not BGZF compressed".format(getattr(fh, 'name', fh)))
+        bsize, = struct.unpack('<H', header[16:18])
+        rest = fh.read(bsize - 17)
+        crc, isize = struct.unpack('<II', rest[-8:])
+        data = zlib.decompress(rest[:-8], -15)
+        if len(data) != isize:
+            raise NotBGZF("Truncated BGZF block in {0}".format(getattr(fh, 'name', fh)))
+        yield header + rest, data
+
+
+def compress_block(data, level=6):
+    '''Compress ``data`` (at most BGZF_BLOCK_SIZE bytes) into one BGZF block'''
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    return (BGZF_HEADER + struct.pack('<H', len(cdata) + 25) + cdata +
+            struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+class BgzfWriter():
+    '''Write a BGZF file, compressing batches of blocks in parallel with ``threads`` threads
+       (zlib releases the GIL). Keeps a table of where each block starts so uncompressed offsets can
+       be converted to BGZF virtual offsets with :meth:`voffset` once they have been written'''
+
+    def __init__(self, path, level=6, threads=1, batch=64):
+        self.fh = open(path, 'wb')
+        self.level = level
+        self.batch = batch * BGZF_BLOCK_SIZE
+        self.pool = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.pending = bytearray()
+        # Uncompressed and compressed offsets of the start of each block written
+        self.ustarts, self.cstarts = [], []
+        self.utell, self.ctell = 0, 0
+
+    def tell(self):
+        '''Uncompressed offset of the next byte to be written'''
+        return self.utell + len(self.pending)
+
+    def write(self, data):
+        self.pending += data
+        if len(self.pending) >= self.batch:
+            self._compress(len(self.pending) - len(self.pending) % BGZF_BLOCK_SIZE)
+
+    def write_block(self, raw, size):
+        '''Copy the already compressed BGZF block ``raw`` of uncompressed ``size`` to the output'''
+        self._compress(len(self.pending))
+        self._append(raw, size)
+
+    def _append(self, raw, size):
+        self.ustarts.append(self.utell)
+        self.cstarts.append(self.ctell)
+        self.fh.write(raw)
+        self.utell += size
+        self.ctell += len(raw)
+
+    def _compress(self, n):
+        data, self.pending = bytes(self.pending[:n]), self.pending[n:]
+        chunks = [data[i:i + BGZF_BLOCK_SIZE] for i in range(0, len(data), BGZF_BLOCK_SIZE)]
+        mapper = self.pool.map if self.pool is not None else map
+        for chunk, raw in zip(chunks, mapper(compress_block, chunks, [self.level] * len(chunks))):
+            self._append(raw, len(chunk))
+
+    def flush(self):
+        '''Compress everything pending, so the next write starts a new block'''
+        self._compress(len(self.pending))
+
+    def voffset(self, uoffset):
+        '''BGZF virtual offset of the uncompressed offset ``uoffset``, which must already be flushed'''
+        i = bisect.bisect_right(self.ustarts, uoffset) - 1
+        if i < 0 or uoffset >= self.utell:
+            return self.ctell << 16
+        return (self.cstarts[i] << 16) | (uoffset - self.ustarts[i])
+
+    def close(self):
+        self.flush()
+        self.fh.write(BGZF_EOF)
+        self.fh.close()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+def reg2bin(beg, end):
+    '''UCSC/SAM binning scheme bin of the 0-based half open interval [beg, end)'''
+    end -= 1
+    for shift, offset in [(14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)]:
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
+
+
+class TabixIndexer():
+    '''Builds a tabix index for a VCF as records are written, mirroring htslib's hts_idx_push.
+       Offsets are uncompressed offsets into the BGZF stream and are converted to virtual offsets
+       when the index is written, after the data has been compressed'''
+
+    def __init__(self):
+        self.names, self.refs = [], []
+        self.tid = -1
+        self.last_end = None
+
+    def push(self, contig, beg, end, ustart, uend):
+        '''Add a record on ``contig`` covering [beg, end) found at uncompressed offsets [ustart, uend)'''
+        if self.tid < 0 or contig != self.names[self.tid]:
+            if contig in self.names:
+                raise OutOfOrder("Records for {0} are not contiguous".format(contig))
+            self._save_chunk()
+            self.names.append(contig)
+            self.refs.append({'bins': {}, 'linear': [], 'beg': ustart, 'end': uend, 'n': 0})
+            self.tid += 1
+            self.save_bin, self.save_off, self.last_beg = None, ustart, -1
+        ref = self.refs[self.tid]
+
+        if beg < self.last_beg:
+            raise OutOfOrder("{0}:{1} is out of order".format(contig, beg + 1))
+        self.last_beg = beg
+        end = max(end, beg + 1)
+
+        linear = ref['linear']
+        first, last = beg >> TBX_MIN_SHIFT, (end - 1) >> TBX_MIN_SHIFT
+        if len(linear) <= last:
+            linear.extend([None] * (last + 1 - len(linear)))
+        for w in range(first, last + 1):
+            if linear[w] is None:
+                linear[w] = ustart
+
+        b = reg2bin(beg, end)
+        if b != self.save_bin:
+            self._save_chunk(ustart)
+            self.save_bin, self.save_off = b, ustart
+        ref['end'] = uend
+        ref['n'] += 1
+        self.last_end = uend
+
+    def _save_chunk(self, end=None):
+        if self.tid >= 0 and self.save_bin is not None:
+            end = self.last_end if end is None else end
+            self.refs[self.tid]['bins'].setdefault(self.save_bin, []).append((self.save_off, end))
+
+    def write(self, path, voffset, level=6):
+        '''Write the .tbi to ``path``, ``voffset`` converts uncompressed offsets to virtual offsets'''
+        self._save_chunk()
+        names = b''.join(n.encode() + b'\0' for n in self.names)
+        out = [b'TBI\x01', struct.pack('<8i', len(self.names), TBX_VCF, 1, 2, 0, ord('#'), 0, len(names)), names]
+        for ref in self.refs:
+            bins = ref['bins']
+            out.append(struct.pack('<i', len(bins) + 1))
+            for b in sorted(bins):
+                chunks = merge_chunks([(voffset(s), voffset(e)) for s, e in bins[b]])
+                out.append(struct.pack('<Ii', b, len(chunks)))
+                out.append(struct.pack('<{0}Q'.format(2 * len(chunks)), *[o for c in chunks for o in c]))
+            # htslib's pseudo-bin: the contig's offsets and its mapped/unmapped record counts
+            out.append(struct.pack('<Ii4Q', TBX_PSEUDO_BIN, 2, voffset(ref['beg']), voffset(ref['end']), ref['n'], 0))
+
+            # Fill the gaps in the linear index like htslib
+            linear = [voffset(o) if o is not None else None for o in ref['linear']]
+            previous = voffset(ref['beg'])
+            for i, o in enumerate(linear):
+                linear[i] = previous = previous if o is None else o
+            out.append(struct.pack('<i{0}Q'.format(len(linear)), len(linear), *linear))
+        out.append(struct.pack('<Q', 0))
+
+        data = b''.join(out)
+        with open(path, 'wb') as f:
+            for i in range(0, len(data), BGZF_BLOCK_SIZE):
+                f.write(compress_block(data[i:i + BGZF_BLOCK_SIZE], level))
+            f.write(BGZF_EOF)
+
+
+def merge_chunks(chunks):
+    '''Merge overlapping or adjacent (start, end) virtual offset chunks'''
+    merged = []
+    for s, e in sorted(chunks):
+        if merged and s <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], e))
+        else:
+            merged.append((s, e))
+    return merged
+
+
+def record_span(line):
+    '''Returns (contig, beg, end) of a VCF record, 0-based half open, using INFO/END if present'''
+    fields = line.split(b'\t', 8)
+    beg = int(fields[1]) - 1
+    end = beg + len(fields[3])
+    if b'END=' in line:
+        for kv in fields[7].split(b';'):
+            if kv.startswith(b'END='):
+                end = int(kv[4:])
+    return fields[0].decode(), beg, end
+
+
+def split_header(data):
+    '''Split the start of a VCF into (header, rest), or (None, data) if the header might continue past ``data``'''
+    pos = 0
+    while pos < len(data):
+        if data[pos:pos + 1] != b'#':
+            return data[:pos], data[pos:]
+        nl = data.find(b'\n', pos)
+        if nl < 0:
+            break
+        pos = nl + 1
+    return None, data
+
+
+def _index_lines(indexer, data, start, first=None):
+    '''Index the complete records in ``data`` which starts at uncompressed offset ``start``,
+       returns the trailing partial record. The (contig, beg) of the first record is appended to ``first`` if it's empty'''
+    pos = 0
+    while True:
+        nl = data.find(b'\n', pos)
+        if nl < 0:
+            return data[pos:]
+        if nl > pos:
+            contig, beg, end = record_span(data[pos:nl])
+            indexer.push(contig, beg, end, start + pos, start + nl + 1)
+            if first == []:
+                first.append((contig, beg))
+        pos = nl + 1
+
+
+def concat_vcfs(inputs, output, level=6, threads=1):
+    '''Concatenate the BGZF compressed VCFs ``inputs``, whose records must already be in order across
+       the files, into ``output``, copying compressed blocks as-is wherever possible, and build its tabix index.
+       Raises OutOfOrder if the records aren't in order, or a shard starts at the position the one before ends
+       so might repeat its records, and NotBGZF if an input isn't BGZF'''
+    writer = BgzfWriter(output, level=level, threads=threads)
+    indexer = TabixIndexer()
+    samples = None
+    try:
+        for i, path in enumerate(inputs):
+            with open(path, 'rb', buffering=2**22) as fh:
+                blocks = read_blocks(fh)
+                # Decompress until the end of the header, the rest of that block is recompressed
+                data = b''
+                for raw, block in blocks:
+                    data += block
+                    header, rest = split_header(data)
+                    if header is not None:
+                        break
+                else:
+                    header, rest = data, b''
+
+                columns = header[header.rfind(b'\n#', 0, len(header) - 1) + 1:]
+                if samples is None:
+                    samples = columns
+                    writer.write(header)
+                elif columns != samples:
+                    raise ValueError("{0} has different samples to {1}".format(path, inputs[0]))
+
+                # Where the previous shard ended
+                last = (indexer.names[indexer.tid], indexer.last_beg) if indexer.tid >= 0 else None
+                first = []
+
+                start = writer.tell()
+                writer.write(rest)
+                partial = _index_lines(indexer, rest, start, first)
+                writer.flush()
+
+                for raw, block in blocks:
+                    if not block:
+                        # Skip the EOF marker
+                        continue
+                    start = writer.tell()
+                    writer.write_block(raw, len(block))
+                    # Records spanning blocks start in the previous block
+                    partial = _index_lines(indexer, partial + block, start - len(partial), first)
+                if partial:
+                    raise ValueError("{0} doesn't end with a newline".format(path))
+                if first and first[0] == last:
+                    raise OutOfOrder("{0} starts at {1}:{2} where the shard before ends".format(path, last[0], last[1] + 1))
+        writer.close()
+    except Exception:
+        writer.close()
+        os.remove(output)
+        raise
+    indexer.write(output + '.tbi', writer.voffset, level)
+
+
+def _open_vcf(path):
+    '''Open the VCF ``path`` for reading bytes, whether it's compressed or not'''
+    import gzip
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    return gzip.open(path, 'rb') if magic == b'\x1f\x8b' else open(path, 'rb')
+
+
+def _records(path):
+    '''Yield the records of the VCF ``path``'''
+    with _open_vcf(path) as f:
+        for line in f:
+            if not line.startswith(b'#'):
+                yield line
+
+
+def _unique(records):
+    '''Drop repeats of a record at the same position, eg a variant called in two shards whose regions meet'''
+    current, seen = None, set()
+    for line in records:
+        k = line.split(b'\t', 2)[:2]
+        if k != current:
+            current, seen = k, set()
+        if line not in seen:
+            seen.add(line)
+            yield line
+
+
+def merged_records(inputs):
+    '''Returns (header, records) of the sorted VCFs ``inputs`` k-way merged by (contig, pos), the header
+       is that of the first input. Contigs are ordered by the ##contig header lines then by first appearance.
+       Identical records at the same position in more than one input are only kept once'''
+    header, contigs = [], {}
+    with _open_vcf(inputs[0]) as f:
+        for line in f:
+            if not line.startswith(b'#'):
+                break
+            header.append(line)
+            if line.startswith(b'##contig=<ID='):
+                contigs.setdefault(line[len(b'##contig=<ID='):].split(b',')[0].split(b'>')[0], len(contigs))
+
+    def key(line):
+        contig, pos = line.split(b'\t', 2)[:2]
+        if contig not in contigs:
+            contigs[contig] = len(contigs)
+        return contigs[contig], int(pos)
+
+    return b''.join(header), _unique(heapq.merge(*[_records(p) for p in inputs], key=key))
+
+
+def merge_vcfs(inputs, output, level=6, threads=1):
+    '''k-way merge the sorted VCFs ``inputs`` into ``output``, see :func:`merged_records`,
+       and build its tabix index'''
+    header, records = merged_records(inputs)
+    writer = BgzfWriter(output, level=level, threads=threads)
+    indexer = TabixIndexer()
+    try:
+        writer.write(header)
+        for line in records:
+            start = writer.tell()
+            writer.write(line)
+            contig, beg, end = record_span(line.rstrip(b'\n'))
+            indexer.push(contig, beg, end, start, start + len(line))
+        writer.close()
+    except Exception:
+        writer.close()
+        os.remove(output)
+        raise
+    indexer.write(output + '.tbi', writer.voffset, level)
+
+
+def merge_plain_vcfs(inputs, output):
+    '''k-way merge the sorted VCFs ``inputs`` into the uncompressed VCF ``output``, see :func:`merged_records`.
+       Written to a temporary file and moved into place'''
+    header, records = merged_records(inputs)
+    temp = output + '.temp'
+    with open(temp, 'wb', buffering=2**22) as f:
+        f.write(header)
+        f.writelines(records)
+    os.rename(temp, output)
+
+
+def gather_vcfs(inputs, output, level=6, threads=1):
+    '''Gather the VCF shards ``inputs`` into ``output`` and write ``output``.tbi. Shards that are BGZF
+       compressed and already in order are concatenated block-wise, otherwise they are merged.
+       Both are written to a temporary file and moved into place'''
+    temp = output + '.temp.vcf.gz'
+    try:
+        concat_vcfs(inputs, temp, level, threads)
+        logger.info("Concatenated {0} shards into {1}".format(len(inputs), output))
+    except (OutOfOrder, NotBGZF) as e:
+        logger.info("Can't concatenate shards ({0}), merging instead".format(e))
+        merge_vcfs(inputs, temp, level, threads)
+    os.rename(temp + '.tbi', output + '.tbi')
+    os.rename(temp, output)
@@ -0,0 +1,257 @@
+'''
+A chunked, compressed, directory based columnar store for variant matrices, an alternative to HDF5.
+
+Every block of records parsed by :mod:`fieldpathogenomics.vcf2hd5` is written as one file per field,
+so scatter shards each write their own store in parallel and gathering them is just moving
+each shard's directory into the output, no data is copied. Readers open only meta.json and
+load the chunks of the fields and rows they index, see :class:`Column`.
+
+    <store>/meta.json                       samples, dtype and shape of each field and where its chunks are
+    <store>/<shard>/<group>/<field>/<i>     chunk i of a field, a zlib compressed .npy
+
+Fields are laid out as in the HDF5 files (samples, variants/*, calldata/*) and :func:`open_callset`
+opens either, so code reading the HDF5 files can read a store with no other changes.
+'''
+import io
+import os
+import sys
+import json
+import zlib
+import shutil
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('luigi-interface')
+
+COMPRESS_LEVEL = 1
+
+
+def encode_chunk(a, level=COMPRESS_LEVEL):
+    buf = io.BytesIO()
+    np.save(buf, a, allow_pickle=False)
+    return zlib.compress(buf.getvalue(), level)
+
+
+def decode_chunk(data):
+    return np.load(io.BytesIO(zlib.decompress(data)), allow_pickle=False)
+
+
+def write_store(vcf, store, block_size=None, processes=1, **kwargs):
+    '''Convert the VCF ``vcf`` (a path, plain or gzipped, or a binary file object eg sys.stdin.buffer) into the
+       store directory ``store``, see :func:`fieldpathogenomics.vcf2hd5.parsed_blocks` for the other arguments.
+       Written to a temporary directory and moved into place'''
+    from fieldpathogenomics.bgzf import _open_vcf
+    from fieldpathogenomics.vcf2hd5 import parsed_blocks
+
+    f = _open_vcf(vcf) if isinstance(vcf, str) else vcf
+    temp = store + '.temp'
+    shutil.rmtree(temp, ignore_errors=True)
+    try:
+        spec, blocks = parsed_blocks(f, block_size, processes, **kwargs)
+        fields = {group + '/' + field.name: {'dtype': np.dtype(field.dtype).str,
+                                             'shape': list(spec.shape(group, field, 0)[1:])}
+                  for group, fs in (('variants', spec.variants), ('calldata', spec.calldata)) for field in fs}
+        for path in fields:
+            os.makedirs(os.path.join(temp, '0', path))
+
+        chunks = []
+        for i, arrays in enumerate(blocks):
+            for path, a in arrays.items():
+                with open(os.path.join(temp, '0', path, str(i)), 'wb') as fout:
+                    fout.write(encode_chunk(a))
+            chunks.append(len(arrays['variants/POS']))
+
+        meta = {'samples': spec.samples, 'fields': fields, 'shards': [{'path': '0', 'chunks': chunks}]}
+        with open(os.path.join(temp, 'meta.json'), 'w') as fout:
+            json.dump(meta, fout)
+        shutil.rmtree(store, ignore_errors=True)
+        os.rename(temp, store)
+        logger.info("Wrote {0} records of {1} samples to {2}".format(sum(chunks), len(spec.samples), store))
+    finally:
+        if isinstance(vcf, str):
+            f.close()
+
+
+def read_meta(store):
+    with open(os.path.join(store, 'meta.json')) as f:
+        return json.load(f)
+
+
+def gather_stores(inputs, output):
+    '''Gather the stores ``inputs``, in order, into ``output`` by moving each into it, the inputs are consumed.
+       They must all have the same samples and fields'''
+    metas = [read_meta(path) for path in inputs]
+    for path, meta in zip(inputs, metas):
+        if meta['samples'] != metas[0]['samples']:
+            raise Exception("All stores must have the same samples, {0} differs".format(path))
+        if meta['fields'] != metas[0]['fields']:
+            raise Exception("All stores must have the same fields, {0} differs".format(path))
+
+    temp = output + '.temp'
+    shutil.rmtree(temp, ignore_errors=True)
+    os.makedirs(temp)
+    shards = []
+    for i, (path, meta) in enumerate(zip(inputs, metas)):
+        os.rename(path, os.path.join(temp, str(i)))
+        os.remove(os.path.join(temp, str(i), 'meta.json'))
+        shards += [{'path': os.path.join(str(i), s['path']), 'chunks': s['chunks']} for s in meta['shards']]
+
+    with open(os.path.join(temp, 'meta.json'), 'w') as f:
+        json.dump({'samples': metas[0]['samples'], 'fields': metas[0]['fields'], 'shards': shards}, f)
+    shutil.rmtree(output, ignore_errors=True)
+    os.rename(temp, output)
+    logger.info("Gathered {0} stores into {1}".format(len(inputs), output))
+
+
+class Column():
+    '''Read only, array like view of one field of a store, like a h5py Dataset.
+       Indexing loads just the chunks holding the rows asked for, the most recently used chunk is kept.
+
+       :param files: path of each chunk, in order
+       :param rows: number of rows in each chunk'''
+
+    def __init__(self, files, rows, dtype, shape):
+        self.files = files
+        self.offsets = np.concatenate([[0], np.cumsum(rows, dtype=np.int64)])
+        self.dtype = np.dtype(dtype)
+        self.shape = (int(self.offsets[-1]),) + tuple(shape)
+        self.ndim = len(self.shape)
+        self.chunks = (max(rows) if len(rows) else 1,) + tuple(shape)
+        self._cached = (None, None)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        a = self[:]
+        return a if dtype is None else a.astype(dtype)
+
+    def chunk(self, i):
+        '''Chunk ``i`` as an array'''
+        if self._cached[0] != i:
+            with open(self.files[i], 'rb') as f:
+                self._cached = (i, decode_chunk(f.read()))
+        return self._cached[1]
+
+    def _rows(self, start, stop):
+        '''Rows [start, stop)'''
+        if stop <= start:
+            return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+        first = np.searchsorted(self.offsets, start, side='right') - 1
+        last = np.searchsorted(self.offsets, stop, side='left')
+        parts = [self.chunk(c)[max(start - self.offsets[c], 0):stop - self.offsets[c]] for c in range(first, last)]
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def _take(self, index):
+        '''Rows at the integer array ``index``'''
+        out = np.empty((len(index),) + self.shape[1:], dtype=self.dtype)
+        which = np.searchsorted(self.offsets, index, side='right') - 1
+        for c in np.unique(which):
+            sel = which == c
+            out[sel] = self.chunk(c)[index[sel] - self.offsets[c]]
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        rows, rest = key[0], key[1:]
+        n = self.shape[0]
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(n)
+            if step > 0:
+                out = self._rows(start, stop)[::step]
+            else:
+                out = self._take(np.arange(start, stop, step))
+            return out[(slice(None),) + rest] if rest else out
+        elif isinstance(rows, (int, np.integer)):
+            row = rows + n if rows < 0 else rows
+            if not 0 <= row < n:
+                raise IndexError("index {0} is out of bounds for axis 0 with size {1}".format(rows, n))
+            out = self._rows(row, row + 1)[0]
+            return out[rest] if rest else out
+        else:
+            # Integer or boolean arrays
+            out = self._take(np.arange(n)[np.asarray(rows)])
+            return out[(slice(None),) + rest] if rest else out
+
+
+class Group():
+    '''Fields of a store under a common prefix, eg calldata, indexed like a h5py Group'''
+
+    def __init__(self, store, prefix):
+        self.store = store
+        self.prefix = prefix
+
+    def keys(self):
+        names = {p[len(self.prefix):].split('/')[0] for p in self.store.meta['fields'] if p.startswith(self.prefix)}
+        return sorted(names)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, name):
+        return name in self.keys()
+
+    def __getitem__(self, name):
+        return self.store[self.prefix + name]
+
+
+class Store(Group):
+    '''A store opened for reading, see :func:`open_callset`. samples is an array of bytes like in the HDF5 files'''
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = read_meta(path)
+        super().__init__(self, '')
+
+    def keys(self):
+        return ['samples'] + super().keys()
+
+    def __getitem__(self, name):
+        name = name.strip('/')
+        if name == 'samples':
+            return np.array([s.encode() for s in self.meta['samples']], dtype='S')
+        if name not in self.meta['fields']:
+            if any(p.startswith(name + '/') for p in self.meta['fields']):
+                return Group(self, name + '/')
+            raise KeyError(name)
+        field = self.meta['fields'][name]
+        files, rows = [], []
+        for shard in self.meta['shards']:
+            files += [os.path.join(self.path, shard['path'], name, str(i)) for i in range(len(shard['chunks']))]
+            rows += shard['chunks']
+        return Column(files, rows, field['dtype'], field['shape'])
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_callset(path):
+    '''Open the callset ``path`` for reading, either a store (its directory or meta.json) or a HDF5 file'''
+    if os.path.basename(path) == 'meta.json':
+        path = os.path.dirname(path)
+    if os.path.isdir(path):
+        return Store(path)
+    import h5py
+    return h5py.File(path, mode='r')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert a VCF to a chunked store")
+    parser.add_argument('vcf', help="VCF, plain or gzipped, - for stdin")
+    parser.add_argument('output')
+    parser.add_argument('--block-size', type=int, default=None)
+    parser.add_argument('--processes', type=int, default=1)
+    args = parser.parse_args()
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+    write_store(sys.stdin.buffer if args.vcf == '-' else args.vcf, args.output,
+                block_size=args.block_size, processes=args.processes)
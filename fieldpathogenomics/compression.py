@@ -0,0 +1,272 @@
+'''
+Compression codecs for reading and writing fastq.gz and other compressed files.
+
+Every codec can open a file for streaming reads/writes, compress a block of bytes in memory
+(concatenated gzip members/zstd frames are valid files, so blocks can be compressed independently
+and written in order) and provide the shell command to use in a work_script.
+Use get_codec() to choose one, it falls back to the next best codec if the one asked for isn't installed.
+'''
+import io
+import sys
+import gzip
+import shutil
+import subprocess
+
+import logging
+logger = logging.getLogger('luigi-interface')
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+class ProcessFile():
+    '''File-like wrapper around a (de)compression subprocess reading from or writing to ``path``'''
+
+    def __init__(self, cmd, path, mode):
+        self.path = path
+        self.mode = mode
+        if mode == 'rb':
+            self._fh = open(path, 'rb')
+            self.proc = subprocess.Popen(cmd, stdin=self._fh, stdout=subprocess.PIPE, bufsize=2**22)
+            self._pipe = self.proc.stdout
+        elif mode == 'wb':
+            self._fh = open(path, 'wb')
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=self._fh, bufsize=2**22)
+            self._pipe = self.proc.stdin
+        else:
+            raise ValueError("Mode must be 'rb' or 'wb'")
+
+    def read(self, size=-1):
+        return self._pipe.read(size)
+
+    def readline(self, size=-1):
+        return self._pipe.readline(size)
+
+    def __iter__(self):
+        return iter(self._pipe)
+
+    def write(self, data):
+        return self._pipe.write(data)
+
+    def close(self):
+        if self._pipe.closed:
+            return
+        self._pipe.close()
+        self.proc.wait()
+        self._fh.close()
+        # A reader closed before EOF kills the decompressor with SIGPIPE, that's not an error
+        if self.proc.returncode != 0 and not (self.mode == 'rb' and self.proc.returncode == -13):
+            raise subprocess.CalledProcessError(self.proc.returncode, self.proc.args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Codec():
+    '''Base class for compression backends.
+       :param int threads: Number of threads the backend may use, if it supports threading
+       :param int level: Compression level'''
+
+    name = ''
+    ext = '.gz'
+    gzip_compatible = True
+
+    def __init__(self, threads=1, level=6):
+        self.threads = threads
+        self.level = level
+
+    def available(self):
+        return True
+
+    def open(self, path, mode='rb'):
+        raise NotImplementedError
+
+    def compress(self, data):
+        raise NotImplementedError
+
+    def decompress_cmd(self):
+        raise NotImplementedError
+
+    def compress_cmd(self):
+        raise NotImplementedError
+
+    def __str__(self):
+        return self.name
+
+
+class GzipCodec(Codec):
+    '''Python standard library gzip'''
+
+    name = 'gzip'
+
+    def open(self, path, mode='rb'):
+        # Use mid sized caches 134mb to reduce network load
+        fh = open(path, mode, buffering=2**27)
+        gz = gzip.GzipFile(mode=mode, fileobj=fh, compresslevel=self.level)
+        # Make sure closing the GzipFile also closes the underlying file
+        gz.myfileobj = fh
+        return gz
+
+    def compress(self, data):
+        return gzip.compress(data, compresslevel=self.level)
+
+    def decompress_cmd(self):
+        return 'gzip -cd'
+
+    def compress_cmd(self):
+        return 'gzip -c -{0}'.format(self.level)
+
+
+class PigzCodec(Codec):
+    '''External multi-threaded pigz process'''
+
+    name = 'pigz'
+
+    def available(self):
+        return shutil.which('pigz') is not None
+
+    def open(self, path, mode='rb'):
+        return ProcessFile(self.decompress_cmd().split() if mode == 'rb' else self.compress_cmd().split(), path, mode)
+
+    def compress(self, data):
+        return subprocess.run(self.compress_cmd().split(), input=data, stdout=subprocess.PIPE, check=True).stdout
+
+    def decompress_cmd(self):
+        return 'pigz -p {0} -cd'.format(self.threads)
+
+    def compress_cmd(self):
+        return 'pigz -p {0} -c -{1}'.format(self.threads, self.level)
+
+
+class BgzipCodec(PigzCodec):
+    '''External multi-threaded bgzip process, produces block gzip (BGZF) which is still valid gzip'''
+
+    name = 'bgzip'
+
+    def available(self):
+        return shutil.which('bgzip') is not None
+
+    def decompress_cmd(self):
+        return 'bgzip -@ {0} -cd'.format(self.threads)
+
+    def compress_cmd(self):
+        return 'bgzip -@ {0} -c -l {1}'.format(self.threads, self.level)
+
+
+class IsalCodec(Codec):
+    '''In-process Intel ISA-L deflate via python-isal, several times faster than zlib.
+       ISA-L only has compression levels 0-3'''
+
+    name = 'isal'
+
+    def available(self):
+        try:
+            import isal.igzip  # noqa
+            return True
+        except ImportError:
+            return False
+
+    def open(self, path, mode='rb'):
+        import isal.igzip
+        fh = open(path, mode, buffering=2**27)
+        gz = isal.igzip.IGzipFile(mode=mode, fileobj=fh, compresslevel=min(self.level, 3))
+        gz.myfileobj = fh
+        return gz
+
+    def compress(self, data):
+        import isal.igzip
+        return isal.igzip.compress(data, compresslevel=min(self.level, 3))
+
+    # The interpreter that has python-isal, a bare python in a work_script may be another one
+    def decompress_cmd(self):
+        return '{0} -m isal.igzip -cd'.format(sys.executable)
+
+    def compress_cmd(self):
+        return '{0} -m isal.igzip -c -{1}'.format(sys.executable, min(self.level, 3))
+
+
+class ZstdCodec(Codec):
+    '''In-process Zstandard via the zstandard package. Not gzip compatible,
+       so only suitable for intermediate files read back by this package'''
+
+    name = 'zstd'
+    ext = '.zst'
+    gzip_compatible = False
+
+    def available(self):
+        try:
+            import zstandard  # noqa
+            return True
+        except ImportError:
+            return False
+
+    def open(self, path, mode='rb'):
+        import zstandard
+        fh = open(path, mode, buffering=2**27)
+        if mode == 'rb':
+            return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(fh, closefd=True), buffer_size=2**22)
+        else:
+            return zstandard.ZstdCompressor(level=self.level, threads=self.threads).stream_writer(fh, closefd=True)
+
+    def compress(self, data):
+        import zstandard
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress_cmd(self):
+        return 'zstd -cd'
+
+    def compress_cmd(self):
+        return 'zstd -c -T{0} -{1}'.format(self.threads, self.level)
+
+
+CODECS = {c.name: c for c in [GzipCodec, PigzCodec, BgzipCodec, IsalCodec, ZstdCodec]}
+
+# Codecs to try, in order, if the one asked for isn't installed. Stdlib gzip is always available
+FALLBACKS = {'gzip': [],
+             'pigz': ['bgzip', 'isal', 'gzip'],
+             'bgzip': ['pigz', 'isal', 'gzip'],
+             'isal': ['pigz', 'bgzip', 'gzip'],
+             'zstd': ['isal', 'pigz', 'gzip']}
+
+
+def get_codec(name='gzip', threads=1, level=6):
+    '''Return an instance of codec ``name``, falling back through FALLBACKS if it isn't installed'''
+    if name not in CODECS:
+        raise ValueError("Unknown codec {0}, choose from {1}".format(name, ", ".join(CODECS)))
+
+    for n in [name] + FALLBACKS[name]:
+        codec = CODECS[n](threads=threads, level=level)
+        if codec.available():
+            if n != name:
+                logger.warning("Compression codec {0} not available, falling back to {1}".format(name, n))
+            return codec
+
+
+def open_compressed(path, codec=None, process=False):
+    '''Open the compressed file ``path`` for reading, detecting gzip or zstd from the magic number.
+       Gzip files are read with ``codec`` if given, otherwise the stdlib.
+
+       :param bool process: decompress in a subprocess with the codec's decompress_cmd, so decompression
+                            runs alongside whatever is reading the file rather than in the same process'''
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(ZSTD_MAGIC):
+        codec = ZstdCodec()
+    elif magic.startswith(GZIP_MAGIC):
+        codec = codec if codec is not None and codec.gzip_compatible else GzipCodec()
+    else:
+        raise ValueError("{0} is not gzip or zstd compressed".format(path))
+    if process:
+        return ProcessFile(codec.decompress_cmd().split(), path, 'rb')
+    return codec.open(path, 'rb')
+
+
+def task_codec(task, default='gzip'):
+    '''Return the codec for ``task``, chosen per task family by the ``codec`` option in the
+       task's section of the luigi config eg [FastxQC] codec=pigz. Uses the task's n_cpu as threads'''
+    from luigi.configuration import get_config
+    name = get_config().get(task.task_family, 'codec', default)
+    return get_codec(name, threads=getattr(task, 'n_cpu', 1))
@@ -0,0 +1,172 @@
+'''
+Gathering HDF5 shards, each holding a block of variants, into one file without decoding the data where possible.
+
+'virtual' writes HDF5 Virtual Datasets that map onto the shard files, so nothing is copied
+at all but the shards have to be kept.
+'chunks' copies the compressed chunks of each dataset straight into the output with
+read_direct_chunk/write_direct_chunk while the shards' rows line up with the output's chunks.
+The output has one chunk grid, so once a shard's length isn't a multiple of the chunk size every
+later shard is decoded and recompressed. Shards of a scattered VCF almost never line up past the first,
+so 'chunks' is only much faster than copying rows when the shards are written in whole chunks.
+
+Virtual Datasets need h5py >= 2.9 built against HDF5 >= 1.10 and copying chunks directly h5py >= 2.10,
+with older versions 'virtual' falls back to 'chunks' and 'chunks' decodes every row.
+'''
+import os
+import itertools
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('luigi-interface')
+
+# Most data decoded at once when rows have to be copied the slow way
+COPY_BLOCK_BYTES = 2**26
+
+
+def _structure(f):
+    '''Returns the (groups, datasets) in the h5py File ``f``'''
+    import h5py
+    groups, datasets = [], []
+    f.visititems(lambda n, o: datasets.append(n) if isinstance(o, h5py.Dataset) else groups.append(n))
+    return groups, datasets
+
+
+def has_virtual():
+    '''Whether h5py can write Virtual Datasets'''
+    import h5py
+    return hasattr(h5py, 'VirtualLayout') and getattr(h5py.version, 'hdf5_version_tuple', (0,)) >= (1, 10)
+
+
+def has_direct_chunks():
+    '''Whether h5py can copy chunks without decoding them'''
+    import h5py
+    return hasattr(h5py.h5d.DatasetID, 'read_direct_chunk') and hasattr(h5py.h5d.DatasetID, 'write_direct_chunk')
+
+
+def num_chunks(d):
+    '''Number of chunks in the grid of the chunked dataset ``d``'''
+    return int(np.prod([-(-s // c) for s, c in zip(d.shape, d.chunks)]))
+
+
+def _layout(d):
+    '''The storage options of dataset ``d`` that have to match for its chunks to be copied directly'''
+    return (d.dtype, d.shape[1:], d.chunks, d.compression, d.compression_opts, d.shuffle, d.fletcher32, d.scaleoffset)
+
+
+def copy_rows(src, dst, offset, start, stop):
+    '''Decode rows [start, stop) of ``src`` and write them at ``offset`` + start in ``dst``, in blocks
+       cut at ``dst``'s chunk boundaries so output chunks aren't repeatedly rewritten'''
+    row_bytes = max(src.dtype.itemsize * int(np.prod(src.shape[1:])), 1)
+    chunk = dst.chunks[0] if dst.chunks else 1
+    step = max(chunk, COPY_BLOCK_BYTES // row_bytes // chunk * chunk)
+    a = start
+    while a < stop:
+        # End on an output chunk boundary
+        b = min(stop, ((offset + a) // step + 1) * step - offset)
+        dst[offset + a:offset + b] = src[a:b]
+        a = b
+
+
+def copy_chunks(src, dst, offset, last=False):
+    '''Copy dataset ``src`` into rows ``offset`` onwards of ``dst``. Chunks are copied without decoding if
+       ``offset`` is on a chunk boundary, the final partial chunk only if this is the ``last`` shard.
+       Returns the number of chunks copied directly'''
+    n = src.shape[0]
+    if n == 0:
+        return 0
+    chunks = src.chunks
+    if chunks is None or offset % chunks[0] != 0 or not has_direct_chunks():
+        copy_rows(src, dst, offset, 0, n)
+        return 0
+
+    # Rows that fill whole chunks, plus the partial chunk at the end of the output
+    whole = n if last else n - n % chunks[0]
+    copied = 0
+    grid = [range(0, s, c) for s, c in zip(src.shape[1:], chunks[1:])]
+    for row in range(0, whole, chunks[0]):
+        for rest in itertools.product(*grid):
+            try:
+                mask, data = src.id.read_direct_chunk((row,) + rest)
+            except (KeyError, OSError):
+                # Chunk was never written, leave it as fill value
+                continue
+            dst.id.write_direct_chunk((offset + row,) + rest, data, mask)
+            copied += 1
+    if whole < n:
+        copy_rows(src, dst, offset, whole, n)
+    return copied
+
+
+def gather_hd5s(inputs, output, mode='virtual'):
+    '''Concatenate the variants in the HDF5 files ``inputs`` along the first axis of every dataset,
+       except 'samples' which must be the same in every file, into ``output``.
+
+       :param mode: 'virtual' to write Virtual Datasets that refer to the inputs, which must then be kept,
+                    'chunks' to copy them, compressed chunks directly where they line up'''
+    import h5py
+    if mode not in ('chunks', 'virtual'):
+        raise ValueError("mode must be 'chunks' or 'virtual'")
+    if mode == 'virtual' and not has_virtual():
+        logger.warning("h5py {0} can't write Virtual Datasets, copying the data instead".format(h5py.version.version))
+        mode = 'chunks'
+
+    fs = [h5py.File(path, mode='r') for path in inputs]
+    try:
+        # Verify all H5s have the same structure
+        structures = [_structure(f) for f in fs]
+        groups, datasets = structures[0]
+        for path, f, (g, d) in zip(inputs, fs, structures):
+            if set(d) != set(datasets):
+                raise Exception("All HDF5 files must have the same groups/datasets, {0} differs".format(path))
+            if 'samples' in datasets and not np.array_equal(f['samples'][:], fs[0]['samples'][:]):
+                raise Exception("All HDF5 files must have the same samples, {0} differs".format(path))
+
+        temp = output + '.temp'
+        with h5py.File(temp, 'w') as fout:
+            for g in groups:
+                fout.require_group(g)
+
+            direct, total = 0, 0
+            for d in datasets:
+                first = fs[0][d]
+                if d == 'samples':
+                    fout.create_dataset(d, data=first[:])
+                    continue
+                shape = (sum(f[d].shape[0] for f in fs),) + first.shape[1:]
+
+                if mode == 'virtual':
+                    layout = h5py.VirtualLayout(shape=shape, dtype=first.dtype)
+                    offset = 0
+                    for path, f in zip(inputs, fs):
+                        n = f[d].shape[0]
+                        layout[offset:offset + n] = h5py.VirtualSource(os.path.abspath(path), d, shape=f[d].shape)
+                        offset += n
+                    fout.create_virtual_dataset(d, layout)
+                    continue
+
+                same = all(_layout(f[d]) == _layout(first) for f in fs) and first.chunks is not None
+                if same:
+                    # Resizable, otherwise h5py won't allow chunks bigger than the whole dataset
+                    out = fout.create_dataset(d, shape=shape, maxshape=(None,) + shape[1:], dtype=first.dtype, chunks=first.chunks,
+                                              compression=first.compression, compression_opts=first.compression_opts,
+                                              shuffle=first.shuffle, fletcher32=first.fletcher32,
+                                              scaleoffset=first.scaleoffset)
+                else:
+                    out = fout.create_dataset(d, shape=shape, dtype=first.dtype, chunks=True, compression='gzip')
+
+                offset = 0
+                for i, f in enumerate(fs):
+                    if same:
+                        direct += copy_chunks(f[d], out, offset, last=(i == len(fs) - 1))
+                        total += num_chunks(f[d])
+                    else:
+                        copy_rows(f[d], out, offset, 0, f[d].shape[0])
+                    offset += f[d].shape[0]
+
+            if mode == 'chunks':
+                logger.info("Gathered {0} HDF5 files, copied {1}/{2} chunks without decoding".format(len(fs), direct, total))
+        os.rename(temp, output)
+    finally:
+        for f in fs:
+            f.close()
@@ -0,0 +1,181 @@
+'''
+Adding libraries to an existing callset without genotyping all of it again.
+
+The previous raw callset (tabix indexed, as written by GatherVCF) is the store, the samples
+in its header are the libraries already called and the combined gVCFs CombineGVCFs keeps
+are reused for them. Intervals of the mask where any new library has a variant record in its
+gVCF are genotyped again over every library. Everywhere else the new libraries are reference
+like, so the previous records stand and the new libraries' genotypes, from GenotypeGVCFs run
+on their gVCFs alone, are merged into them as extra columns.
+
+The new callset must use the same mask and reference as the previous one.
+
+Only AC, AN, AF and DP are recalculated for the merged records. The site annotations GenotypeGVCFs
+computes from the reads of every sample (QD, FS, MQ, the rank sum tests etc, see :data:`STALE_INFO`)
+can't be updated without genotyping again, so they are removed from the merged records rather than
+left describing the previous libraries only. Hard filters on them, eg the QD and FS filters of
+VcfToolsFilter, then don't apply to those records. QUAL is also the previous callset's.
+'''
+import os
+import sys
+import bisect
+
+from fieldpathogenomics.bgzf import _open_vcf, BgzfWriter
+
+import logging
+logger = logging.getLogger('luigi-interface')
+
+# INFO annotations of GenotypeGVCFs that depend on the reads of every sample
+STALE_INFO = ['BaseQRankSum', 'ClippingRankSum', 'ExcessHet', 'FS', 'InbreedingCoeff', 'MLEAC', 'MLEAF',
+              'MQ', 'MQRankSum', 'QD', 'ReadPosRankSum', 'SOR']
+
+
+def vcf_samples(path):
+    '''The sample names in the header of the VCF ``path``'''
+    with _open_vcf(path) as f:
+        for line in f:
+            if line.startswith(b'#CHROM'):
+                return [s.decode() for s in line.rstrip(b'\r\n').split(b'\t')[9:]]
+            if not line.startswith(b'#'):
+                break
+    return []
+
+
+def stale_info(path):
+    '''The tags of :data:`STALE_INFO` defined in the header of the VCF ``path``, so bcftools annotate -x
+       is only asked to remove tags it knows'''
+    tags = set()
+    with _open_vcf(path) as f:
+        for line in f:
+            if not line.startswith(b'##'):
+                break
+            if line.startswith(b'##INFO=<ID='):
+                tags.add(line[len(b'##INFO=<ID='):].split(b',', 1)[0].decode())
+    return [t for t in STALE_INFO if t in tags]
+
+
+def new_libraries(previous, lib_list):
+    '''Libraries in ``lib_list`` that aren't in the ``previous`` callset, sorted.
+       Raises ValueError if there are none or if the previous callset has libraries that ``lib_list`` doesn't'''
+    samples = set(vcf_samples(previous))
+    removed = samples - set(lib_list)
+    if removed:
+        raise ValueError("Libraries can't be removed from a callset incrementally, {0} aren't in "
+                         "lib_list: {1}".format(previous, ', '.join(sorted(removed))))
+    new = sorted(set(lib_list) - samples)
+    if not new:
+        raise ValueError("Every library is already in {0}".format(previous))
+    return new
+
+
+def gvcf_variant_sites(path):
+    '''Yield (contig, start, end) 0-based half open of the records in the gVCF ``path`` with an
+       alternate allele other than <NON_REF>, ie everything but reference blocks'''
+    with _open_vcf(path) as f:
+        for line in f:
+            if line.startswith(b'#'):
+                continue
+            contig, pos, _, ref, alt = line.split(b'\t', 5)[:5]
+            if any(a != b'<NON_REF>' for a in alt.split(b',')) and alt != b'.':
+                start = int(pos) - 1
+                yield contig.decode(), start, start + len(ref)
+
+
+def read_bed(path):
+    '''Returns (lines, intervals) of the BED file ``path``, intervals as (contig, start, end)'''
+    with open(path) as f:
+        lines = [l for l in f if l.strip() and not l.startswith(('#', 'track', 'browser'))]
+    return lines, [(l.split()[0], int(l.split()[1]), int(l.split()[2])) for l in lines]
+
+
+def affected_intervals(intervals, sites):
+    '''Indices of the ``intervals`` that overlap any of ``sites``, both as (contig, start, end)'''
+    by_contig = {}
+    for i, (contig, start, end) in enumerate(intervals):
+        by_contig.setdefault(contig, []).append((start, end, i))
+    index = {}
+    for contig, ivs in by_contig.items():
+        ivs.sort()
+        # Running max of the ends, so the search can stop at the first interval that can't overlap
+        ends, m = [], -1
+        for start, end, i in ivs:
+            m = max(m, end)
+            ends.append(m)
+        index[contig] = ([s for s, e, i in ivs], ends, ivs)
+
+    affected = set()
+    for contig, start, end in sites:
+        if contig not in index:
+            continue
+        starts, ends, ivs = index[contig]
+        j = bisect.bisect_left(starts, end) - 1
+        while j >= 0 and ends[j] > start:
+            if ivs[j][1] > start:
+                affected.add(ivs[j][2])
+            j -= 1
+    return sorted(affected)
+
+
+def write_affected(mask, gvcfs, output):
+    '''Write the intervals of the BED ``mask`` that overlap variants in any of the ``gvcfs`` to ``output``'''
+    lines, intervals = read_bed(mask)
+    affected = set()
+    for gvcf in gvcfs:
+        affected.update(affected_intervals(intervals, gvcf_variant_sites(gvcf)))
+    logger.info("{0} of {1} intervals have variants in the new libraries".format(len(affected), len(intervals)))
+    with open(output + '.temp', 'w') as f:
+        f.writelines(lines[i].rstrip('\n') + '\n' for i in sorted(affected))
+    os.rename(output + '.temp', output)
+
+
+def split_shard(shard, affected, affected_out, unaffected_out):
+    '''Split the intervals of the BED ``shard`` into those that are also in the BED ``affected`` and the rest.
+       Returns the number of intervals in each'''
+    shard_lines = [l.rstrip('\n') for l in read_bed(shard)[0]]
+    affected_lines = {l.rstrip('\n') for l in read_bed(affected)[0]}
+    yes = [l for l in shard_lines if l in affected_lines]
+    no = [l for l in shard_lines if l not in affected_lines]
+    for path, lines in ((affected_out, yes), (unaffected_out, no)):
+        with open(path, 'w') as f:
+            f.writelines(l + '\n' for l in lines)
+    return len(yes), len(no)
+
+
+def write_header(previous, samples, output):
+    '''Write a BGZF VCF to ``output`` with no records, the header of the VCF ``previous`` but the ``samples``'''
+    header = []
+    with _open_vcf(previous) as f:
+        for line in f:
+            if line.startswith(b'#CHROM'):
+                header.append(b'\t'.join(line.rstrip(b'\r\n').split(b'\t')[:9] + [s.encode() for s in samples]) + b'\n')
+                break
+            header.append(line)
+    writer = BgzfWriter(output + '.temp')
+    writer.write(b''.join(header))
+    writer.close()
+    os.rename(output + '.temp', output)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Steps of adding libraries to a callset, run by GenotypeGVCF")
+    sub = parser.add_subparsers(dest='command')
+    split = sub.add_parser('split', help="Split the BED shard into the intervals that are in the affected BED and the rest")
+    split.add_argument('shard')
+    split.add_argument('affected')
+    split.add_argument('affected_out')
+    split.add_argument('unaffected_out')
+    header = sub.add_parser('header', help="Write a VCF with no records, the header of previous and the samples in samples_file")
+    header.add_argument('previous')
+    header.add_argument('samples_file')
+    header.add_argument('output')
+    args = parser.parse_args()
+
+    if args.command == 'split':
+        split_shard(args.shard, args.affected, args.affected_out, args.unaffected_out)
+    elif args.command == 'header':
+        with open(args.samples_file) as f:
+            write_header(args.previous, [l.strip() for l in f if l.strip()], args.output)
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -0,0 +1,274 @@
+'''
+Submitting SlurmExecutableTasks as elements of SLURM job arrays rather than one sbatch each.
+
+Each task writes its work_script to a spool directory shared by all tasks with the same
+family and resource request. Whichever luigi worker holds the spool's lock once the oldest script
+has waited ArrayConfig().window seconds, or max_size scripts are waiting, moves them into a
+batch directory and submits the batch as one array job. Every element writes its exit status
+next to its script, which the task that wrote it is polling for, so each task still succeeds or
+fails on its own.
+
+Each task holds its luigi worker while it waits, so an array is never larger than the number of
+luigi workers (--workers). Run with many workers, eg one per library, for the arrays to be worthwhile.
+
+    <spool_dir>/<shape>/pending/<key>.sh        waiting to be submitted
+    <spool_dir>/<shape>/assigned/<key>          batch directory, array index and jobid
+    <spool_dir>/<shape>/<batch>/<index>.sh      with .out, .err and .exit once it has run
+'''
+import os
+import time
+import fcntl
+import shlex
+import hashlib
+import subprocess
+
+import luigi
+from bioluigi.slurm import SlurmExecutableTask
+
+import logging
+logger = logging.getLogger('luigi-interface')
+alloc_log = logging.getLogger('alloc_log')
+
+class ArrayConfig(luigi.Config):
+    '''Settings for SLURM job arrays, in the [ArrayConfig] section of the luigi config.
+
+       :param enabled: submit ArrayTasks in arrays, otherwise they are submitted one at a time as normal
+       :param spool_dir: directory shared by the luigi workers to collect scripts into arrays,
+                         by default .slurm_arrays in the working directory when the first task is submitted
+       :param window: seconds to wait for more tasks of the same shape before submitting
+       :param max_size: most tasks in one array, arrays are also limited by the number of luigi workers
+       :param max_running: most elements of an array running at once (sbatch --array=...%N), 0 for no limit
+       :param poll_time: seconds between checks for an element finishing
+       :param submit_timeout: seconds sbatch is given to submit an array, a task whose script has been
+                              waiting longer than this after the window gives up
+       :param sbatch: the sbatch command'''
+    enabled = luigi.BoolParameter(default=False)
+    spool_dir = luigi.Parameter(default='')
+    window = luigi.FloatParameter(default=30)
+    max_size = luigi.IntParameter(default=1000)
+    max_running = luigi.IntParameter(default=0)
+    poll_time = luigi.FloatParameter(default=10)
+    submit_timeout = luigi.FloatParameter(default=300)
+    sbatch = luigi.Parameter(default='sbatch')
+
+
+WRAPPER = '''#!/bin/bash
+i=$SLURM_ARRAY_TASK_ID
+bash {batch}/$i.sh > {batch}/$i.out 2> {batch}/$i.err
+echo $? > {batch}/$i.exit.temp
+mv {batch}/$i.exit.temp {batch}/$i.exit
+'''
+
+
+def shape(task):
+    '''Name of the spool for tasks that can share an array with ``task``'''
+    args = getattr(task, 'sbatch_args', '') or ''
+    h = hashlib.sha1(args.encode()).hexdigest()[:8]
+    return "{0}_{1}x{2}_{3}_{4}".format(task.task_family, task.mem, task.n_cpu, task.partition.replace(',', '+'), h)
+
+
+class ArraySpool():
+    '''Collects the scripts of tasks with the same resource request and submits them as arrays.
+
+       :param path: spool directory, shared by every task of this shape
+       :param mem: memory per CPU in MB
+       :param n_cpu: CPUs per element
+       :param partition: SLURM partition(s)
+       :param sbatch_args: any other arguments to sbatch
+       :param name: job name'''
+
+    def __init__(self, path, mem, n_cpu, partition, sbatch_args='', name='array'):
+        self.path = path
+        self.sbatch_args = "--mem-per-cpu {0} -c {1} -p {2} -J {3} {4}".format(mem, n_cpu, partition, name, sbatch_args or '')
+        for d in ('pending', 'assigned'):
+            os.makedirs(os.path.join(path, d), exist_ok=True)
+
+    def add(self, key, script):
+        '''Queue ``script`` under ``key``, which must be unique among the tasks waiting'''
+        path = os.path.join(self.path, 'pending', key + '.sh')
+        with open(path + '.temp', 'w') as f:
+            f.write(script)
+        os.rename(path + '.temp', path)
+
+    def assignment(self, key):
+        '''(batch directory, index, jobid) that ``key`` was submitted in, or None if it's still pending'''
+        try:
+            with open(os.path.join(self.path, 'assigned', key)) as f:
+                batch, index, jobid = f.read().split('\t')
+            return batch, int(index), jobid
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def try_submit(self, config):
+        '''Submit the pending scripts as an array if this process can take the lock and they have waited long enough'''
+        with open(os.path.join(self.path, '.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            pending = os.path.join(self.path, 'pending')
+            scripts = sorted((os.path.getmtime(os.path.join(pending, s)), s)
+                             for s in os.listdir(pending) if s.endswith('.sh'))
+            if not scripts or (time.time() - scripts[0][0] < config.window and len(scripts) < config.max_size):
+                return
+            for i in range(0, len(scripts), config.max_size):
+                self.submit([s for t, s in scripts[i:i + config.max_size]], config)
+
+    def submit(self, scripts, config):
+        batch = os.path.join(self.path, "batch_{0}_{1}".format(time.strftime("%Y%m%d-%H%M%S"), os.getpid()))
+        os.makedirs(batch)
+        for i, s in enumerate(scripts):
+            os.rename(os.path.join(self.path, 'pending', s), os.path.join(batch, str(i) + '.sh'))
+        with open(os.path.join(batch, 'run.sh'), 'w') as f:
+            f.write(WRAPPER.format(batch=batch))
+
+        array = "0-{0}".format(len(scripts) - 1) + ("%{0}".format(config.max_running) if config.max_running else '')
+        cmd = (shlex.split(config.sbatch) + ['--parsable', '--array=' + array, '-o', os.path.join(batch, 'slurm_%a.log')] +
+               shlex.split(self.sbatch_args) + [os.path.join(batch, 'run.sh')])
+        try:
+            # Bounded, as every other task of this shape is waiting on the lock held meanwhile
+            jobid = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, universal_newlines=True,
+                                   timeout=config.submit_timeout).stdout.strip().split(';')[0]
+            logger.info("Submitted {0} tasks as array job {1}".format(len(scripts), jobid))
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+            logger.exception("Submitting array {0} failed".format(batch))
+            # Fail every task in the batch rather than leave them waiting
+            jobid = ''
+            for i in range(len(scripts)):
+                with open(os.path.join(batch, str(i) + '.exit'), 'w') as f:
+                    f.write('1\n')
+
+        for i, s in enumerate(scripts):
+            path = os.path.join(self.path, 'assigned', s[:-len('.sh')])
+            with open(path + '.temp', 'w') as f:
+                f.write("{0}\t{1}\t{2}".format(batch, i, jobid))
+            os.rename(path + '.temp', path)
+
+    def wait(self, key, config):
+        '''Block until the script queued as ``key`` has run, returns (exit status, batch, index, jobid).
+           The status is None if the element left the queue without writing one'''
+        assigned = None
+        deadline = time.time() + config.window + 2 * config.submit_timeout
+        while assigned is None:
+            self.try_submit(config)
+            assigned = self.assignment(key)
+            if assigned is None and time.time() > deadline:
+                self.withdraw(key)
+                assigned = self.assignment(key)
+            if assigned is None:
+                time.sleep(min(1, config.window / 10))
+        os.remove(os.path.join(self.path, 'assigned', key))
+        batch, index, jobid = assigned
+
+        exit_file = os.path.join(batch, "{0}.exit".format(index))
+        finished = 0
+        while not os.path.exists(exit_file):
+            time.sleep(config.poll_time)
+            if not jobid:
+                continue
+            state = _job_state("{0}_{1}".format(jobid, index))
+            if state == 'queued':
+                finished = 0
+            elif state == 'finished':
+                # Give the filesystem a moment before deciding it died without writing its status
+                finished += 1
+                if finished > 2 and not os.path.exists(exit_file):
+                    return None, batch, index, jobid
+        with open(exit_file) as f:
+            return int(f.read().strip() or 1), batch, index, jobid
+
+    def withdraw(self, key):
+        '''Take the script queued as ``key`` out of pending, raises an Exception unless it was submitted meanwhile'''
+        try:
+            os.remove(os.path.join(self.path, 'pending', key + '.sh'))
+        except FileNotFoundError:
+            # Taken by a submission, whose assignment is about to appear
+            return
+        raise Exception("Script {0} in {1} was never submitted, is the process holding {2} stuck?".format(
+            key, self.path, os.path.join(self.path, '.lock')))
+
+
+# sacct states of a job that hasn't finished
+ACTIVE_STATES = {'PENDING', 'RUNNING', 'REQUEUED', 'RESIZING', 'SUSPENDED', 'CONFIGURING', 'COMPLETING'}
+
+
+def _job_state(jobid):
+    '''Whether ``jobid`` is 'queued' or 'finished', None if neither squeue nor sacct could tell.
+       A job missing from squeue is only taken as finished once sacct says so, as squeue also
+       fails or comes back empty when the controller is too busy to answer'''
+    try:
+        p = subprocess.run(['squeue', '-h', '-j', jobid, '-o', '%T'], stdout=subprocess.PIPE,
+                           stderr=subprocess.DEVNULL, universal_newlines=True)
+        if p.returncode == 0 and p.stdout.strip():
+            return 'queued'
+        p = subprocess.run(['sacct', '-n', '-X', '-P', '-j', jobid, '-o', 'State'], stdout=subprocess.PIPE,
+                           stderr=subprocess.DEVNULL, universal_newlines=True)
+    except OSError:
+        return None
+    states = [l.split()[0] for l in p.stdout.splitlines() if l.strip()]
+    if p.returncode != 0 or not states:
+        return None
+    return 'queued' if any(st in ACTIVE_STATES for st in states) else 'finished'
+
+
+def spool_dir(config):
+    '''The spool directory from ``config``, resolved when it is first needed rather than at import'''
+    return os.path.abspath(config.spool_dir or '.slurm_arrays')
+
+
+def run_in_array(task, config=None):
+    '''Run ``task``'s work_script as an element of an array job, raises CalledProcessError if it fails'''
+    config = config or ArrayConfig()
+    spool = ArraySpool(os.path.join(spool_dir(config), shape(task)), task.mem, task.n_cpu, task.partition,
+                       getattr(task, 'sbatch_args', ''), name=task.task_family)
+    key = hashlib.sha1(task.task_id.encode()).hexdigest()
+    script = task.work_script()
+    spool.add(key, script)
+
+    status, batch, index, jobid = spool.wait(key, config)
+    if jobid:
+        alloc_log.info("{0}\t{1}_{2}".format(task.task_id, jobid, index))
+    if status != 0:
+        err = os.path.join(batch, "{0}.err".format(index))
+        if os.path.exists(err):
+            with open(err, errors='replace') as f:
+                logger.error("{0} failed in array job {1}_{2}:\n{3}".format(task.task_id, jobid, index, f.read()[-5000:]))
+        else:
+            logger.error("{0} failed in array job {1}_{2} before it started".format(task.task_id, jobid, index))
+        raise subprocess.CalledProcessError(1 if status is None else status, os.path.join(batch, "{0}.sh".format(index)))
+
+
+def _skip_slurm(task, name, *args):
+    '''Call the ``name`` event hook of ``task`` that comes after ArrayTask's, except SlurmExecutableTask's
+       which cleans up after the sbatch job it submits itself, or luigi.Task's if there are no others'''
+    mro = type(task).__mro__
+    for cls in mro[mro.index(ArrayTask) + 1:]:
+        if cls is SlurmExecutableTask:
+            break
+        if name in vars(cls):
+            return vars(cls)[name](task, *args)
+    return getattr(luigi.Task, name)(task, *args)
+
+
+class ArrayTask():
+    '''Mixin for SlurmExecutableTask that submits it as part of a SLURM job array, shared with the
+       other tasks of the same family and resource request that are ready at about the same time,
+       see :func:`run_in_array`. Tasks run locally, or with ArrayConfig().enabled off, are run as normal.
+       SlurmExecutableTask's on_success/on_failure are skipped for tasks run in an array, the other mixins' aren't'''
+    in_array = False
+
+    def run(self):
+        if self.run_locally or not ArrayConfig().enabled:
+            return super().run()
+        self.in_array = True
+        run_in_array(self)
+
+    def on_success(self):
+        if self.in_array:
+            return _skip_slurm(self, 'on_success')
+        return super().on_success()
+
+    def on_failure(self, e):
+        if self.in_array:
+            return _skip_slurm(self, 'on_failure', e)
+        return super().on_failure(e)
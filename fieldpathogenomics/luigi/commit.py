@@ -4,8 +4,13 @@ import luigi
 import os
 import sqlalchemy
 import datetime
+import multiprocessing.util
+from concurrent.futures import ThreadPoolExecutor
 import fieldpathogenomics.utils as utils
 
+import logging
+logger = logging.getLogger('luigi-interface')
+
 
 class CommitToTable(sqla.CopyToTable):
     columns = [(["path", sqlalchemy.String(4096)], {}),
@@ -39,6 +44,71 @@ class CommitToTable(sqla.CopyToTable):
         return hash(str(self._rows))
 
 
+class CommitConfig(luigi.Config):
+    '''Settings for committing to the file database, in the [CommitConfig] section of the luigi config.
+
+       :param background: checksum and commit outputs in a background thread, so the worker is not held up
+       :param connection_string: SQLAlchemy URL of the database eg sqlite:///files.db to work offline'''
+    background = luigi.BoolParameter(default=False)
+    connection_string = luigi.Parameter(default=CommitToTable.connection_string)
+
+
+class FileTable():
+    '''Writes rows to the FileTable, replacing any existing rows for the same paths with a single
+       DELETE ... WHERE path IN (...) and a bulk INSERT in one transaction. Every FileTable in a process
+       shares one pooled engine per database. Use :func:`file_table` to get the one for the configured database.
+
+       Rows are written as soon as they are given, so a task's outputs are in the database before luigi
+       marks it done. luigi's forked task processes each run one task and so can't usefully batch more than
+       that task's outputs, they each connect once.
+
+       :param connection_string: SQLAlchemy URL of the database
+       :param table: name of the table, created if it doesn't exist'''
+
+    _engines = {}
+
+    def __init__(self, connection_string, table=CommitToTable.table):
+        self.engine = self.get_engine(connection_string)
+
+        metadata = sqlalchemy.MetaData()
+        self.table = sqlalchemy.Table(table, metadata,
+                                      *[sqlalchemy.Column(*c[0], **c[1]) for c in CommitToTable.columns])
+        self.table.create(self.engine, checkfirst=True)
+        self.names = [c[0][0] for c in CommitToTable.columns]
+
+    @classmethod
+    def get_engine(cls, connection_string):
+        key = (os.getpid(), connection_string)
+        if key not in cls._engines:
+            # Recycle connections before the MySQL server times them out
+            cls._engines[key] = sqlalchemy.create_engine(connection_string, pool_recycle=3600)
+        return cls._engines[key]
+
+    def write(self, rows):
+        '''Write ``rows``, tuples in the order of CommitToTable.columns'''
+        if not rows:
+            return
+        # Only the last row for each path is kept
+        by_path = {row[0]: dict(zip(self.names, row)) for row in rows}
+        with self.engine.begin() as conn:
+            conn.execute(self.table.delete().where(self.table.c.path.in_(list(by_path))))
+            conn.execute(self.table.insert(), list(by_path.values()))
+        logger.info("Committed {0} rows to {1}".format(len(by_path), self.table.name))
+
+
+# One FileTable per process and database
+_tables = {}
+
+
+def file_table(connection_string=None):
+    '''Return this process's :class:`FileTable` for ``connection_string``, by default the one in CommitConfig'''
+    connection_string = connection_string or CommitConfig().connection_string
+    key = (os.getpid(), connection_string)
+    if key not in _tables:
+        _tables[key] = FileTable(connection_string)
+    return _tables[key]
+
+
 class CommittedTarget(luigi.LocalTarget):
     '''LocalTarget that is checksummed and git commit hash stored
        in the file database on creation.
@@ -48,14 +118,49 @@ class CommittedTarget(luigi.LocalTarget):
     def checksum(self):
         return utils.checksum(self.path)
 
+    def row(self, task_family, pipeline_hash):
+        '''The FileTable row for this target'''
+        return (os.path.abspath(self.path),
+                self.checksum(),
+                datetime.datetime.now(),
+                task_family,
+                utils.current_commit_hash(os.path.split(__file__)[0]),
+                pipeline_hash)
+
     def commit(self, task_family, pipeline_hash):
-        row = (os.path.abspath(self.path),
-               self.checksum(),
-               str(datetime.datetime.now()),
-               task_family,
-               utils.current_commit_hash(os.path.split(__file__)[0]),
-               pipeline_hash)
-        CommitToTable([row]).run()
+        '''Write the row for this target to the file database'''
+        file_table().write([self.row(task_family, pipeline_hash)])
+
+
+# Background commit thread pool and the pid it belongs to, forked processes need their own
+_commit_pool, _commit_pid = None, None
+
+
+def _background_commit(target, task_family, pipeline_hash):
+    try:
+        target.commit(task_family=task_family, pipeline_hash=pipeline_hash)
+    except Exception:
+        logger.exception("Background commit of {0} failed".format(target.path))
+        raise
+
+
+def commit_in_background(target, task_family, pipeline_hash):
+    '''Queue ``target`` to be checksummed and committed by a background thread.
+       Outstanding commits are waited for when the process exits, including luigi's
+       forked task processes which skip the normal atexit handlers'''
+    global _commit_pool, _commit_pid
+    if _commit_pool is None or _commit_pid != os.getpid():
+        _commit_pool, _commit_pid = ThreadPoolExecutor(max_workers=1), os.getpid()
+        multiprocessing.util.Finalize(None, wait_for_commits, exitpriority=100)
+    return _commit_pool.submit(_background_commit, target, task_family, pipeline_hash)
+
+
+def wait_for_commits():
+    '''Block until all background commits have finished'''
+    global _commit_pool
+    if _commit_pool is not None and _commit_pid == os.getpid():
+        _commit_pool.shutdown(wait=True)
+    _commit_pool = None
 
 
 class CommittedTask():
@@ -63,7 +168,10 @@ class CommittedTask():
        It overrides on_sucess to commit the taget checksum to SQL'''
     def on_success(self):
         pipeline_hash = utils.hash_pipeline(self)
-        for o in flatten(self.output()):
-            if isinstance(o, CommittedTarget):
-                o.commit(task_family=self.task_family,
-                         pipeline_hash=pipeline_hash)
+        targets = [o for o in flatten(self.output()) if isinstance(o, CommittedTarget)]
+        if CommitConfig().background:
+            for o in targets:
+                commit_in_background(o, self.task_family, pipeline_hash)
+        else:
+            # All of the task's outputs in one transaction
+            file_table().write([o.row(self.task_family, pipeline_hash) for o in targets])
@@ -0,0 +1,105 @@
+import os
+import datetime
+import statistics
+
+import luigi
+import sqlalchemy
+
+from fieldpathogenomics.luigi.commit import FileTable
+
+import logging
+logger = logging.getLogger('luigi-interface')
+
+
+class HistoryConfig(luigi.Config):
+    '''Settings for the task history database, in the [HistoryConfig] section of the luigi config.
+
+       :param connection_string: SQLAlchemy URL of the database, by default an SQLite file in the virtualenv
+       :param window: number of most recent runs of a task family used to predict the next'''
+    connection_string = luigi.Parameter(default='sqlite:///' + os.path.join(os.environ['VIRTUAL_ENV'], 'task_history.db'))
+    window = luigi.IntParameter(default=20)
+
+
+class TaskHistory():
+    '''Records how long each run of a task took and with what resources, so the
+       cost of the next run of the same task family can be predicted.
+
+       :param connection_string: SQLAlchemy URL of the database
+       :param table: name of the table, created if it doesn't exist'''
+
+    columns = [(["id", sqlalchemy.Integer], {'primary_key': True}),
+               (["task_family", sqlalchemy.String(100)], {'index': True}),
+               (["task_id", sqlalchemy.String(1000)], {}),
+               (["executor", sqlalchemy.String(10)], {}),
+               (["elapsed", sqlalchemy.Float], {}),
+               (["mem", sqlalchemy.INTEGER], {}),
+               (["n_cpu", sqlalchemy.INTEGER], {}),
+               (["partition", sqlalchemy.String(100)], {}),
+               (["input_bytes", sqlalchemy.BigInteger], {}),
+               (["state", sqlalchemy.String(20)], {}),
+               # Filled in from sacct for SLURM jobs, see fieldpathogenomics.luigi.resources.ingest_sacct
+               (["jobid", sqlalchemy.String(20)], {}),
+               (["max_rss", sqlalchemy.Float], {}),
+               (["cpu_time", sqlalchemy.Float], {}),
+               (["datetime", sqlalchemy.DateTime], {})]
+
+    def __init__(self, connection_string, table='TaskHistory', window=20):
+        self.window = window
+        self.engine = FileTable.get_engine(connection_string)
+        metadata = sqlalchemy.MetaData()
+        self.table = sqlalchemy.Table(table, metadata,
+                                      *[sqlalchemy.Column(*c[0], **c[1]) for c in self.columns])
+        self.table.create(self.engine, checkfirst=True)
+        # Recent elapsed times by (task_family, executor)
+        self._elapsed = {}
+
+    def record(self, task, executor, elapsed=None, state='COMPLETED', input_bytes=None):
+        '''Add a run of ``task`` on ``executor`` ('local' or 'slurm') that took ``elapsed`` seconds'''
+        row = {'task_family': task.task_family, 'task_id': task.task_id, 'executor': executor,
+               'elapsed': elapsed, 'mem': getattr(task, 'mem', None), 'n_cpu': getattr(task, 'n_cpu', None),
+               'partition': getattr(task, 'partition', None), 'input_bytes': input_bytes, 'state': state,
+               'datetime': datetime.datetime.now()}
+        with self.engine.begin() as conn:
+            conn.execute(self.table.insert(), [row])
+        self._elapsed.pop((task.task_family, executor), None)
+
+    def runs(self, *where, limit=None):
+        '''Rows matching all the SQLAlchemy clauses ``where``, most recent first'''
+        q = self.table.select()
+        for w in where:
+            q = q.where(w)
+        q = q.order_by(self.table.c.datetime.desc(), self.table.c.id.desc()).limit(limit)
+        with self.engine.connect() as conn:
+            return list(conn.execute(q))
+
+    def elapsed(self, task_family, executor=None):
+        '''Elapsed seconds of the most recent runs of ``task_family``, optionally only those on ``executor``'''
+        key = (task_family, executor)
+        if key not in self._elapsed:
+            q = self.table.select().where(self.table.c.task_family == task_family)
+            q = q.where(self.table.c.elapsed.isnot(None)).where(self.table.c.state == 'COMPLETED')
+            if executor is not None:
+                q = q.where(self.table.c.executor == executor)
+            q = q.order_by(self.table.c.datetime.desc()).limit(self.window)
+            with self.engine.connect() as conn:
+                self._elapsed[key] = [row.elapsed for row in conn.execute(q)]
+        return self._elapsed[key]
+
+    def predict_elapsed(self, task_family, executor=None):
+        '''Median of the recent elapsed times of ``task_family``, None if it has never been run'''
+        elapsed = self.elapsed(task_family, executor)
+        return statistics.median(elapsed) if elapsed else None
+
+
+# One history per process and database
+_histories = {}
+
+
+def task_history(connection_string=None):
+    '''Return this process's :class:`TaskHistory` for ``connection_string``, by default the one in HistoryConfig'''
+    config = HistoryConfig()
+    connection_string = connection_string or config.connection_string
+    key = (os.getpid(), connection_string)
+    if key not in _histories:
+        _histories[key] = TaskHistory(connection_string, window=config.window)
+    return _histories[key]
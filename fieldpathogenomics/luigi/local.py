@@ -0,0 +1,80 @@
+import time
+
+import luigi
+
+from fieldpathogenomics.luigi.history import task_history
+
+import logging
+logger = logging.getLogger('luigi-interface')
+
+
+class LocalConfig(luigi.Config):
+    '''Settings for running small SLURM tasks on the scheduler node, in the [LocalConfig] section of the luigi config.
+       Local tasks each take one unit of the luigi resource ``local``, so set eg local=8 in the
+       [resources] section to run up to 8 at once, by default they run one at a time.
+
+       :param enabled: route small tasks locally, otherwise everything is submitted to SLURM
+       :param max_runtime: longest predicted runtime in seconds of a task that is run locally
+       :param max_mem: most memory in MB a task can request and be run locally
+       :param max_cpu: most CPUs a task can request and be run locally'''
+    enabled = luigi.BoolParameter(default=False)
+    max_runtime = luigi.FloatParameter(default=600)
+    max_mem = luigi.IntParameter(default=4000)
+    max_cpu = luigi.IntParameter(default=1)
+
+
+def predict_runtime(task):
+    '''Predicted runtime of ``task`` in seconds, from the previous local runs of its task family or
+       failing that its ``expected_runtime``. None if there is no way to tell'''
+    try:
+        elapsed = task_history().predict_elapsed(task.task_family, executor='local')
+    except Exception:
+        logger.exception("Couldn't read the task history")
+        elapsed = None
+    return elapsed if elapsed is not None else getattr(task, 'expected_runtime', None)
+
+
+def runs_locally(task):
+    '''True if ``task`` should run on this node rather than be submitted to SLURM, because
+       it requests few resources and is predicted to finish within LocalConfig().max_runtime'''
+    if getattr(task, 'run_locally', False):
+        return True
+    config = LocalConfig()
+    if not config.enabled:
+        return False
+    if task.mem > config.max_mem or task.n_cpu > config.max_cpu:
+        return False
+    runtime = predict_runtime(task)
+    return runtime is not None and runtime <= config.max_runtime
+
+
+class LocalTask():
+    '''Mixin for SlurmTask/SlurmExecutableTask that runs the task in the luigi worker process instead
+       of submitting it to SLURM when :func:`runs_locally` says it's small enough. The task is run exactly
+       as with --run-locally, so its outputs are created the same way. Local runs are timed and recorded
+       in the task history to refine the prediction for the next run.
+
+       :cvar expected_runtime: guess at the runtime in seconds, used until the task family has been run locally'''
+    expected_runtime = None
+
+    def _local(self):
+        # Decided once, when the task is scheduled, so it holds the same resources when it runs
+        if not hasattr(self, '_route_local'):
+            self._route_local = runs_locally(self)
+        return self._route_local
+
+    @property
+    def resources(self):
+        return {'local': 1} if self._local() else {}
+
+    def run(self):
+        if self._local() and not self.run_locally:
+            logger.info("Running {0} locally instead of on SLURM".format(self.task_id))
+            self.run_locally = True
+        start = time.time()
+        super().run()
+        if self.run_locally:
+            try:
+                task_history().record(self, 'local', time.time() - start)
+            except Exception:
+                logger.exception("Couldn't record the runtime of {0}".format(self.task_id))
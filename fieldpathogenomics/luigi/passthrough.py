@@ -0,0 +1,40 @@
+import luigi
+
+
+class PassThroughTask():
+    '''Mixin for SlurmTask/SlurmExecutableTask that are optional steps, skipped when
+       :meth:`passes_through` is True. Nothing is submitted to SLURM then, :meth:`pass_through` is run
+       in the worker instead (usually output() just returns the input) and the plain luigi.Task
+       on_success/on_failure are used since there is no SLURM job to clean up after.
+
+       Goes before the other mixins in the bases, eg ``class X(PassThroughTask, ArrayTask, SlurmExecutableTask)``.
+       Whether a task passed through is decided once, so it can depend on files pass_through() moves'''
+
+    def passes_through(self):
+        '''True if this task should be skipped'''
+        return False
+
+    def pass_through(self):
+        '''Run instead of the task when it is skipped, nothing by default'''
+        pass
+
+    def passed_through(self):
+        if not hasattr(self, '_passed_through'):
+            self._passed_through = self.passes_through()
+        return self._passed_through
+
+    def run(self):
+        if self.passed_through():
+            self.pass_through()
+        else:
+            super().run()
+
+    def on_success(self):
+        if self.passed_through():
+            return luigi.Task.on_success(self)
+        return super().on_success()
+
+    def on_failure(self, e):
+        if self.passed_through():
+            return luigi.Task.on_failure(self, e)
+        return super().on_failure(e)
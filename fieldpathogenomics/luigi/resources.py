@@ -0,0 +1,285 @@
+'''
+Right-sizing SLURM requests from the resources previous runs of each task actually used.
+
+Every SLURM run is recorded in the task history along with the total size of its inputs.
+ingest_sacct() then fills in the MaxRSS, Elapsed and TotalCPU of those jobs from sacct,
+using the task_id to jobid mapping in the .salloc.log files written by utils.logging_init,
+run it after a pipeline finishes with
+
+    python -m fieldpathogenomics.luigi.resources logs/*.salloc.log
+
+When a task starts, memory and runtime are predicted from a least squares fit against input size
+over its task family's past runs and the SLURM request is set to that plus a safety margin.
+If the previous attempt at the same task failed its memory is bumped instead.
+
+This only happens once :func:`register` has been called, which fieldpathogenomics.utils.logging_init does,
+and enabled is set in [ResourceConfig].
+'''
+import os
+import re
+import sys
+import math
+import subprocess
+
+import luigi
+from luigi.task import flatten
+from bioluigi.slurm import SlurmExecutableTask, SlurmTask
+
+from fieldpathogenomics.luigi.history import task_history
+
+import logging
+logger = logging.getLogger('luigi-interface')
+
+class ResourceConfig(luigi.Config):
+    '''Settings for resource tuning, in the [ResourceConfig] section of the luigi config.
+
+       :param enabled: tune the mem/n_cpu/partition of SLURM tasks, otherwise they request what they declare
+       :param min_runs: number of completed runs with sacct data needed before a task family is tuned
+       :param margin: fraction added to the predicted memory and runtime
+       :param min_mem: least total memory in MB requested for a tuned task
+       :param max_mem: most total memory in MB requested for any task, including after OOM bumps
+       :param oom_factor: factor the memory of a failed attempt is multiplied by on the next attempt
+       :param partitions: partitions a task can be moved between and their time limits in hours,
+                          tasks declaring any other partition keep it'''
+    enabled = luigi.BoolParameter(default=False)
+    min_runs = luigi.IntParameter(default=3)
+    margin = luigi.FloatParameter(default=0.25)
+    min_mem = luigi.IntParameter(default=500)
+    max_mem = luigi.IntParameter(default=250000)
+    oom_factor = luigi.FloatParameter(default=2)
+    partitions = luigi.Parameter(default='nbi-short:2,nbi-medium:48,nbi-long:720')
+
+
+def input_bytes(task):
+    '''Total size of the files and directories that are the inputs of ``task``'''
+    total = 0
+    for target in flatten(task.input()):
+        path = getattr(target, 'path', None)
+        if path is None or not os.path.exists(path):
+            continue
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        else:
+            total += os.path.getsize(path)
+    return total
+
+
+def fit_linear(xs, ys):
+    '''Least squares fit y = a + b*x, returns (a, b). Flat at the mean if the xs don't vary'''
+    n = len(xs)
+    mx, my = sum(xs) / n, sum(ys) / n
+    sxx = sum((x - mx) ** 2 for x in xs)
+    if sxx == 0:
+        return my, 0
+    b = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sxx
+    return my - b * mx, b
+
+
+def predict(xs, ys, x, margin):
+    '''Upper bound on y at ``x``: the fit of ``ys`` against ``xs`` shifted up so that it covers
+       every observation, plus ``margin`` of that'''
+    a, b = fit_linear(xs, ys)
+    over = max(y - (a + b * xi) for xi, y in zip(xs, ys))
+    return (a + b * x + max(over, 0)) * (1 + margin)
+
+
+def parse_partitions(spec):
+    '''"name:hours,..." to a list of (name, seconds) in order of time limit'''
+    parts = [p.split(':') for p in spec.split(',') if p.strip()]
+    return sorted(((name.strip(), float(hours) * 3600) for name, hours in parts), key=lambda p: p[1])
+
+
+def recommend(task, history=None, size=None):
+    '''Resources for ``task`` from the history of its task family, as a dict with any of mem (MB per CPU),
+       n_cpu and partition that should change, given its declared resources in ``task.mem`` etc'''
+    config = ResourceConfig()
+    history = history or task_history()
+    t = history.table
+    size = input_bytes(task) if size is None else size
+    declared_total = task.mem * task.n_cpu
+
+    # A retry after a failure, most likely running out of memory
+    last = history.runs(t.c.task_id == task.task_id, t.c.executor == 'slurm', limit=1)
+    if last and last[0].mem is not None and last[0].state not in ('COMPLETED', 'TIMEOUT'):
+        total = max(declared_total, last[0].mem * last[0].n_cpu * config.oom_factor)
+        total = min(total, config.max_mem)
+        logger.info("{0} failed last time, bumping memory to {1}MB".format(task.task_id, int(total)))
+        return {'mem': int(math.ceil(total / task.n_cpu))}
+
+    runs = [r for r in history.runs(t.c.task_family == task.task_family, t.c.state == 'COMPLETED',
+                                    t.c.max_rss.isnot(None), limit=100)
+            if r.input_bytes is not None and r.elapsed]
+    if len(runs) < config.min_runs:
+        return {}
+    xs = [r.input_bytes for r in runs]
+
+    # CPUs, only ever fewer than declared
+    n_cpu = task.n_cpu
+    if all(r.cpu_time is not None for r in runs):
+        used = max(r.cpu_time / r.elapsed for r in runs) * (1 + config.margin)
+        n_cpu = min(task.n_cpu, max(1, int(math.ceil(used))))
+
+    total = predict(xs, [r.max_rss for r in runs], size, config.margin)
+    total = min(max(total, config.min_mem), config.max_mem)
+    rec = {'mem': int(math.ceil(total / n_cpu)), 'n_cpu': n_cpu}
+
+    partitions = parse_partitions(config.partitions)
+    if task.partition in [p for p, limit in partitions]:
+        elapsed = predict(xs, [r.elapsed for r in runs], size, config.margin)
+        rec['partition'] = next((p for p, limit in partitions if limit >= elapsed), partitions[-1][0])
+    return rec
+
+
+def tune(task):
+    '''Set ``task``'s SLURM request from :func:`recommend`, starting from what it declares each time'''
+    if not hasattr(task, '_declared'):
+        task._declared = (task.mem, task.n_cpu, task.partition)
+    task.mem, task.n_cpu, task.partition = task._declared
+    rec = recommend(task, size=task._input_bytes)
+    if rec:
+        logger.info("Tuned {0}: {1}".format(task.task_id, rec))
+    for k, v in rec.items():
+        setattr(task, k, v)
+
+
+def _running_on_slurm(task):
+    # LocalTasks are routed when they are scheduled but only set run_locally when they run
+    local = getattr(task, 'run_locally', False) or getattr(task, '_route_local', False)
+    # PassThroughTasks that are skipped don't submit anything
+    skipped = hasattr(task, 'passed_through') and task.passed_through()
+    return ResourceConfig().enabled and not local and not skipped
+
+
+def _on_start(task):
+    if not _running_on_slurm(task):
+        return
+    try:
+        task._input_bytes = input_bytes(task)
+        tune(task)
+    except Exception:
+        logger.exception("Couldn't tune the resources of {0}".format(task.task_id))
+
+
+def _record(task, state):
+    if not _running_on_slurm(task) or not hasattr(task, '_input_bytes'):
+        return
+    try:
+        task_history().record(task, 'slurm', state=state, input_bytes=task._input_bytes)
+    except Exception:
+        logger.exception("Couldn't record the run of {0}".format(task.task_id))
+
+
+def _on_success(task):
+    _record(task, 'COMPLETED')
+
+
+def _on_failure(task, exception):
+    _record(task, 'FAILED')
+
+
+def register():
+    '''Add the event handlers that tune and record every SlurmTask and SlurmExecutableTask, called by
+       fieldpathogenomics.utils.logging_init. luigi fires the events in its task processes, which are forked
+       from the scheduling process and so inherit the handlers added before luigi.run. Adding them again does nothing'''
+    for cls in (SlurmTask, SlurmExecutableTask):
+        cls.event_handler(luigi.Event.START)(_on_start)
+        cls.event_handler(luigi.Event.SUCCESS)(_on_success)
+        cls.event_handler(luigi.Event.FAILURE)(_on_failure)
+
+
+###############################################################################
+#                                   sacct                                     #
+###############################################################################
+
+def parse_slurm_time(t):
+    '''[DD-[HH:]]MM:SS[.mmm] to seconds'''
+    days, _, t = t.rpartition('-') if '-' in t else ('0', '', t)
+    parts = [float(x) for x in t.split(':')]
+    while len(parts) < 3:
+        parts.insert(0, 0)
+    h, m, s = parts
+    return int(days) * 86400 + h * 3600 + m * 60 + s
+
+
+def parse_size(s):
+    '''sacct memory like 1234K to MB, None if blank'''
+    m = re.match(r'([\d.]+)([KMGT]?)', s)
+    if not m:
+        return None
+    base, unit = m.groups()
+    return float(base) * {'': 1024**-2, 'K': 1024**-1, 'M': 1, 'G': 1024, 'T': 1024**2}[unit]
+
+
+def sacct(jobids, batch=500):
+    '''{jobid: {'state', 'elapsed', 'cpu_time', 'max_rss'}} for ``jobids``, MaxRSS is the max over job steps'''
+    jobs = {}
+    for i in range(0, len(jobids), batch):
+        out = subprocess.run(['sacct', '-P', '-n', '--format=JobID,State,Elapsed,TotalCPU,MaxRSS',
+                              '-j', ','.join(jobids[i:i + batch])],
+                             check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        for line in out.splitlines():
+            jobid, state, elapsed, cpu, rss = line.split('|')
+            base = jobid.split('.')[0]
+            job = jobs.setdefault(base, {'max_rss': None})
+            if '.' not in jobid:
+                # sacct reports eg "CANCELLED by 1234"
+                job.update(state=state.split()[0], elapsed=parse_slurm_time(elapsed), cpu_time=parse_slurm_time(cpu))
+            rss = parse_size(rss)
+            if rss is not None:
+                job['max_rss'] = max(job['max_rss'] or 0, rss)
+    return jobs
+
+
+def read_alloc_logs(paths):
+    '''Yield (task_id, jobid) from the .salloc.log files written by utils.logging_init'''
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                # Array elements are jobid_index
+                if len(fields) == 2 and re.fullmatch(r'\d+(_\d+)?', fields[1]):
+                    yield fields[0], fields[1]
+
+
+def ingest_sacct(paths, history=None):
+    '''Fill in the sacct data for the SLURM runs in the task history from the jobs in the
+       .salloc.log files ``paths``. Each task's jobs are matched with its runs in order,
+       jobs with no recorded run are added without an input size. Returns the number of jobs added'''
+    history = history or task_history()
+    t = history.table
+    done = {r.jobid for r in history.runs(t.c.jobid.isnot(None))}
+    by_task = {}
+    for task_id, jobid in read_alloc_logs(paths):
+        if jobid not in done:
+            by_task.setdefault(task_id, []).append(jobid)
+    if not by_task:
+        return 0
+    jobs = sacct(sorted({j for js in by_task.values() for j in js}))
+
+    updates, inserts = [], []
+    for task_id, jobids in by_task.items():
+        runs = history.runs(t.c.task_id == task_id, t.c.executor == 'slurm', t.c.jobid.is_(None))[::-1]
+        for i, jobid in enumerate(sorted(jobids, key=lambda j: [int(x) for x in j.split('_')])):
+            if 'state' not in jobs.get(jobid, {}):
+                continue
+            values = dict(jobs[jobid], jobid=jobid)
+            if i < len(runs):
+                updates.append((runs[i].id, values))
+            else:
+                inserts.append(dict(values, task_id=task_id, task_family=task_id.split('_')[0], executor='slurm'))
+
+    with history.engine.begin() as conn:
+        for id, values in updates:
+            conn.execute(t.update().where(t.c.id == id).values(**values))
+        if inserts:
+            conn.execute(t.insert(), inserts)
+    n = len(updates) + len(inserts)
+    logger.info("Added sacct data for {0} jobs".format(n))
+    return n
+
+
+if __name__ == '__main__':
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+    ingest_sacct(sys.argv[1:])
@@ -1,7 +1,6 @@
 import os
 import sys
 import json
-import math
 import shutil
 from glob import glob
 import multiprocessing_on_dill as multiprocessing
@@ -10,7 +9,7 @@ import luigi
 from luigi import LocalTarget
 from luigi.file import TemporaryFile
 
-from bioluigi.slurm import SlurmExecutableTask
+from bioluigi.slurm import SlurmExecutableTask, SlurmTask
 from bioluigi.utils import CheckTargetNonEmpty
 from bioluigi.decorators import requires, inherits
 from bioluigi.scattergather import ScatterGather
@@ -18,16 +17,20 @@ from bioluigi.notebook import NotebookTask
 
 import fieldpathogenomics
 from fieldpathogenomics.utils import gatk, snpeff, snpsift
-from fieldpathogenomics.SGUtils import ScatterBED, GatherVCF, ScatterVCF, GatherHD5s
+from fieldpathogenomics.SGUtils import (ScatterBED, GatherVCF, ScatterVCFRegions, GatherHD5s, vcf_shard,
+                                        GatherStores, scatter_width, bed_length, ScatterConfig, reduction_tree, is_leaf,
+                                        node_items, node_name, tabix)
 from fieldpathogenomics.luigi.commit import CommittedTarget, CommittedTask
+from fieldpathogenomics.luigi.passthrough import PassThroughTask
+from fieldpathogenomics.incremental import new_libraries, write_affected, stale_info
 import fieldpathogenomics.utils as utils
 import fieldpathogenomics.pipelines.Library as Library
 
 
-FILE_HASH = utils.file_hash(__file__)
 VERSION = fieldpathogenomics.__version__.rsplit('.', 1)[0]
 PIPELINE = os.path.basename(__file__).split('.')[0]
 
+
 '''
 Guidelines for harmonious living:
 --------------------------------
@@ -40,7 +43,19 @@ Notes
 job.mem is actually mem_per_cpu
 '''
 
-N_scatter = int(sys.argv[2]) if __name__ == '__main__' else 5
+MASK = Library.MASK
+# Rough fraction of the sites in the mask that end up as SNPs
+SNP_FRACTION = 0.01
+
+# Scatter widths for each stage, chosen from the number of sites and samples, capped at sys.argv[2]
+if __name__ == '__main__':
+    with open(sys.argv[1], 'r') as libs_file:
+        N_libs = sum(1 for line in libs_file if line.strip())
+    N_sites = bed_length(MASK)
+    N_raw = scatter_width(N_sites, N_libs, max_shards=int(sys.argv[2]))
+    N_snps = scatter_width(N_sites * SNP_FRACTION, N_libs, max_shards=int(sys.argv[2]))
+else:
+    N_raw = N_snps = scatter_width()
 
 
 class GenomeContigs(luigi.ExternalTask):
@@ -72,15 +87,24 @@ class gVCFs(luigi.Task, CheckTargetNonEmpty):
         return [x['gvcf'] for x in self.input()]
 
 
-@requires(gVCFs)
-class CombineGVCFs(SlurmExecutableTask, CheckTargetNonEmpty):
-    '''The number of gVCFs that can be passed to  GenotypeGVCF
-       is limited so this task combines the single library gvcfs
-       into N_gvcf multisample gVCFs'''
+@inherits(gVCFs)
+class CombineGVCFs(PassThroughTask, SlurmExecutableTask, CheckTargetNonEmpty):
+    '''Combines the gVCFs of one node of the tree built by CombineGVCFsWrapper, see
+       :func:`fieldpathogenomics.SGUtils.reduction_tree`. A leaf combines single library gVCFs,
+       higher nodes the combined gVCFs of their children. Outputs are named by the libraries
+       they hold rather than the callset, so are reused by any later callset that includes them.
+       The name also hashes the input paths and the pipeline code upstream, so a node is
+       recombined if those change
 
-    # Number of combined gVCFs to end up with
-    N_gvcfs = luigi.IntParameter(default=5)
-    idx = luigi.IntParameter()
+       :param node: nested list, a leaf is a list of libraries, a higher node a list of nodes'''
+
+    node = luigi.ListParameter()
+
+    def requires(self):
+        if is_leaf(self.node):
+            return self.clone(gVCFs, lib_list=list(self.node))
+        else:
+            return [self.clone(CombineGVCFs, node=child, lib_list=node_items(child)) for child in self.node]
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -90,15 +114,18 @@ class CombineGVCFs(SlurmExecutableTask, CheckTargetNonEmpty):
         self.partition = "nbi-medium"
 
     def output(self):
-        return LocalTarget(os.path.join(self.scratch_dir, VERSION, PIPELINE, self.output_prefix, "combined", self.output_prefix + "_" + str(self.idx) + ".g.vcf"))
+        if len(self.node) == 1:
+            # Nothing to combine
+            return self.input()[0]
+        inputs = "\n".join(sorted(x.path for x in self.input()))
+        salt = utils.hash_pipeline(self) + "\n" + inputs
+        return LocalTarget(os.path.join(self.base_dir, VERSION, PIPELINE, "combined",
+                                        node_name(self.node, salt=salt) + ".g.vcf"))
 
-    def work_script(self):
-        perfile = math.ceil(len(self.input()) / self.N_gvcfs)
-        start_idx = perfile * self.idx
-        end_idx = perfile * (self.idx + 1)
-        self.variants = self.input()[
-            start_idx:end_idx] if self.idx < self.N_gvcfs - 1 else self.input()[start_idx:]
+    def passes_through(self):
+        return len(self.node) == 1
 
+    def work_script(self):
         return '''#!/bin/bash
                 source jre-8u92
                 source gatk-3.6.0
@@ -111,27 +138,63 @@ class CombineGVCFs(SlurmExecutableTask, CheckTargetNonEmpty):
                 '''.format(output=self.output().path,
                            gatk=gatk.format(mem=self.mem * self.n_cpu),
                            reference=self.reference,
-                           variants="\\\n".join([" --variant " + lib.path for lib in self.variants]))
+                           variants="\\\n".join([" --variant " + gvcf.path for gvcf in self.input()]))
 
 
 @inherits(CombineGVCFs)
 class CombineGVCFsWrapper(luigi.Task):
-    idx = None
+    '''Combines the gVCFs of lib_list hierarchically, up to ``fan_in`` at a time, into at most ``fan_in``
+       multisample gVCFs. Libraries are grouped so adding some only recombines the groups they land in'''
+    node = None
+    fan_in = luigi.IntParameter(default=8)
 
     def requires(self):
-        return [self.clone(CombineGVCFs, idx=idx) for idx in range(self.N_gvcfs)]
+        return [self.clone(CombineGVCFs, node=node, lib_list=node_items(node))
+                for node in reduction_tree(self.lib_list, self.fan_in)]
 
     def output(self):
         return self.input()
 
 
-@ScatterGather(ScatterBED, GatherVCF, N_scatter)
+@inherits(gVCFs, GenomeContigs)
+class NewVariantIntervals(SlurmTask):
+    '''Intervals of the mask where the libraries that aren't in the ``previous`` callset have variants,
+       see :mod:`fieldpathogenomics.incremental`'''
+    previous = luigi.Parameter()
+
+    def requires(self):
+        return [self.clone(GenomeContigs), self.clone(gVCFs, lib_list=new_libraries(self.previous, self.lib_list))]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Set the SLURM request params for this task
+        self.mem = 2000
+        self.n_cpu = 1
+        self.partition = "nbi-medium"
+
+    def output(self):
+        return LocalTarget(os.path.join(self.scratch_dir, VERSION, PIPELINE, self.output_prefix, self.output_prefix + "_affected.bed"))
+
+    def work(self):
+        write_affected(self.input()[0].path, [x.path for x in self.input()[1]], self.output().path)
+
+
+@ScatterGather(ScatterBED, GatherVCF, N_raw)
 @inherits(CombineGVCFsWrapper, GenomeContigs)
 class GenotypeGVCF(SlurmExecutableTask, CheckTargetNonEmpty):
-    '''Combine the per sample g.vcfs into a complete callset'''
+    '''Combine the per sample g.vcfs into a complete callset.
+
+       :param previous: an earlier raw callset to add the libraries in lib_list that aren't in it to,
+                        rather than genotype every library over every interval, see :mod:`fieldpathogenomics.incremental`'''
+    previous = luigi.Parameter(default='')
 
     def requires(self):
-        return [self.clone(GenomeContigs), self.clone(CombineGVCFsWrapper)]
+        if self.previous == '':
+            return [self.clone(GenomeContigs), self.clone(CombineGVCFsWrapper)]
+        else:
+            new = new_libraries(self.previous, self.lib_list)
+            return [self.clone(GenomeContigs), self.clone(CombineGVCFsWrapper),
+                    self.clone(CombineGVCFsWrapper, lib_list=new), self.clone(NewVariantIntervals)]
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -144,6 +207,9 @@ class GenotypeGVCF(SlurmExecutableTask, CheckTargetNonEmpty):
         return LocalTarget(os.path.join(self.base_dir, VERSION, PIPELINE, self.output_prefix, self.output_prefix + "_raw.vcf.gz"))
 
     def work_script(self):
+        if self.previous != '':
+            return self.incremental_script()
+
         return '''#!/bin/bash
                 source jre-8u92
                 source gatk-3.6.0
@@ -159,11 +225,78 @@ class GenotypeGVCF(SlurmExecutableTask, CheckTargetNonEmpty):
                            reference=self.reference,
                            variants="\\\n".join([" --variant " + lib.path for lib in self.input()[1]]))
 
+    def incremental_script(self):
+        '''Genotype the intervals of this shard where the new libraries have variants over every library, elsewhere
+           add the new libraries' genotypes to the records of the previous callset'''
+        # Can't be recalculated for the merged records, see fieldpathogenomics.incremental
+        stale = ','.join('INFO/' + tag for tag in stale_info(self.previous))
+        strip = '''
+                bcftools annotate -x {stale} {output}.filled.vcf.gz -O z -o {output}.stripped.vcf.gz
+                mv {output}.stripped.vcf.gz {output}.filled.vcf.gz''' if stale else ''
 
-@ScatterGather(ScatterVCF, GatherVCF, N_scatter)
+        script = '''#!/bin/bash
+                source jre-8u92
+                source gatk-3.6.0
+                source bcftools-1.3.1;
+                {python}
+                gatk='{gatk}'
+
+                set -eo pipefail
+                python -m fieldpathogenomics.incremental split {shard} {affected} {output}.affected.bed {output}.unaffected.bed
+                # GATK orders the samples by name
+                printf '%s\\n' {libs} > {output}.samples
+
+                parts=()
+                if [ -s {output}.affected.bed ]; then
+                $gatk -T GenotypeGVCFs -R {reference} -L {output}.affected.bed -o {output}.affected.vcf.gz --includeNonVariantSites {variants}
+                {tabix} -f -p vcf {output}.affected.vcf.gz
+                parts+=({output}.affected.vcf.gz)
+                fi
+
+                if [ -s {output}.unaffected.bed ]; then
+                $gatk -T GenotypeGVCFs -R {reference} -L {output}.unaffected.bed -o {output}.new.vcf.gz --includeNonVariantSites {new_variants}
+                {tabix} -f -p vcf {output}.new.vcf.gz
+                bcftools view -R {output}.unaffected.bed {previous} -O z -o {output}.previous.vcf.gz
+                {tabix} -f -p vcf {output}.previous.vcf.gz
+
+                bcftools merge -m all -i DP:sum {output}.previous.vcf.gz {output}.new.vcf.gz -O z -o {output}.merged.vcf.gz
+                bcftools +fill-tags {output}.merged.vcf.gz -O z -o {output}.filled.vcf.gz -- -t AC,AN,AF{strip}
+                bcftools view -S {output}.samples {output}.filled.vcf.gz -O z -o {output}.unaffected.vcf.gz
+                {tabix} -f -p vcf {output}.unaffected.vcf.gz
+                parts+=({output}.unaffected.vcf.gz)
+                fi
+
+                if [ ${{#parts[@]}} -eq 0 ]; then
+                python -m fieldpathogenomics.incremental header {previous} {output}.samples {output}.temp.vcf.gz
+                else
+                bcftools concat -a "${{parts[@]}}" -O z -o {output}.temp.vcf.gz
+                fi
+
+                mv {output}.temp.vcf.gz {output}
+                rm -f {output}.affected.bed {output}.unaffected.bed {output}.samples
+                for part in affected unaffected new previous merged filled stripped; do
+                rm -f {output}.$part.vcf.gz {output}.$part.vcf.gz.tbi
+                done
+                '''
+        return script.format(output=self.output().path,
+                             shard=self.input()[0].path,
+                             affected=self.input()[3].path,
+                             libs=' '.join(sorted(self.lib_list)),
+                             previous=self.previous,
+                             strip=strip.format(stale=stale, output=self.output().path),
+                             tabix=tabix,
+                             python=utils.python,
+                             gatk=gatk.format(mem=self.mem * self.n_cpu),
+                             reference=self.reference,
+                             variants="\\\n".join([" --variant " + x.path for x in self.input()[1]]),
+                             new_variants="\\\n".join([" --variant " + x.path for x in self.input()[2]]))
+
+
+@ScatterGather(ScatterVCFRegions, GatherVCF, N_raw)
 @inherits(GenotypeGVCF)
 class VcfToolsFilter(SlurmExecutableTask, CheckTargetNonEmpty):
-    '''Applies hard filtering to the raw callset'''
+    '''Applies hard filtering to the raw callset. In a callset made with ``previous``, records that were
+       merged rather than genotyped again have no QD or FS so only the GQ filter applies to them'''
 
     GQ = luigi.IntParameter(default=30)
     QD = luigi.IntParameter(default=5)
@@ -185,19 +318,21 @@ class VcfToolsFilter(SlurmExecutableTask, CheckTargetNonEmpty):
     def work_script(self):
         self.temp1 = TemporaryFile()
         self.temp2 = TemporaryFile()
+        vcf, bed = vcf_shard(self.input().path)
 
         return '''#!/bin/bash
                 source vcftools-0.1.13;
                 source bcftools-1.3.1;
                 set -eo pipefail
 
-                bcftools view --apply-filters . {input} -o {temp1} -O z --threads 1
+                bcftools view --apply-filters . {regions} {input} -o {temp1} -O z --threads 1
                 bcftools filter {temp1} -e "FMT/RGQ < {GQ} || FMT/GQ < {GQ} || QD < {QD} || FS > {FS}" --set-GTs . -o {temp2} -O z --threads 1
                 vcftools --gzvcf {temp2} --recode --max-missing 0.000001 --stdout --bed {mask} | bgzip -c > {output}.temp
 
                 mv {output}.temp {output}
                 tabix -f -p vcf {output}
-                '''.format(input=self.input().path,
+                '''.format(input=vcf,
+                           regions='-R ' + bed if bed else '',
                            output=self.output().path,
                            GQ=self.GQ,
                            QD=self.QD,
@@ -207,7 +342,7 @@ class VcfToolsFilter(SlurmExecutableTask, CheckTargetNonEmpty):
                            temp2=self.temp2.path)
 
 
-@ScatterGather(ScatterVCF, GatherVCF, N_scatter)
+@ScatterGather(ScatterVCFRegions, GatherVCF, N_raw)
 @inherits(VcfToolsFilter)
 class GetSNPs(SlurmExecutableTask, CommittedTask, CheckTargetNonEmpty):
     '''Extracts just sites with only biallelic SNPs that have a least one variant isolate'''
@@ -226,6 +361,7 @@ class GetSNPs(SlurmExecutableTask, CommittedTask, CheckTargetNonEmpty):
         return CommittedTarget(os.path.join(self.base_dir, VERSION, PIPELINE, self.output_prefix, self.output_prefix + "_SNPs.vcf.gz"))
 
     def work_script(self):
+        vcf, bed = vcf_shard(self.input().path)
         return '''#!/bin/bash
                   source jre-8u92
                   source gatk-3.6.0
@@ -233,7 +369,7 @@ class GetSNPs(SlurmExecutableTask, CommittedTask, CheckTargetNonEmpty):
                   gatk='{gatk}'
                   set -eo pipefail
 
-                  $gatk -T -T SelectVariants -V {input} -R {reference} --restrictAllelesTo BIALLELIC \
+                  $gatk -T -T SelectVariants -V {input} {intervals} -R {reference} --restrictAllelesTo BIALLELIC \
                                                                        --selectTypeToInclude SNP \
                                                                        --out {output}.temp.vcf.gz
 
@@ -242,7 +378,8 @@ class GetSNPs(SlurmExecutableTask, CommittedTask, CheckTargetNonEmpty):
 
                   rm {output}.temp.vcf.gz
                   mv {output}.temp2.vcf.gz {output}
-                  '''.format(input=self.input().path,
+                  '''.format(input=vcf,
+                             intervals='-L ' + bed if bed else '',
                              output=self.output().path,
                              reference=self.reference,
                              gatk=gatk.format(mem=self.mem * self.n_cpu))
@@ -250,17 +387,20 @@ class GetSNPs(SlurmExecutableTask, CommittedTask, CheckTargetNonEmpty):
 
 class VCFtoHDF5(SlurmExecutableTask):
     '''Converts the text vcf files into HD5 files, these are binary
-       and compressed so are much easier to work with downstream'''
+       and compressed so are much easier to work with downstream.
+       Streamed in one pass, see :mod:`fieldpathogenomics.vcf2hd5`'''
+    ext = '.hd5'
+    module = 'fieldpathogenomics.vcf2hd5'
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Set the SLURM request params for this task
-        self.mem = 64000
-        self.n_cpu = 1
+        self.mem = 2000
+        self.n_cpu = 4
         self.partition = "nbi-medium"
 
     def output(self):
-        return LocalTarget(utils.get_ext(self.input().path)[0] + ".hd5")
+        return LocalTarget(utils.get_ext(self.input().path)[0] + self.ext)
 
     def to_str_params(self, only_significant=False):
         sup = super().to_str_params(only_significant)
@@ -268,29 +408,35 @@ class VCFtoHDF5(SlurmExecutableTask):
         return dict(list(sup.items()) + list(extras.items()))
 
     def work_script(self):
-        cache_dir = self.output().path + '.cache'
-        shutil.rmtree(cache_dir, ignore_errors=True)
-        os.makedirs(cache_dir)
+        # Virtual shards stream their regions out of the parent VCF
+        vcf, bed = vcf_shard(self.input().path)
+        if bed:
+            source = 'bcftools view -R {0} {1} | '.format(bed, vcf)
+            vcf = '-'
+        else:
+            source = ''
+
         return '''#!/bin/bash
                 {python}
-                rm {output}.temp
-                source vcftools-0.1.13
+                source bcftools-1.3.1
                 set -eo pipefail
 
-                tabix -f -p vcf {input}
-
-                vcf2npy --vcf {input} --arity 'AD:6' --array-type calldata_2d --output-dir {cache_dir}
-                vcf2npy --vcf {input} --arity 'AD:6' --exclude-field ANN --array-type variants --output-dir {cache_dir}
-
-                vcfnpy2hdf5 --vcf {input} --input-dir {cache_dir} --output {output}.temp
-
-                mv {output}.temp {output}
+                {source}python -m {module} {input} {output} --processes {n_cpu}
                 '''.format(python=utils.python,
-                           input=self.input().path,
-                           cache_dir=cache_dir,
+                           source=source,
+                           module=self.module,
+                           input=vcf,
+                           n_cpu=self.n_cpu,
                            output=self.output().path)
 
 
+class VCFtoStore(VCFtoHDF5):
+    '''Converts the text vcf files into chunked stores, a directory per callset,
+       see :mod:`fieldpathogenomics.chunkstore`'''
+    ext = '.store'
+    module = 'fieldpathogenomics.chunkstore'
+
+
 @requires(GetSNPs)
 class SnpEff(SlurmExecutableTask, CheckTargetNonEmpty):
     '''Runs SnpEff to annote variants with their predicted effect'''
@@ -349,7 +495,7 @@ class GetSyn(SlurmExecutableTask, CheckTargetNonEmpty):
                              snpsift=snpsift.format(mem=self.mem * self.n_cpu))
 
 
-@ScatterGather(ScatterVCF, GatherVCF, N_scatter)
+@ScatterGather(ScatterVCFRegions, GatherVCF, N_raw)
 @inherits(VcfToolsFilter)
 class GetINDELs(SlurmExecutableTask, CheckTargetNonEmpty):
     '''Get sites with MNPs'''
@@ -368,24 +514,26 @@ class GetINDELs(SlurmExecutableTask, CheckTargetNonEmpty):
         return LocalTarget(os.path.join(self.base_dir, VERSION, PIPELINE, self.output_prefix, self.output_prefix + "_INDELs_only.vcf.gz"))
 
     def work_script(self):
+        vcf, bed = vcf_shard(self.input().path)
         return '''#!/bin/bash
                   source jre-8u92
                   source gatk-3.6.0
                   gatk='{gatk}'
                   set -eo pipefail
 
-                  $gatk -T -T SelectVariants -V {input} -R {reference} --selectTypeToInclude MNP \
+                  $gatk -T -T SelectVariants -V {input} {intervals} -R {reference} --selectTypeToInclude MNP \
                                                                        --selectTypeToInclude MIXED \
                                                                        --out {output}.temp.vcf.gz
 
                   mv {output}.temp.vcf.gz {output}
-                  '''.format(input=self.input().path,
+                  '''.format(input=vcf,
+                             intervals='-L ' + bed if bed else '',
                              output=self.output().path,
                              reference=self.reference,
                              gatk=gatk.format(mem=self.mem * self.n_cpu))
 
 
-@ScatterGather(ScatterVCF, GatherVCF, N_scatter)
+@ScatterGather(ScatterVCFRegions, GatherVCF, N_raw)
 @inherits(VcfToolsFilter)
 class GetRefSNPs(SlurmExecutableTask, CommittedTask, CheckTargetNonEmpty):
     '''Create a VCF with SNPs and include sites that are reference like in all samples'''
@@ -404,6 +552,7 @@ class GetRefSNPs(SlurmExecutableTask, CommittedTask, CheckTargetNonEmpty):
         return CommittedTarget(os.path.join(self.base_dir, VERSION, PIPELINE, self.output_prefix, self.output_prefix + "_RefSNPs.vcf.gz"))
 
     def work_script(self):
+        vcf, bed = vcf_shard(self.input().path)
         return '''#!/bin/bash
                   source jre-8u92
                   source gatk-3.6.0
@@ -411,7 +560,7 @@ class GetRefSNPs(SlurmExecutableTask, CommittedTask, CheckTargetNonEmpty):
                   gatk='{gatk}'
                   set -eo pipefail
 
-                  $gatk -T SelectVariants -V {input} -R {reference} \
+                  $gatk -T SelectVariants -V {input} {intervals} -R {reference} \
                         --selectTypeToInclude NO_VARIATION \
                         --selectTypeToInclude SNP \
                         --out {output}.temp.vcf.gz
@@ -420,7 +569,8 @@ class GetRefSNPs(SlurmExecutableTask, CommittedTask, CheckTargetNonEmpty):
                   gzip -cd {output}.temp.vcf.gz | grep -v $'[,\t]\*' | bgzip -c > {output}.temp2.vcf.gz
 
                   mv {output}.temp2.vcf.gz {output}
-                  '''.format(input=self.input().path,
+                  '''.format(input=vcf,
+                             intervals='-L ' + bed if bed else '',
                              output=self.output().path,
                              reference=self.reference,
                              gatk=gatk.format(mem=self.mem * self.n_cpu))
@@ -430,10 +580,23 @@ class GetRefSNPs(SlurmExecutableTask, CommittedTask, CheckTargetNonEmpty):
 class HD5s(luigi.WrapperTask):
     '''Wrapper providing access to HD5 encoded variant matrices'''
     def requires(self):
-        return {'raw': self.clone(ScatterGather(ScatterVCF, GatherHD5s, N_scatter)(requires(GenotypeGVCF)(VCFtoHDF5))),
-                'syn': self.clone(ScatterGather(ScatterVCF, GatherHD5s, N_scatter)(requires(GetSyn)(VCFtoHDF5))),
-                'filtered': self.clone(ScatterGather(ScatterVCF, GatherHD5s, N_scatter)(requires(VcfToolsFilter)(VCFtoHDF5))),
-                'snps': self.clone(ScatterGather(ScatterVCF, GatherHD5s, N_scatter)(requires(GetSNPs)(VCFtoHDF5)))}
+        return {'raw': self.clone(ScatterGather(ScatterVCFRegions, GatherHD5s, N_raw)(requires(GenotypeGVCF)(VCFtoHDF5))),
+                'syn': self.clone(ScatterGather(ScatterVCFRegions, GatherHD5s, N_snps)(requires(GetSyn)(VCFtoHDF5))),
+                'filtered': self.clone(ScatterGather(ScatterVCFRegions, GatherHD5s, N_raw)(requires(VcfToolsFilter)(VCFtoHDF5))),
+                'snps': self.clone(ScatterGather(ScatterVCFRegions, GatherHD5s, N_snps)(requires(GetSNPs)(VCFtoHDF5)))}
+
+    def output(self):
+        return self.input()
+
+
+@inherits(HD5s)
+class Stores(luigi.WrapperTask):
+    '''Wrapper providing access to the variant matrices as chunked stores, like HD5s'''
+    def requires(self):
+        return {'raw': self.clone(ScatterGather(ScatterVCFRegions, GatherStores, N_raw)(requires(GenotypeGVCF)(VCFtoStore))),
+                'syn': self.clone(ScatterGather(ScatterVCFRegions, GatherStores, N_snps)(requires(GetSyn)(VCFtoStore))),
+                'filtered': self.clone(ScatterGather(ScatterVCFRegions, GatherStores, N_raw)(requires(VcfToolsFilter)(VCFtoStore))),
+                'snps': self.clone(ScatterGather(ScatterVCFRegions, GatherStores, N_snps)(requires(GetSNPs)(VCFtoStore)))}
 
     def output(self):
         return self.input()
@@ -492,9 +655,13 @@ class QCNotebooks(luigi.WrapperTask):
 # ----------------------------------------------------------------------- #
 
 
-@requires(QCNotebooks, GetSyn, GetRefSNPs, GetINDELs, HD5s)
+@inherits(QCNotebooks, GetSyn, GetRefSNPs, GetINDELs, HD5s)
 class CallsetWrapper(luigi.WrapperTask):
-    pass
+    def requires(self):
+        reqs = [self.clone(x) for x in (QCNotebooks, GetSyn, GetRefSNPs, GetINDELs, HD5s)]
+        if ScatterConfig().chunk_store:
+            reqs.append(self.clone(Stores))
+        return reqs
 
 
 @requires(CallsetWrapper)
@@ -503,16 +670,20 @@ class CleanUpCallset(luigi.Task):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         base = os.path.join(self.base_dir, VERSION, PIPELINE, self.output_prefix, self.output_prefix)
-        self.to_rm_glob = ([base + '_filtered_' + str(i) + '*' for i in range(N_scatter)] +
-                           [base + '_INDELs_only_' + str(i) + '*' for i in range(N_scatter)] +
-                           [base + '_raw_' + str(i) + '*' for i in range(N_scatter)] +
-                           [base + '_SNPs_' + str(i) + '*' for i in range(N_scatter)] +
-                           [base + '_RefSNPs_' + str(i) + '*' for i in range(N_scatter)] +
-                           [base + '_SNPs_syn_' + str(i) + '*' for i in range(N_scatter)] +
-                           [base + "*temp*"])
+        # Shards are numbered _0, _1, ... and each stage has its own scatter width
+        self.to_rm_glob = [base + '_filtered_[0-9]*',
+                           base + '_INDELs_only_[0-9]*',
+                           base + '_raw_[0-9]*',
+                           base + '_SNPs_[0-9]*',
+                           base + '_RefSNPs_[0-9]*',
+                           base + '_SNPs_syn_[0-9]*',
+                           base + "*temp*"]
         self.unglob = []
         for x in self.to_rm_glob:
             self.unglob += glob(x)
+        if ScatterConfig().hd5_gather == 'virtual':
+            # The gathered HDF5s are Virtual Datasets over the shards
+            self.unglob = [x for x in self.unglob if not x.endswith('.hd5')]
 
     def run(self):
         for x in self.unglob:
@@ -546,4 +717,4 @@ if __name__ == '__main__':
                                  '--lib-list', json.dumps(lib_list),
                                  '--star-genome', os.path.join(utils.reference_dir, 'genome'),
                                  '--reference', os.path.join(utils.reference_dir, 'PST130_contigs.fasta'),
-                                 '--mask', os.path.join(utils.reference_dir, 'PST130_RNASeq_collapsed_exons.bed')] + sys.argv[3:])
+                                 '--mask', MASK] + sys.argv[3:])
@@ -12,16 +12,22 @@ from luigi import LocalTarget
 from bioluigi.slurm import SlurmExecutableTask, SlurmTask
 from bioluigi.utils import CheckTargetNonEmpty
 from bioluigi.decorators import requires, inherits
+from bioluigi.scattergather import ScatterGather
 
 import fieldpathogenomics
 from fieldpathogenomics.utils import picard, gatk, trimmomatic
 from fieldpathogenomics.luigi.commit import CommittedTarget, CommittedTask
+from fieldpathogenomics.luigi.local import LocalTask
+from fieldpathogenomics.luigi.arrays import ArrayTask
+from fieldpathogenomics.luigi.passthrough import PassThroughTask
+from fieldpathogenomics.compression import task_codec
+from fieldpathogenomics.SGUtils import ScatterBED, GatherGVCF, ScatterConfig
 import fieldpathogenomics.utils as utils
 
-FILE_HASH = utils.file_hash(__file__)
 PIPELINE = os.path.basename(__file__).split('.')[0]
 VERSION = fieldpathogenomics.__version__.rsplit('.', 1)[0]
 
+
 '''
 
 TODO: Migrate making the STAR reference to luigi and correctly set the genome column in AlginmentStats
@@ -37,8 +43,11 @@ Notes
 job.mem is actually mem_per_cpu
 '''
 
+# Regions variants are called in when HaplotypeCaller is scattered over ScatterConfig().hc_shards shards of it
+MASK = os.path.join(utils.reference_dir, 'PST130_RNASeq_collapsed_exons.bed')
+
 
-class FetchFastqGZ(CheckTargetNonEmpty, SlurmExecutableTask):
+class FetchFastqGZ(ArrayTask, CheckTargetNonEmpty, SlurmExecutableTask):
     '''Fetches and concatenate the fastq.gz files for ``library`` from the /reads/ server
      :param str library: library name  '''
 
@@ -74,7 +83,7 @@ class FetchFastqGZ(CheckTargetNonEmpty, SlurmExecutableTask):
 
 
 @requires(FetchFastqGZ)
-class Trimmomatic(CheckTargetNonEmpty, SlurmExecutableTask):
+class Trimmomatic(ArrayTask, CheckTargetNonEmpty, SlurmExecutableTask):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -118,7 +127,10 @@ class Trimmomatic(CheckTargetNonEmpty, SlurmExecutableTask):
 
 @requires(FetchFastqGZ)
 class FastxQC(SlurmExecutableTask):
-    '''Runs Fastx toolkit to plot the nucleotide and base call quality score distributions '''
+    '''Plots the nucleotide and base call quality score distributions. The per cycle statistics are
+       computed in a single pass over both mates by :mod:`fieldpathogenomics.scripts.fastq_stats`, which writes
+       the fastx_quality_stats format used by the Fastx toolkit plotting scripts.
+       The decompression codec can be set with [FastxQC] codec= in the luigi config'''
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -140,10 +152,10 @@ class FastxQC(SlurmExecutableTask):
     def work_script(self):
         return '''#!/bin/bash
         source fastx_toolkit-0.0.13.2
+        {python}
         set -euo pipefail
 
-        gzip -cd {R1_in} | fastx_quality_stats -o {stats_R1} -Q33
-        gzip -cd {R2_in} | fastx_quality_stats -o {stats_R2} -Q33
+        python -m fieldpathogenomics.scripts.fastq_stats {R1_in} {R2_in} {stats_R1} {stats_R2} --codec {codec}
 
         fastq_quality_boxplot_graph.sh -i {stats_R1} -o {boxplot_R1}
         fastq_quality_boxplot_graph.sh -i {stats_R2} -o {boxplot_R2}
@@ -151,7 +163,9 @@ class FastxQC(SlurmExecutableTask):
         fastx_nucleotide_distribution_graph.sh -i {stats_R1} -o {nt_dist_R1}
         fastx_nucleotide_distribution_graph.sh -i {stats_R2} -o {nt_dist_R2}
 
-        '''.format(R1_in=self.input()[0].path,
+        '''.format(python=utils.python,
+                   codec=task_codec(self).name,
+                   R1_in=self.input()[0].path,
                    R2_in=self.input()[1].path,
                    stats_R1=self.output()['stats_R1'].path,
                    stats_R2=self.output()['stats_R2'].path,
@@ -162,8 +176,9 @@ class FastxQC(SlurmExecutableTask):
 
 
 @requires(Trimmomatic)
-class Star(CheckTargetNonEmpty, SlurmExecutableTask):
-    '''Runs STAR to align to the reference :param str star_genome:'''
+class Star(ArrayTask, CheckTargetNonEmpty, SlurmExecutableTask):
+    '''Runs STAR to align to the reference :param str star_genome:
+       The codec used to decompress the reads can be set with [Star] codec= in the luigi config'''
     star_genome = luigi.Parameter()
 
     def __init__(self, *args, **kwargs):
@@ -191,7 +206,7 @@ class Star(CheckTargetNonEmpty, SlurmExecutableTask):
                         --outSAMstrandField intronMotif \
                         --outSAMtype BAM SortedByCoordinate \
                         --runThreadN {n_cpu} \
-                        --readFilesCommand gunzip -c \
+                        --readFilesCommand {decompress} \
                         --readFilesIn {R1} {R2}
 
                   mv {scratch_dir}/star_temp/Log.final.out {star_log}
@@ -202,6 +217,7 @@ class Star(CheckTargetNonEmpty, SlurmExecutableTask):
                              scratch_dir=os.path.join(self.scratch_dir, VERSION, PIPELINE, self.library),
                              star_genome=self.star_genome,
                              n_cpu=self.n_cpu,
+                             decompress=task_codec(self).decompress_cmd(),
                              R1=self.input()[0].path,
                              R2=self.input()[1].path,)
 
@@ -291,8 +307,14 @@ class AlignmentStats(sqla.CopyToTable):
 
 
 @requires(Star)
-class CleanSam(CheckTargetNonEmpty, SlurmExecutableTask):
-    '''Cleans the provided SAM/BAM, soft-clipping beyond-end-of-reference alignments and setting MAPQ to 0 for unmapped reads'''
+class CleanSam(PassThroughTask, LocalTask, ArrayTask, CheckTargetNonEmpty, SlurmExecutableTask):
+    '''Cleans the provided SAM/BAM, soft-clipping beyond-end-of-reference alignments and setting MAPQ to 0 for unmapped reads.
+
+       With :param bool fuse_bam: this and AddReadGroups pass the Star BAM straight through and MarkDuplicates
+       runs CleanSam, AddReadGroups, MarkDuplicates and SplitNCigarReads in a single job'''
+    expected_runtime = 300
+    fuse_bam = luigi.BoolParameter(default=False)
+    reference = luigi.Parameter()
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -302,7 +324,13 @@ class CleanSam(CheckTargetNonEmpty, SlurmExecutableTask):
         self.partition = "nbi-short"
 
     def output(self):
-        return LocalTarget(os.path.join(self.scratch_dir, VERSION, PIPELINE, self.library, 'Aligned.out_cleaned.bam'))
+        if self.fuse_bam:
+            return self.input()['star_bam']
+        else:
+            return LocalTarget(os.path.join(self.scratch_dir, VERSION, PIPELINE, self.library, 'Aligned.out_cleaned.bam'))
+
+    def passes_through(self):
+        return self.fuse_bam
 
     def work_script(self):
         return '''#!/bin/bash
@@ -320,7 +348,7 @@ class CleanSam(CheckTargetNonEmpty, SlurmExecutableTask):
 
 
 @requires(CleanSam)
-class AddReadGroups(CheckTargetNonEmpty, SlurmExecutableTask):
+class AddReadGroups(PassThroughTask, ArrayTask, CheckTargetNonEmpty, SlurmExecutableTask):
     '''Sets the read group to the sample name, required for GATK'''
 
     def __init__(self, *args, **kwargs):
@@ -331,7 +359,13 @@ class AddReadGroups(CheckTargetNonEmpty, SlurmExecutableTask):
         self.partition = "nbi-short"
 
     def output(self):
-        return LocalTarget(os.path.join(self.scratch_dir, VERSION, PIPELINE, self.library, 'rg_added_sorted.bam'))
+        if self.fuse_bam:
+            return self.input()
+        else:
+            return LocalTarget(os.path.join(self.scratch_dir, VERSION, PIPELINE, self.library, 'rg_added_sorted.bam'))
+
+    def passes_through(self):
+        return self.fuse_bam
 
     def work_script(self):
         return '''#!/bin/bash
@@ -349,9 +383,26 @@ class AddReadGroups(CheckTargetNonEmpty, SlurmExecutableTask):
                            picard=picard.format(mem=self.mem * self.n_cpu))
 
 
+def fused_split(task):
+    '''Where the fused MarkDuplicates job writes its split BAM for SplitNCigarReads'''
+    return os.path.join(task.scratch_dir, VERSION, PIPELINE, task.library, 'fused_split.bam')
+
+
+def fuses_split(task):
+    '''True if the fused MarkDuplicates job should also run SplitNCigarReads, only when
+       Portcullis and BQSR pass the BAM through so SplitNCigarReads can use its split BAM'''
+    return task.fuse_bam and task.portcullis_junc == '' and task.snp_db == ''
+
+
 @requires(AddReadGroups)
-class MarkDuplicates(CheckTargetNonEmpty, CommittedTask, SlurmExecutableTask):
-    '''Marks optical/PCR duplicates'''
+class MarkDuplicates(ArrayTask, CheckTargetNonEmpty, CommittedTask, SlurmExecutableTask):
+    '''Marks optical/PCR duplicates.
+
+       With fuse_bam this also does the CleanSam and AddReadGroups steps, streaming uncompressed
+       BAM between them, and SplitNCigarReads if nothing changes the BAM before it, see :meth:`fused_script`'''
+    # Set by the tasks downstream, only so the fused job knows whether to split, see :func:`fuses_split`
+    portcullis_junc = luigi.Parameter(default='', significant=False)
+    snp_db = luigi.Parameter(default='', significant=False)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -364,6 +415,8 @@ class MarkDuplicates(CheckTargetNonEmpty, CommittedTask, SlurmExecutableTask):
         return CommittedTarget(os.path.join(self.base_dir, VERSION, PIPELINE, self.library, self.library + '.bam'))
 
     def work_script(self):
+        if self.fuse_bam:
+            return self.fused_script()
         return '''#!/bin/bash
                source jre-8u92
                source picardtools-2.1.1
@@ -377,9 +430,62 @@ class MarkDuplicates(CheckTargetNonEmpty, CommittedTask, SlurmExecutableTask):
                            output=self.output().path,
                            picard=picard.format(mem=self.mem * self.n_cpu))
 
+    def fused_script(self):
+        '''CleanSam | AddOrReplaceReadGroups -> MarkDuplicates [-> SplitNCigarReads] in one job.
+           MarkDuplicates reads its input twice so can't take a pipe, its input is written with light compression
+           and removed once it's done. The read group and duplicate marked BAMs are checkpoints, a failed job
+           restarts after the last one written. When :func:`fuses_split` the committed BAM is moved into place last,
+           once the split BAM that SplitNCigarReads picks up, see :func:`fused_split`, is done'''
+        library_dir = os.path.join(self.scratch_dir, VERSION, PIPELINE, self.library)
+        if fuses_split(self):
+            split = '''$gatk -T SplitNCigarReads --logging_level ERROR -R {reference} -I $marked.bam -o {split}.temp -rf ReassignOneMappingQuality -RMQF 255 -RMQT 60 -U ALLOW_N_CIGAR_READS
+               mv {split}.temp.bai {split}.bai
+               mv {split}.temp {split}'''.format(reference=self.reference, split=fused_split(self))
+        else:
+            split = ''
+        return '''#!/bin/bash
+               source jre-8u92
+               source picardtools-2.1.1
+               source gatk-3.6.0
+               clean='{clean}'
+               picard='{picard}'
+               gatk='{gatk}'
+               set -euo pipefail
+
+               sorted={sorted}
+               marked={marked}
+
+               if [ ! -e $marked.bam ] && [ ! -e $sorted ]; then
+                   $clean CleanSam VERBOSITY=ERROR QUIET=true I={input} O=/dev/stdout COMPRESSION_LEVEL=0 | \
+                   $picard AddOrReplaceReadGroups VERBOSITY=ERROR QUIET=true I=/dev/stdin O=$sorted.temp COMPRESSION_LEVEL=1 SO=coordinate RGID=Star RGLB={lib} RGPL=Ilumina RGPU=Ilumina RGSM={lib}
+                   mv $sorted.temp $sorted
+               fi
+
+               if [ ! -e $marked.bam ]; then
+                   $picard MarkDuplicates VERBOSITY=ERROR QUIET=true I=$sorted O=$marked.temp.bam CREATE_INDEX=true VALIDATION_STRINGENCY=SILENT M=/dev/null
+                   mv $marked.temp.bai $marked.bai
+                   mv $marked.temp.bam $marked.bam
+               fi
+               rm -f $sorted
+
+               {split}
+
+               mv $marked.bai {index}
+               mv $marked.bam {output}
+                '''.format(input=self.input().path,
+                           output=self.output().path,
+                           index=os.path.splitext(self.output().path)[0] + '.bai',
+                           sorted=os.path.join(library_dir, 'rg_added_sorted.bam'),
+                           marked=os.path.join(library_dir, 'marked'),
+                           split=split,
+                           lib=self.library,
+                           clean=picard.format(mem=1500),
+                           picard=picard.format(mem=self.mem * self.n_cpu - 1500),
+                           gatk=gatk.format(mem=self.mem * self.n_cpu))
+
 
 @requires(MarkDuplicates)
-class PortcullisFilterBam(SlurmExecutableTask):
+class PortcullisFilterBam(PassThroughTask, SlurmExecutableTask):
     '''Removes reads correspoding to incorrect splice junctions'''
 
     portcullis_junc = luigi.Parameter(default='')
@@ -397,21 +503,8 @@ class PortcullisFilterBam(SlurmExecutableTask):
         else:
             return LocalTarget(os.path.join(self.base_dir, VERSION, PIPELINE, self.library, 'portcullis.bam'))
 
-    def on_success(self):
-        if self.portcullis_junc == '':
-            luigi.Task.on_success(self)
-        else:
-            SlurmExecutableTask.on_success(self)
-
-    def on_failure(self, e):
-        if self.portcullis_junc == '':
-            luigi.Task.on_failure(self, e)
-        else:
-            SlurmExecutableTask.on_failure(self, e)
-
-    def run(self):
-        if self.portcullis_junc != '':
-            super().run()
+    def passes_through(self):
+        return self.portcullis_junc == ''
 
     def work_script(self):
         return '''#!/bin/bash
@@ -426,12 +519,12 @@ class PortcullisFilterBam(SlurmExecutableTask):
 
 
 @requires(PortcullisFilterBam)
-class BaseQualityScoreRecalibration(SlurmExecutableTask):
+class BaseQualityScoreRecalibration(PassThroughTask, SlurmExecutableTask):
     '''Runs BQSR. Because this requires a set of high quality SNPs to use
     as a ground truth we bootstrap this by first running the pipeline without
     BQSR then running again using the best SNPs of the first run.
 
-    This is achieved by conditionally overriding run() on whether a snp_db is given
+    This is achieved by passing the BAM through unless a snp_db is given
     '''
     snp_db = luigi.Parameter(default='')
 
@@ -448,21 +541,8 @@ class BaseQualityScoreRecalibration(SlurmExecutableTask):
         else:
             return LocalTarget(os.path.join(self.base_dir, VERSION, PIPELINE, self.library, 'recalibrated.bam'))
 
-    def on_success(self):
-        if self.snp_db == '':
-            luigi.Task.on_success(self)
-        else:
-            SlurmExecutableTask.on_success(self)
-
-    def on_failure(self, e):
-        if self.snp_db == '':
-            luigi.Task.on_failure(self, e)
-        else:
-            SlurmExecutableTask.on_failure(self, e)
-
-    def run(self):
-        if self.snp_db != '':
-            super().run()
+    def passes_through(self):
+        return self.snp_db == ''
 
     def work_script(self):
         recal = os.path.join(self.base_dir, VERSION, PIPELINE, self.library, self.library + "_recal.tsv")
@@ -484,9 +564,9 @@ class BaseQualityScoreRecalibration(SlurmExecutableTask):
 
 
 @requires(BaseQualityScoreRecalibration)
-class SplitNCigarReads(CheckTargetNonEmpty, SlurmExecutableTask):
-    '''Required by GATK, breaks up reads spanning introns'''
-    reference = luigi.Parameter()
+class SplitNCigarReads(PassThroughTask, ArrayTask, CheckTargetNonEmpty, SlurmExecutableTask):
+    '''Required by GATK, breaks up reads spanning introns. Uses the split BAM from the fused
+       MarkDuplicates job when there is one, see :func:`fuses_split`'''
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -498,6 +578,21 @@ class SplitNCigarReads(CheckTargetNonEmpty, SlurmExecutableTask):
     def output(self):
         return LocalTarget(os.path.join(self.scratch_dir, VERSION, PIPELINE, self.library, 'split.bam'))
 
+    def passes_through(self):
+        return fuses_split(self) and os.path.exists(fused_split(self))
+
+    def pass_through(self):
+        os.rename(fused_split(self) + '.bai', self.output().path + '.bai')
+        os.rename(fused_split(self), self.output().path)
+
+    def run(self):
+        if not self.passed_through():
+            # Left by an earlier fused run, before Portcullis or BQSR were turned on
+            for path in (fused_split(self), fused_split(self) + '.bai'):
+                if os.path.exists(path):
+                    os.remove(path)
+        super().run()
+
     def work_script(self):
         return '''#!/bin/bash
                source jre-8u92
@@ -518,9 +613,77 @@ class SplitNCigarReads(CheckTargetNonEmpty, SlurmExecutableTask):
                            reference=self.reference)
 
 
-@requires(SplitNCigarReads)
-class HaplotypeCaller(CheckTargetNonEmpty, CommittedTask, SlurmExecutableTask):
-    '''Per sample SNP calling'''
+class CallingMask(luigi.ExternalTask):
+    '''BED of the regions HaplotypeCaller calls variants in when it is scattered'''
+    mask = luigi.Parameter(default=MASK)
+
+    def output(self):
+        return LocalTarget(self.mask)
+
+
+@inherits(SplitNCigarReads, CallingMask)
+class HaplotypeCallerShards(ArrayTask, CheckTargetNonEmpty, SlurmExecutableTask):
+    '''HaplotypeCaller over one shard of the CallingMask, each shard is called in parallel
+       and the gVCFs merged back into one, see :func:`scattered_haplotypecaller`'''
+
+    def requires(self):
+        return [self.clone(CallingMask), self.clone(SplitNCigarReads)]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Set the SLURM request params for this task
+        self.mem = 6000
+        self.n_cpu = 1
+        self.partition = "nbi-medium"
+        self.sbatch_args = '--constraint=intel'
+
+    def output(self):
+        return LocalTarget(os.path.join(self.scratch_dir, VERSION, PIPELINE, self.library, 'haplotypecaller.g.vcf'))
+
+    def work_script(self):
+        return '''#!/bin/bash
+                source jre-8u92
+                gatk='{gatk}'
+                set -euo pipefail
+
+                $gatk -T HaplotypeCaller  \
+                      -R {reference} \
+                      -I {input} \
+                      -L {intervals} \
+                      -dontUseSoftClippedBases\
+                      --emitRefConfidence GVCF \
+                      -o {output}.temp.g.vcf
+
+                mv {output}.temp.g.vcf {output}
+        '''.format(input=self.input()[1].path,
+                   intervals=self.input()[0].path,
+                   output=self.output().path,
+                   gatk=gatk.format(mem=self.mem * self.n_cpu),
+                   reference=self.reference)
+
+
+# ScatterGather'd HaplotypeCallerShards by width, made once the config has been read
+_scattered_hc = {}
+
+
+def scattered_haplotypecaller(n):
+    '''HaplotypeCallerShards scattered over ``n`` shards of the CallingMask'''
+    if n not in _scattered_hc:
+        _scattered_hc[n] = ScatterGather(ScatterBED, GatherGVCF, n)(HaplotypeCallerShards)
+    return _scattered_hc[n]
+
+
+@inherits(SplitNCigarReads)
+class HaplotypeCaller(PassThroughTask, ArrayTask, CheckTargetNonEmpty, CommittedTask, SlurmExecutableTask):
+    '''Per sample SNP calling. When ScatterConfig().hc_shards is more than 1 the calling is done
+       by HaplotypeCallerShards, over just the CallingMask, and the gathered gVCF is moved into place here'''
+
+    def requires(self):
+        n = ScatterConfig().hc_shards
+        if n > 1:
+            return self.clone(scattered_haplotypecaller(n))
+        else:
+            return self.clone(SplitNCigarReads)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -533,6 +696,24 @@ class HaplotypeCaller(CheckTargetNonEmpty, CommittedTask, SlurmExecutableTask):
     def output(self):
         return CommittedTarget(os.path.join(self.base_dir, VERSION, PIPELINE, self.library, self.library + ".g.vcf"))
 
+    def passes_through(self):
+        return ScatterConfig().hc_shards > 1
+
+    def pass_through(self):
+        # The index GATK would make for the gathered gVCF, or a stale one for an earlier gVCF
+        index = self.output().path + '.idx'
+        if os.path.exists(self.input().path + '.idx'):
+            shutil.move(self.input().path + '.idx', index)
+        elif os.path.exists(index):
+            os.remove(index)
+        # Copy across filesystems to a temp file first so the output appears atomically
+        shutil.move(self.input().path, self.output().path + '.temp')
+        os.rename(self.output().path + '.temp', self.output().path)
+
+    def on_success(self):
+        # Commit the gVCF whether it was called here or gathered from the shards
+        CommittedTask.on_success(self)
+
     def work_script(self):
         return '''#!/bin/bash
                 source jre-8u92
@@ -554,8 +735,9 @@ class HaplotypeCaller(CheckTargetNonEmpty, CommittedTask, SlurmExecutableTask):
 
 
 @requires(HaplotypeCaller)
-class PlotAlleleFreq(SlurmTask):
+class PlotAlleleFreq(LocalTask, SlurmTask):
     '''Make plots of the ranked allele frequencies to identify mixed isolates'''
+    expected_runtime = 60
 
     DP_thresh = luigi.IntParameter(default=10)
 
@@ -4,26 +4,26 @@ import json
 import multiprocessing_on_dill as multiprocessing
 
 import fieldpathogenomics
-from fieldpathogenomics.pipelines.Callset import HD5s
+from fieldpathogenomics.pipelines.Callset import HD5s, Stores
+from fieldpathogenomics.SGUtils import ScatterConfig
 import fieldpathogenomics.utils as utils
 
 from bioluigi.slurm import SlurmExecutableTask, SlurmTask
 from bioluigi.utils import CheckTargetNonEmpty
-from bioluigi.decorators import requires
+from bioluigi.decorators import requires, inherits
 
 import luigi
 from luigi import LocalTarget
 
-FILE_HASH = utils.file_hash(__file__)
 PIPELINE = os.path.basename(__file__).split('.')[0]
 VERSION = fieldpathogenomics.__version__.rsplit('.', 1)[0]
 
 
-@requires(HD5s)
+@inherits(HD5s)
 class PrepStructureInput(SlurmTask, CheckTargetNonEmpty):
-    '''Takes the HD5 file containing high quality biallelic synonymous
-       sites generated by fielpathogenomics.Callset.GetSyn and converts
-       it into a matrix of integer encoded pseudohaplotypes for structure.
+    '''Takes the HD5 file (the chunked store with ScatterConfig().chunk_store) containing
+       high quality biallelic synonymous sites generated by fielpathogenomics.Callset.GetSyn
+       and converts it into a matrix of integer encoded pseudohaplotypes for structure.
 
        Also calculates linkage between sites and selects sites that have r^2 < max_linkage
        '''
@@ -37,6 +37,9 @@ class PrepStructureInput(SlurmTask, CheckTargetNonEmpty):
         self.n_cpu = 1
         self.partition = "nbi-short"
 
+    def requires(self):
+        return self.clone(Stores if ScatterConfig().chunk_store else HD5s)
+
     def output(self):
         return LocalTarget(os.path.join(self.base_dir, VERSION, PIPELINE, self.output_prefix, self.output_prefix + ".str"))
 
@@ -44,12 +47,12 @@ class PrepStructureInput(SlurmTask, CheckTargetNonEmpty):
 
         import numpy as np
         import allel
-        import h5py
         import pandas as pd
         from luigi.file import atomic_file
+        from fieldpathogenomics.chunkstore import open_callset
 
         # Opens the SynSNPS file, which contains only biallelic synonymous sites
-        callset = h5py.File(self.input()['syn'].path, mode='r')
+        callset = open_callset(self.input()['syn'].path)
         genotypes = allel.GenotypeChunkedArray(callset['calldata']['genotype'])
         samples = np.array([x.decode() for x in callset['samples']])
 
@@ -13,12 +13,13 @@ from bioluigi.decorators import requires, inherits
 
 import fieldpathogenomics
 import fieldpathogenomics.utils as utils
+from fieldpathogenomics.luigi.local import LocalTask
 import fieldpathogenomics.pipelines.Library as Library
 
-FILE_HASH = utils.file_hash(__file__)
 PIPELINE = os.path.basename(__file__).split('.')[0]
 VERSION = fieldpathogenomics.__version__.rsplit('.', 1)[0]
 
+
 # -----------------------------StringTie------------------------------- #
 
 
@@ -165,10 +166,11 @@ class CuffMerge(SlurmExecutableTask, CheckTargetNonEmpty):
 
 
 @requires(CuffMerge)
-class AddTranscripts(SlurmTask):
+class AddTranscripts(LocalTask, SlurmTask):
     '''The gtf file produced by cuffmerge has no transcript features, not sure why??!
         This task reconstructs the transcript features use the transcript_id tag of the exons
         and taking the start/stop of the first/last exons with a given transcript_id is the start/stop '''
+    expected_runtime = 60
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
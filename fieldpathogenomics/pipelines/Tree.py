@@ -6,6 +6,7 @@ import multiprocessing_on_dill as multiprocessing
 import fieldpathogenomics
 from fieldpathogenomics.pipelines.Callset import GetRefSNPs
 import fieldpathogenomics.utils as utils
+from fieldpathogenomics.luigi.local import LocalTask
 
 from bioluigi.slurm import SlurmExecutableTask, SlurmTask
 from bioluigi.utils import CheckTargetNonEmpty
@@ -15,7 +16,6 @@ from bioluigi.decorators import requires, inherits
 import luigi
 from luigi import LocalTarget
 
-FILE_HASH = utils.file_hash(__file__)
 PIPELINE = os.path.basename(__file__).split('.')[0]
 VERSION = fieldpathogenomics.__version__.rsplit('.', 1)[0]
 
@@ -167,7 +167,8 @@ class GetConsensusesWrapper(luigi.Task):
 
 
 @requires(GetConsensusesWrapper)
-class GetAlignment(SlurmTask):
+class GetAlignment(LocalTask, SlurmTask):
+    expected_runtime = 60
     min_cov = luigi.FloatParameter(default=0.8)
     min_indvs = luigi.FloatParameter(default=0.8)
 
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import glob
+import argparse
+import tempfile
+
+from fieldpathogenomics.compression import CODECS, open_compressed
+
+test_data = os.path.join(os.path.split(__file__)[0], '..', '..', 'tests', 'data')
+
+
+def benchmark(codec, data, repeats):
+    '''Time compressing ``data`` in memory and round tripping it through a file with ``codec``.
+       Returns compress MB/s, decompress MB/s and the compression ratio'''
+    MB = len(data) * repeats / 2**20
+
+    start = time.time()
+    for i in range(repeats):
+        compressed = codec.compress(data)
+    compress_rate = MB / (time.time() - start)
+
+    with tempfile.NamedTemporaryFile(suffix=codec.ext) as tmp:
+        with codec.open(tmp.name, 'wb') as f:
+            for i in range(repeats):
+                f.write(data)
+
+        start = time.time()
+        with codec.open(tmp.name, 'rb') as f:
+            while f.read(2**22):
+                pass
+        decompress_rate = MB / (time.time() - start)
+
+    return compress_rate, decompress_rate, len(data) / len(compressed)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Report MB/s for each available compression codec")
+    parser.add_argument('files', nargs='*', default=glob.glob(os.path.join(test_data, '*.fastq.gz')))
+    parser.add_argument('--repeats', type=int, default=100,
+                        help="Number of times to process the input, the test data is small")
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--level', type=int, default=6)
+    args = parser.parse_args()
+
+    data = b''
+    for path in args.files:
+        with open_compressed(path) as f:
+            data += f.read()
+    if not data:
+        sys.exit("No input data")
+
+    print("Uncompressed input: {0:.2f} MB x {1}".format(len(data) / 2**20, args.repeats))
+    print("{0:<8}{1:>16}{2:>18}{3:>8}".format("Codec", "Compress MB/s", "Decompress MB/s", "Ratio"))
+    for name, cls in CODECS.items():
+        codec = cls(threads=args.threads, level=args.level)
+        if not codec.available():
+            print("{0:<8}{1:>16}".format(name, "not installed"))
+            continue
+        compress_rate, decompress_rate, ratio = benchmark(codec, data, args.repeats)
+        print("{0:<8}{1:>16.1f}{2:>18.1f}{3:>8.2f}".format(name, compress_rate, decompress_rate, ratio))
@@ -1,99 +1,364 @@
 #!/usr/bin/env python
 
-import gzip
+import os
+import time
 import argparse
 import io
+import itertools
+import collections
+import contextlib
+import multiprocessing
 
+import numpy as np
 
-class no_Ns():
-    '''Filter any read that contains an N'''
+from fieldpathogenomics.compression import Codec, get_codec, open_compressed
+
+# Number of read pairs read and filtered at a time
+BATCH_SIZE = 2**15
+
+
+class ReadBlock():
+    '''A block of reads held as NumPy arrays, the unit that batch filters act on.
+
+    :param seqs: list of sequence lines (bytes, including the newline)
+    :param quals: list of quality lines (bytes, including the newline)
+
+    ``seq`` and ``qual`` are 2D uint8 arrays of shape (n_reads, max_line_length) padded with 0,
+    ``lengths`` is the read length excluding the newline.
+    '''
+
+    def __init__(self, seqs, quals, lengths=None):
+        self.seq = seqs if isinstance(seqs, np.ndarray) else _to_array(seqs)
+        self.qual = quals if isinstance(quals, np.ndarray) else _to_array(quals)
+        if lengths is None:
+            lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs)) - 1
+        self.lengths = lengths
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def take(self, idx):
+        return ReadBlock(self.seq[idx], self.qual[idx], self.lengths[idx])
+
+
+def _to_array(lines):
+    arr = np.array(lines, dtype=bytes)
+    return arr.view(np.uint8).reshape(len(lines), arr.dtype.itemsize)
+
+
+class BatchFilter():
+    '''Base class for filters that act on a block of read pairs at once.
+       Subclasses implement ``mask(r1, r2)``, which takes the R1 and R2 :class:`ReadBlock`
+       and returns a boolean array that is True for the pairs that pass.
+       Failures are counted by :func:`apply_filters`.'''
+
+    name = ''
 
     def __init__(self):
         self.failures = 0
 
-    def __call__(self, r1, r2):
-        predicate = not (('N' in r1) or ('N' in r2))
-        if not predicate:
-            self.failures += 1
-        return predicate
+    def mask(self, r1, r2):
+        raise NotImplementedError
 
     def __str__(self):
-        return "No N's: {0}".format(self.failures)
+        return "{0}: {1}".format(self.name, self.failures)
+
+
+class no_Ns(BatchFilter):
+    '''Filter any read that contains an N'''
+
+    name = "No N's"
+
+    def mask(self, r1, r2):
+        return ~((r1.seq == ord('N')).any(axis=1) | (r2.seq == ord('N')).any(axis=1))
 
 
-class exact_length():
+class exact_length(BatchFilter):
     '''Filter any read that does not have length ``L``
     :param L: Read filter length
     '''
 
+    name = "Exact length"
+
     def __init__(self, L=101):
-        self.L = L + 1  # Add 1 to count the newline
-        self.failures = 0
+        super().__init__()
+        self.L = L
 
-    def __call__(self, r1, r2):
-        predicate = (len(r1) == self.L) and (len(r2) == self.L)
-        if not predicate:
-            self.failures += 1
-        return predicate
+    def mask(self, r1, r2):
+        return (r1.lengths == self.L) & (r2.lengths == self.L)
 
-    def __str__(self):
-        return "Exact length: {0}".format(self.failures)
+
+class mean_quality(BatchFilter):
+    '''Filter any read with mean base quality below ``Q``
+    :param Q: Minimum mean Phred quality
+    :param offset: Quality score encoding offset
+    '''
+
+    name = "Mean quality"
+
+    def __init__(self, Q=20, offset=33):
+        super().__init__()
+        self.Q = Q
+        self.offset = offset
+
+    def mean(self, block):
+        # Row sums include the newline, the padding is 0
+        total = block.qual.sum(axis=1, dtype=np.int64) - ord('\n') - self.offset * block.lengths
+        return total / np.maximum(block.lengths, 1)
+
+    def mask(self, r1, r2):
+        return (self.mean(r1) >= self.Q) & (self.mean(r2) >= self.Q)
+
+
+class homopolymer(BatchFilter):
+    '''Filter any read containing a run of ``K`` or more of the same base
+    :param K: Homopolymer run length
+    '''
+
+    name = "Homopolymer"
+
+    def __init__(self, K=20):
+        super().__init__()
+        self.K = K
+
+    def has_run(self, block):
+        # run[:, i] is True if base i + 1 repeats base i, a run of K bases is K - 1 consecutive Trues.
+        # Extend the number of consecutive Trues covered by doubling, so it takes O(log K) passes
+        run = (block.seq[:, 1:] == block.seq[:, :-1]) & (block.seq[:, 1:] >= ord('A'))
+        covered, needed = 1, self.K - 1
+        while covered < needed:
+            step = min(covered, needed - covered)
+            run = run[:, :-step] & run[:, step:]
+            covered += step
+        return run.any(axis=1)
+
+    def mask(self, r1, r2):
+        return ~(self.has_run(r1) | self.has_run(r2))
+
+
+def apply_filters(filters, r1_lines, r2_lines, qc=None):
+    '''Evaluates the filter chain over a batch of read pairs, given as the lists of lines of R1 and R2.
+       Evaluation short circuits, each filter only sees the pairs that passed all of the filters before it
+       and its failure count is the number of pairs it rejected. Returns the indices of the passing pairs.
+
+       Filters that are plain callables rather than :class:`BatchFilter` are called once per pair with the
+       decoded R1 and R2 sequence lines, and are responsible for counting their own failures.
+
+       If ``qc`` is given it is updated with the (unfiltered) batch, see :mod:`fieldpathogenomics.scripts.fastq_stats`'''
+    r1_seqs, r2_seqs = r1_lines[1::4], r2_lines[1::4]
+    r1 = ReadBlock(r1_seqs, r1_lines[3::4])
+    r2 = ReadBlock(r2_seqs, r2_lines[3::4])
+    if qc is not None:
+        qc.update(r1, r2)
+
+    keep = np.arange(len(r1))
+    for f in filters:
+        if len(keep) == 0:
+            break
+        if isinstance(f, BatchFilter):
+            passed = np.asarray(f.mask(r1.take(keep), r2.take(keep)), dtype=bool)
+            f.failures += int(len(keep) - passed.sum())
+        else:
+            passed = np.array([f(r1_seqs[i].decode(), r2_seqs[i].decode()) for i in keep], dtype=bool)
+        keep = keep[passed]
+
+    return keep
+
+
+def select_records(lines, keep):
+    '''Join the 4 line records of ``lines`` given by the indices ``keep``'''
+    return b''.join([l for i in keep for l in lines[4 * i:4 * i + 4]])
+
+
+def read_batches(r1_fh, r2_fh, size=BATCH_SIZE):
+    '''Yield the lines of up to ``size`` read pairs at a time from the binary handles ``r1_fh`` and ``r2_fh``
+       as a tuple of the R1 and R2 lists of lines'''
+    while True:
+        r1_lines = list(itertools.islice(r1_fh, 4 * size))
+        r2_lines = list(itertools.islice(r2_fh, 4 * size))
+        if not r1_lines and not r2_lines:
+            return
+
+        if len(r1_lines) != len(r2_lines) or len(r1_lines) % 4 != 0:
+            raise Exception("R1 and R2 have different numbers of records or a truncated record!!")
+        if any(h[:1] != b'@' for h in r1_lines[0::4]) or any(h[:1] != b'@' for h in r2_lines[0::4]):
+            raise Exception("Not at the start of a record!!")
+
+        yield r1_lines, r2_lines
+
+
+@contextlib.contextmanager
+def temp_output(codec, path):
+    '''Opens ``path`` + '.temp' for writing with ``codec``. If the block raises the temp file is closed
+       and removed, whether or not closing it fails'''
+    temp = path + '.temp'
+    fh = codec.open(temp, 'wb')
+    try:
+        yield fh
+    except BaseException:
+        try:
+            fh.close()
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+        raise
+
+
+# Per worker process copy of the filter chain, codec and QC stats class, set by _init_worker
+_worker_filters, _worker_codec, _worker_qc = None, None, None
+
+
+def _init_worker(filters, codec, qc):
+    global _worker_filters, _worker_codec, _worker_qc
+    _worker_filters, _worker_codec, _worker_qc = filters, codec, qc
+
+
+def _filter_batch(batch, dup_limit):
+    '''Runs in a worker process. Applies the filter chain to ``batch`` and returns the number of pairs kept,
+       the compressed R1 and R2 output, the number of failures for each filter and the batch QC stats'''
+    for f in _worker_filters:
+        f.failures = 0
+
+    r1_lines, r2_lines = batch
+    qc = _worker_qc(dup_limit=dup_limit) if _worker_qc is not None else None
+    keep = apply_filters(_worker_filters, r1_lines, r2_lines, qc)
+
+    return (len(keep),
+            _worker_codec.compress(select_records(r1_lines, keep)),
+            _worker_codec.compress(select_records(r2_lines, keep)),
+            [f.failures for f in _worker_filters],
+            qc)
 
 
 class FastqFilter():
+    '''Filter a pair of fastq.gz files, keeping read pairs that pass all of ``filters``.
+
+    :param bool stream: Stream the compressed output to temp files next to the outputs and
+                        rename them into place when done, rather than buffering the whole
+                        output in memory. Peak memory is then independent of library size.
+    :param int threads: Number of worker processes. If > 1 read pairs are filtered and compressed
+                        in batches by a pool of workers, the output is always streamed and is
+                        written in the original order as concatenated gzip members.
+    :param codec: Name of the compression codec (see :mod:`fieldpathogenomics.compression`) or a
+                  :class:`~fieldpathogenomics.compression.Codec` used to read and write the files.
+    :param bool qc: Collect QC statistics on the input reads as they are filtered, in ``self.qc``
+                    (a :class:`~fieldpathogenomics.scripts.fastq_stats.PairStats`), so no separate pass is needed.
+    '''
 
-    def __init__(self, in_r1, in_r2, out_r1, out_r2, filters):
+    def __init__(self, in_r1, in_r2, out_r1, out_r2, filters, stream=False, threads=1, codec='gzip', qc=False):
 
         self.in_r1 = in_r1
         self.in_r2 = in_r2
         self.out_r1 = out_r1
         self.out_r2 = out_r2
         self.filters = filters
+        self.stream = stream
+        self.threads = threads
+        self.codec = codec if isinstance(codec, Codec) else get_codec(codec)
+        if qc:
+            from fieldpathogenomics.scripts.fastq_stats import PairStats
+            self.qc = PairStats()
+        else:
+            self.qc = None
 
-        self.apply()
+        if self.threads > 1:
+            self.apply_parallel()
+        else:
+            self.apply()
 
     def apply(self):
+        start = time.time()
 
-        # Use mid sized caches 134mb to reduce network load
-        with open(self.in_r1, 'rb', buffering=2**27) as r1_in_gz, open(self.in_r2, 'rb', buffering=2**27) as r2_in_gz:
-            r1_in_fh = io.TextIOWrapper(gzip.GzipFile(mode='r', fileobj=r1_in_gz))
-            r2_in_fh = io.TextIOWrapper(gzip.GzipFile(mode='r', fileobj=r2_in_gz))
+        with open_compressed(self.in_r1, self.codec) as r1_in_fh, open_compressed(self.in_r2, self.codec) as r2_in_fh, \
+                contextlib.ExitStack() as outputs:
 
-            # Fully buffer the output files, so script is (more) atomic
-            r1_buf, r2_buf = io.BytesIO(), io.BytesIO()
-            r1_out_gz, r2_out_gz = gzip.GzipFile(
-                mode='w', fileobj=r1_buf), gzip.GzipFile(mode='w', fileobj=r2_buf)
-            r1_out_text, r2_out_text = io.TextIOWrapper(r1_out_gz), io.TextIOWrapper(r2_out_gz)
+            if self.stream:
+                # Compressed chunks go straight to disk, the temp files are renamed once complete
+                # and each is cleaned up independently of the other if anything fails before then
+                r1_out = outputs.enter_context(temp_output(self.codec, self.out_r1))
+                r2_out = outputs.enter_context(temp_output(self.codec, self.out_r2))
+                r1_write, r2_write = r1_out.write, r2_out.write
+            else:
+                # Fully buffer the output files, so script is (more) atomic
+                r1_out, r2_out = io.BytesIO(), io.BytesIO()
+                r1_write = lambda data: r1_out.write(self.codec.compress(data))
+                r2_write = lambda data: r2_out.write(self.codec.compress(data))
 
             in_count, out_count = 0, 0
-            zipped = zip(r1_in_fh, r2_in_fh)
-            for r1_header, r2_header in zipped:
+            for r1_lines, r2_lines in read_batches(r1_in_fh, r2_in_fh):
+                keep = apply_filters(self.filters, r1_lines, r2_lines, self.qc)
+                in_count += len(r1_lines) // 4
+                out_count += len(keep)
+                r1_write(select_records(r1_lines, keep))
+                r2_write(select_records(r2_lines, keep))
+
+            if self.stream:
+                r1_out.close()
+                r2_out.close()
+                os.rename(self.out_r1 + '.temp', self.out_r1)
+                os.rename(self.out_r2 + '.temp', self.out_r2)
+            else:
+                with open(self.out_r1, 'wb') as r1_out_fh, open(self.out_r2, 'wb',) as r2_out_fh:
+                    r1_out_fh.write(r1_out.getvalue())
+                    r2_out_fh.write(r2_out.getvalue())
+
+        self.report(in_count, time.time() - start)
+
+    def apply_parallel(self):
+        '''R1 and R2 are each decompressed by a subprocess, see :func:`~fieldpathogenomics.compression.open_compressed`,
+           and split into batches of read pairs in this process. The batches are sent to a pool of ``threads``
+           workers that filter and compress them. At most 2 batches per worker are in flight at once so memory
+           use stays bounded'''
+        start = time.time()
+        r1_temp, r2_temp = self.out_r1 + '.temp', self.out_r2 + '.temp'
 
-                if r1_header[0] != '@' or r2_header[0] != '@':
-                    raise Exception("Not at the start of a record!!")
+        with open_compressed(self.in_r1, self.codec, process=True) as r1_in_fh, \
+                open_compressed(self.in_r2, self.codec, process=True) as r2_in_fh, \
+                open(r1_temp, 'wb', buffering=2**22) as r1_out_fh, open(r2_temp, 'wb', buffering=2**22) as r2_out_fh, \
+                multiprocessing.Pool(self.threads, initializer=_init_worker, initargs=(self.filters, self.codec, type(self.qc) if self.qc else None)) as pool:
+            try:
+                in_count, out_count = 0, 0
+                pending = collections.deque()
 
-                r1_seq, r2_seq = next(zipped)
-                r1_desc, r2_desc = next(zipped)
-                r1_qual, r2_qual = next(zipped)
+                def write_next():
+                    kept, r1_gz, r2_gz, failures, qc = pending.popleft().get()
+                    r1_out_fh.write(r1_gz)
+                    r2_out_fh.write(r2_gz)
+                    for f, n in zip(self.filters, failures):
+                        f.failures += n
+                    if qc is not None:
+                        self.qc += qc
+                    return kept
 
-                in_count += 1
-                if all([f(r1_seq, r2_seq) for f in self.filters]):
-                    out_count += 1
-                    r1_out_text.writelines([r1_header, r1_seq, r1_desc, r1_qual])
-                    r2_out_text.writelines([r2_header, r2_seq, r2_desc, r2_qual])
+                for batch in read_batches(r1_in_fh, r2_in_fh):
+                    # Only the start of the file is sampled for duplicates, later batches needn't send samples back
+                    dup_limit = max(0, self.qc.r1.dup_limit - in_count) if self.qc is not None else 0
+                    in_count += len(batch[0]) // 4
+                    pending.append(pool.apply_async(_filter_batch, (batch, dup_limit)))
+                    if len(pending) >= 2 * self.threads:
+                        out_count += write_next()
 
-                # if in_count > 100000:
-                #    break
+                while pending:
+                    out_count += write_next()
 
-            with open(self.out_r1, 'wb') as r1_out_fh, open(self.out_r2, 'wb',) as r2_out_fh:
-                r1_out_text.flush()
-                r2_out_text.flush()
-                r1_out_gz.close()
-                r2_out_gz.close()
-                r1_out_fh.write(r1_buf.getvalue())
-                r2_out_fh.write(r2_buf.getvalue())
+            except BaseException:
+                for temp in [r1_temp, r2_temp]:
+                    if os.path.exists(temp):
+                        os.remove(temp)
+                raise
+
+        os.rename(r1_temp, self.out_r1)
+        os.rename(r2_temp, self.out_r2)
+
+        self.report(in_count, time.time() - start)
+
+    def report(self, in_count, elapsed):
+        bytes_in = os.path.getsize(self.in_r1) + os.path.getsize(self.in_r2)
+        bytes_out = os.path.getsize(self.out_r1) + os.path.getsize(self.out_r2)
 
         print("In : {0} Failed: ".format(in_count) + "\t".join([str(f) for f in self.filters]))
+        print("Bytes in: {0} Bytes out: {1} Records/s: {2:.0f}".format(bytes_in, bytes_out,
+                                                                       in_count / elapsed if elapsed else 0))
 
 
 if __name__ == '__main__':
@@ -104,7 +369,31 @@ if __name__ == '__main__':
     parser.add_argument('out_R1')
     parser.add_argument('out_R2')
     parser.add_argument('-L', required=False, default=101)
+    parser.add_argument('--stream', action='store_true',
+                        help="Stream output to temp files rather than buffering it in memory")
+    parser.add_argument('--threads', required=False, default=1, type=int,
+                        help="Number of worker processes used to filter and compress")
+    parser.add_argument('--codec', required=False, default='gzip',
+                        help="Compression codec, one of gzip, pigz, bgzip, isal, zstd")
+    parser.add_argument('--stats-R1', required=False, default=None,
+                        help="Write fastx_quality_stats format QC of the input R1 here, requires --stats-R2")
+    parser.add_argument('--stats-R2', required=False, default=None)
+    parser.add_argument('--summary', required=False, default=None,
+                        help="Write the QC summary (read lengths, N content, duplication) here")
+    parser.add_argument('-Q', required=False, default=None, type=int,
+                        help="Filter pairs with a read of mean quality below Q")
+    parser.add_argument('-K', required=False, default=None, type=int,
+                        help="Filter pairs with a read containing a homopolymer run of K or more")
     args = parser.parse_args()
 
-    FastqFilter(args.in_R1, args.in_R2, args.out_R1, args.out_R2,
-                [no_Ns(), exact_length(int(args.L))])
+    filters = [no_Ns(), exact_length(int(args.L))]
+    if args.Q is not None:
+        filters.append(mean_quality(args.Q))
+    if args.K is not None:
+        filters.append(homopolymer(args.K))
+
+    qc = args.stats_R1 is not None
+    ff = FastqFilter(args.in_R1, args.in_R2, args.out_R1, args.out_R2,
+                     filters, stream=args.stream, threads=args.threads, codec=args.codec, qc=qc)
+    if qc:
+        ff.qc.write(args.stats_R1, args.stats_R2, args.summary)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+import os
+import argparse
+
+import numpy as np
+
+from fieldpathogenomics.scripts.fastq_filter import ReadBlock, read_batches
+from fieldpathogenomics.compression import get_codec, open_compressed
+
+# Phred+33 quality scores run from 0 to 93
+N_QUALS = 94
+BASES = b'ACGTN'
+# Number of reads (from the start of the file) sampled to estimate duplication, and the prefix compared
+DUP_SAMPLE = 100000
+DUP_PREFIX = 50
+
+# Maps a byte to its index in BASES, anything that isn't ACGT is counted as an N
+_base_index = np.full(256, BASES.index(b'N'), dtype=np.int64)
+for i, b in enumerate(BASES):
+    _base_index[b] = i
+    _base_index[ord(chr(b).lower())] = i
+
+
+class ReadStats():
+    '''Accumulates single pass QC statistics for one mate from :class:`ReadBlock` s:
+       per cycle quality histograms and base composition, the read length distribution
+       and a sample of read prefixes to estimate duplication.
+
+       ``ReadStats`` from separate blocks of the same file can be merged with ``+=``,
+       as long as they are added in file order.'''
+
+    def __init__(self, offset=33, dup_limit=DUP_SAMPLE):
+        self.offset = offset
+        self.dup_limit = dup_limit
+        self.qual_hist = np.zeros((0, N_QUALS), dtype=np.int64)
+        self.base_counts = np.zeros((0, len(BASES)), dtype=np.int64)
+        self.length_hist = np.zeros(0, dtype=np.int64)
+        self.dup_sample = np.zeros((0, DUP_PREFIX), dtype=np.uint8)
+
+    def _grow(self, cycles):
+        if cycles > len(self.qual_hist):
+            self.qual_hist = np.vstack([self.qual_hist, np.zeros((cycles - len(self.qual_hist), N_QUALS), dtype=np.int64)])
+            self.base_counts = np.vstack([self.base_counts, np.zeros((cycles - len(self.base_counts), len(BASES)), dtype=np.int64)])
+
+    def update(self, block):
+        if len(block) == 0:
+            return
+        width = block.seq.shape[1]
+        self._grow(width)
+        valid = np.arange(width)[None, :] < block.lengths[:, None]
+
+        # Flatten (cycle, value) into a single index so each histogram is one bincount
+        cycle = np.broadcast_to(np.arange(width)[None, :], block.seq.shape)[valid]
+        qual = np.clip(block.qual[valid].astype(np.int64) - self.offset, 0, N_QUALS - 1)
+        self.qual_hist[:width] += np.bincount(cycle * N_QUALS + qual, minlength=width * N_QUALS).reshape(width, N_QUALS)
+
+        base = _base_index[block.seq[valid]]
+        self.base_counts[:width] += np.bincount(cycle * len(BASES) + base,
+                                                minlength=width * len(BASES)).reshape(width, len(BASES))
+
+        lengths = np.bincount(block.lengths)
+        if len(lengths) > len(self.length_hist):
+            self.length_hist = np.append(self.length_hist, np.zeros(len(lengths) - len(self.length_hist), dtype=np.int64))
+        self.length_hist[:len(lengths)] += lengths
+
+        if len(self.dup_sample) < self.dup_limit:
+            take = min(self.dup_limit - len(self.dup_sample), len(block))
+            prefix = np.zeros((take, DUP_PREFIX), dtype=np.uint8)
+            n = min(DUP_PREFIX, width)
+            prefix[:, :n] = np.where(valid[:take, :n], block.seq[:take, :n], 0)
+            self.dup_sample = np.vstack([self.dup_sample, prefix])
+
+    def __iadd__(self, other):
+        self._grow(len(other.qual_hist))
+        self.qual_hist[:len(other.qual_hist)] += other.qual_hist
+        self.base_counts[:len(other.base_counts)] += other.base_counts
+
+        if len(other.length_hist) > len(self.length_hist):
+            self.length_hist = np.append(self.length_hist,
+                                         np.zeros(len(other.length_hist) - len(self.length_hist), dtype=np.int64))
+        self.length_hist[:len(other.length_hist)] += other.length_hist
+
+        if len(self.dup_sample) < self.dup_limit:
+            self.dup_sample = np.vstack([self.dup_sample, other.dup_sample[:self.dup_limit - len(self.dup_sample)]])
+        return self
+
+    @property
+    def reads(self):
+        return int(self.length_hist.sum())
+
+    def duplication(self):
+        '''Estimated fraction of duplicate reads, from the first ``dup_limit`` reads'''
+        if len(self.dup_sample) == 0:
+            return 0.0
+        rows = np.ascontiguousarray(self.dup_sample).view(np.dtype((np.void, DUP_PREFIX)))
+        return 1 - len(np.unique(rows)) / len(rows)
+
+    def summary(self):
+        '''Returns a list of (name, value) summary statistics'''
+        bases = self.base_counts.sum()
+        n_bases = self.base_counts[:, BASES.index(b'N')].sum()
+        lengths = np.arange(len(self.length_hist))
+        summary = [('reads', self.reads),
+                   ('bases', int(bases)),
+                   ('mean_length', float(np.dot(lengths, self.length_hist) / max(self.reads, 1))),
+                   ('mean_quality', float(np.dot(self.qual_hist.sum(axis=0), np.arange(N_QUALS)) / max(bases, 1))),
+                   ('N_bases_pc', float(100 * n_bases / max(bases, 1))),
+                   ('duplicate_pc', 100 * self.duplication())]
+        summary += [('GC_pc', float(100 * self.base_counts[:, [1, 2]].sum() / max(bases - n_bases, 1)))]
+        summary += [('length_' + str(l), int(c)) for l, c in zip(lengths, self.length_hist) if c]
+        return summary
+
+    def fastx_table(self):
+        '''Per cycle statistics in the format of fastx_quality_stats'''
+        lines = ["column\tcount\tmin\tmax\tsum\tmean\tQ1\tmed\tQ3\tIQR\tlW\trW\t"
+                 "A_Count\tC_Count\tG_Count\tT_Count\tN_Count\tMax_count\n"]
+        quals = np.arange(N_QUALS)
+        for col, (hist, bases) in enumerate(zip(self.qual_hist, self.base_counts)):
+            count = hist.sum()
+            if count == 0:
+                continue
+            present = np.flatnonzero(hist)
+            qmin, qmax = present[0], present[-1]
+            total = int(np.dot(hist, quals))
+            cumulative = np.cumsum(hist)
+            Q1, med, Q3 = [int(np.searchsorted(cumulative, count * f)) for f in (0.25, 0.5, 0.75)]
+            IQR = Q3 - Q1
+            lW = max(qmin, Q1 - IQR * 3 // 2)
+            rW = min(qmax, Q3 + IQR * 3 // 2)
+            lines.append("\t".join(str(x) for x in [col + 1, count, qmin, qmax, total, "{0:.2f}".format(total / count),
+                                                     Q1, med, Q3, IQR, lW, rW, *bases, self.reads]) + "\n")
+        return "".join(lines)
+
+    def write_fastx(self, path):
+        with open(path + '.temp', 'w') as f:
+            f.write(self.fastx_table())
+        os.rename(path + '.temp', path)
+
+
+class PairStats():
+    '''QC statistics for a read pair, see :class:`ReadStats`'''
+
+    def __init__(self, offset=33, dup_limit=DUP_SAMPLE):
+        self.r1 = ReadStats(offset, dup_limit)
+        self.r2 = ReadStats(offset, dup_limit)
+
+    def update(self, r1, r2):
+        self.r1.update(r1)
+        self.r2.update(r2)
+
+    def __iadd__(self, other):
+        self.r1 += other.r1
+        self.r2 += other.r2
+        return self
+
+    def write(self, stats_r1, stats_r2, summary=None):
+        '''Write fastx_quality_stats style tables for each mate and, optionally, a summary table'''
+        self.r1.write_fastx(stats_r1)
+        self.r2.write_fastx(stats_r2)
+        if summary is not None:
+            with open(summary + '.temp', 'w') as f:
+                f.write("stat\tR1\tR2\n")
+                s1, s2 = self.r1.summary(), self.r2.summary()
+                keys = [k for k, v in s1] + [k for k, v in s2 if k not in dict(s1)]
+                s1, s2 = dict(s1), dict(s2)
+                for k in keys:
+                    f.write("{0}\t{1}\t{2}\n".format(k, s1.get(k, 0), s2.get(k, 0)))
+            os.rename(summary + '.temp', summary)
+
+
+def fastq_pair_stats(in_r1, in_r2, codec='gzip'):
+    '''Stream the fastq pair ``in_r1``, ``in_r2`` once and return their :class:`PairStats`'''
+    stats = PairStats()
+    codec = get_codec(codec)
+    with open_compressed(in_r1, codec) as r1_fh, open_compressed(in_r2, codec) as r2_fh:
+        for r1_lines, r2_lines in read_batches(r1_fh, r2_fh):
+            stats.update(ReadBlock(r1_lines[1::4], r1_lines[3::4]), ReadBlock(r2_lines[1::4], r2_lines[3::4]))
+    return stats
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Single pass QC statistics for a fastq pair")
+    parser.add_argument('in_R1')
+    parser.add_argument('in_R2')
+    parser.add_argument('stats_R1', help="fastx_quality_stats format output for R1")
+    parser.add_argument('stats_R2', help="fastx_quality_stats format output for R2")
+    parser.add_argument('--summary', required=False, default=None,
+                        help="Write read count, length distribution, N content and duplication to this file")
+    parser.add_argument('--codec', required=False, default='gzip')
+    args = parser.parse_args()
+
+    fastq_pair_stats(args.in_R1, args.in_R2, args.codec).write(args.stats_R1, args.stats_R2, args.summary)
@@ -4,8 +4,10 @@ import pandas as pd
 import hashlib
 import inspect
 import zlib
+import mmap
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 ###############################################################################
 #                               File handling                                  #
@@ -46,6 +48,11 @@ snpsift = "java -XX:+UseSerialGC -Xmx{mem}M -jar /tgac/software/testing/snpeff/4
 
 
 def logging_init(log_dir, pipeline_name):
+    '''Set up the pipeline's logs and the SLURM resource tuning of fieldpathogenomics.luigi.resources,
+       call before luigi.run'''
+    from fieldpathogenomics.luigi import resources
+    resources.register()
+
     os.makedirs(log_dir, exist_ok=True)
     logger = logging.getLogger('luigi-interface')
     alloc_log = logging.getLogger('alloc_log')
@@ -73,16 +80,50 @@ def logging_init(log_dir, pipeline_name):
 ###############################################################################
 
 
-def checksum(file):
-    '''Adler32 checksum. Uses blocksize of 500MB. Takes ~30s to checksum 10GB'''
-    BLOCK_SIZE = 2**29
-    with open(file, 'rb') as f:
-        value = 0
-        while True:
-            data = f.read(BLOCK_SIZE)
-            if not data:
-                break
-            value = zlib.adler32(data, value)
+ADLER_BASE = 65521
+CHECKSUM_BLOCK_SIZE = 2**26
+
+# Checksums already computed in this process, keyed on (device, inode, size, mtime)
+_checksum_cache = {}
+
+
+def adler32_combine(adler1, adler2, len2):
+    '''Combine the Adler32 ``adler1`` of one block with the Adler32 ``adler2`` of a following block of length ``len2``
+       into the Adler32 of the concatenation. Same as zlib's adler32_combine'''
+    rem = len2 % ADLER_BASE
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % ADLER_BASE
+    sum1 += (adler2 & 0xffff) + ADLER_BASE - 1
+    sum2 += ((adler1 >> 16) & 0xffff) + ((adler2 >> 16) & 0xffff) + ADLER_BASE - rem
+    sum1 %= ADLER_BASE
+    sum2 %= ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+
+def checksum(file, threads=min(4, os.cpu_count() or 1), block_size=CHECKSUM_BLOCK_SIZE):
+    '''Adler32 checksum, identical to the value of zlib.adler32(data, 0) over the whole file.
+       The file is memory mapped and blocks of ``block_size`` are checksummed in parallel by ``threads``
+       threads (zlib releases the GIL) then combined. Results are cached on (device, inode, size, mtime)'''
+    st = os.stat(file)
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    if key in _checksum_cache:
+        return _checksum_cache[key]
+
+    value = 0
+    if st.st_size > 0:
+        with open(file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            view = memoryview(m)
+            try:
+                offsets = range(0, st.st_size, block_size)
+                with ThreadPoolExecutor(max_workers=threads) as pool:
+                    blocks = list(pool.map(lambda o: zlib.adler32(view[o:o + block_size]), offsets))
+            finally:
+                view.release()
+
+        for o, block in zip(offsets, blocks):
+            value = adler32_combine(value, block, min(block_size, st.st_size - o))
+
+    _checksum_cache[key] = value
     return value
 
 
@@ -125,45 +166,147 @@ def parseLibList(liblist, base_dir):
 #                                    Git                                     #
 ###############################################################################
 
+# Git metadata already resolved in this process
+_file_hashes = {}
+_commit_hashes = {}
+
+
 def file_hash(file):
-    r = subprocess.run("git hash-object " + file, shell=True, check=True,
-                       stdout=subprocess.PIPE, universal_newlines=True)
-    return r.stdout.strip()
+    '''Git blob hash of :param: file, the same as git hash-object but computed in-process
+       and cached on the file's size and mtime'''
+    st = os.stat(file)
+    key = (os.path.abspath(file), st.st_size, st.st_mtime_ns)
+    if key not in _file_hashes:
+        with open(file, 'rb') as f:
+            data = f.read()
+        sha = hashlib.sha1(b'blob ' + str(len(data)).encode() + b'\0')
+        sha.update(data)
+        _file_hashes[key] = sha.hexdigest()
+    return _file_hashes[key]
+
+
+def find_git_dir(path):
+    '''Return the .git directory of the repository containing :param: path, or None'''
+    path = os.path.abspath(path)
+    while True:
+        dot_git = os.path.join(path, '.git')
+        if os.path.isdir(dot_git):
+            return dot_git
+        if os.path.isfile(dot_git):
+            # Worktrees and submodules have a .git file pointing at the real directory
+            with open(dot_git) as f:
+                line = f.read().strip()
+            if line.startswith('gitdir:'):
+                return os.path.normpath(os.path.join(path, line[len('gitdir:'):].strip()))
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def read_ref(git_dir, ref):
+    '''Resolve :param: ref eg refs/heads/master to a commit hash from the loose refs or packed-refs'''
+    common_dir = git_dir
+    if os.path.isfile(os.path.join(git_dir, 'commondir')):
+        with open(os.path.join(git_dir, 'commondir')) as f:
+            common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+
+    for d in [git_dir, common_dir]:
+        loose = os.path.join(d, ref)
+        if os.path.isfile(loose):
+            with open(loose) as f:
+                return f.read().strip()
+
+    packed = os.path.join(common_dir, 'packed-refs')
+    if os.path.isfile(packed):
+        with open(packed) as f:
+            for line in f:
+                if line.startswith(('#', '^')):
+                    continue
+                sha, _, name = line.strip().partition(' ')
+                if name == ref:
+                    return sha
+    return None
 
 
 def current_commit_hash(git_dir):
-    r = subprocess.run("git rev-parse HEAD ", shell=True, check=True,
-                       stdout=subprocess.PIPE, universal_newlines=True, cwd=git_dir)
-    return r.stdout.strip()
+    '''Hash of the commit checked out in the repository containing :param: git_dir, read directly
+       from .git and cached for the life of the process, the code that is running doesn't change'''
+    if git_dir not in _commit_hashes:
+        sha = None
+        dot_git = find_git_dir(git_dir)
+        if dot_git is not None:
+            with open(os.path.join(dot_git, 'HEAD')) as f:
+                head = f.read().strip()
+            sha = read_ref(dot_git, head[len('ref:'):].strip()) if head.startswith('ref:') else head
+
+        if sha is None:
+            # Unborn branch or an unusual layout, let git work it out
+            r = subprocess.run("git rev-parse HEAD ", shell=True, check=True,
+                               stdout=subprocess.PIPE, universal_newlines=True, cwd=git_dir)
+            sha = r.stdout.strip()
+        _commit_hashes[git_dir] = sha
+    return _commit_hashes[git_dir]
 
 ###############################################################################
 #                          Pipeline hashing                                   #
 ###############################################################################
 
 
+# Source hash of each Task class and pipeline hash of each task, keyed on task_id
+_source_hashes = {}
+_pipeline_hashes = {}
+
+
 def ancestor(task):
-    '''Return a set of all Tasks that are ancestors of :param: task'''
-    tree = set()
-    if task.deps() != set():
-        for d in task.deps():
-            tree.add(d)
-            tree.update(ancestor(d))
-    return list(tree)
+    '''Return a list of all Tasks that are ancestors of :param: task, walking the DAG iteratively
+       so tasks shared between branches are only visited once'''
+    seen = {task.task_id}
+    tree, stack = [], [task]
+    while stack:
+        for d in stack.pop().deps():
+            if d.task_id not in seen:
+                seen.add(d.task_id)
+                tree.append(d)
+                stack.append(d)
+    return tree
+
+
+def source_hash(cls):
+    '''sha1 of the source code of the class :param: cls, computed once per process'''
+    if cls not in _source_hashes:
+        _source_hashes[cls] = hashlib.sha1(inspect.getsource(cls).encode()).hexdigest()
+    return _source_hashes[cls]
 
 
 def hash_pipeline(task):
-    '''Creates a hash of the source code of :param: task and all tasks upstream of it'''
-    sha = hashlib.sha1()
-    task_list = [task] + ancestor(task)
-    sources = sorted([inspect.getsource(type(t)) for t in task_list])
-    for s in sources:
-        sha.update(s.encode())
-
-    return sha.hexdigest()
+    '''Creates a Merkle hash of the source code of :param: task and all tasks upstream of it.
+       Each task's hash is the sha1 of its class's source hash and the sorted hashes of its dependencies,
+       every hash is cached so shared subgraphs are hashed once and later calls are a lookup'''
+    deps = {}
+    stack = [task]
+    while stack:
+        t = stack[-1]
+        if t.task_id in _pipeline_hashes:
+            stack.pop()
+            continue
+        if t.task_id not in deps:
+            # First visit, hash the dependencies before coming back to t
+            deps[t.task_id] = t.deps()
+            stack.extend(d for d in deps[t.task_id] if d.task_id not in _pipeline_hashes)
+            continue
+
+        stack.pop()
+        sha = hashlib.sha1(source_hash(type(t)).encode())
+        for h in sorted({_pipeline_hashes[d.task_id] for d in deps[t.task_id]}):
+            sha.update(h.encode())
+        _pipeline_hashes[t.task_id] = sha.hexdigest()
+
+    return _pipeline_hashes[task.task_id]
 
 
 def hash_files(task):
     '''Get all of the files used in any task upstream of :parm: task and returns there git file hash'''
     task_list = [task] + list(ancestor(task))
     files = [inspect.getfile(type(t)) for t in task_list]
-    return {f: git.git_hash(f) for f in files}
+    return {f: file_hash(f) for f in files}
@@ -0,0 +1,339 @@
+'''
+Converting a VCF into HDF5 in a single streaming pass, replacing vcf2npy/vcfnpy2hdf5.
+
+Records are read in blocks, each block is parsed into numpy arrays (in worker processes, the
+parsing is pure python so threads would just contend for the GIL) and appended to chunked, compressed
+datasets in the same layout vcfnpy2hdf5 wrote, so GatherHD5s and the notebooks read them as before
+
+    samples                 names of the samples
+    variants/<field>        CHROM, POS, ID, REF, ALT, QUAL, FILTER_<id>, num_alleles, is_snp, svlen and INFO fields
+    calldata/<field>        genotype, is_called, is_phased and FORMAT fields
+
+Memory is bounded by the block size and the number of blocks in flight, not by the size of the VCF.
+Strings are stored fixed width, so that GatherHD5s can copy chunks without decoding them, and are truncated.
+'''
+import re
+import os
+import sys
+import itertools
+import collections
+import concurrent.futures
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('luigi-interface')
+
+# Values per record of fields with Number=A/R/G and of ALT, and of particular fields
+ARITY = {'A': 1, 'R': 2, 'G': 3, 'ALT': 1, 'AD': 6}
+EXCLUDE = ('ANN',)
+# Types of the fields in the header, with the value used where a field is missing
+TYPES = {'Integer': ('i4', -1), 'Float': ('f4', np.nan), 'Flag': ('?', False),
+         'String': ('S12', b''), 'Character': ('S1', b'')}
+FIXED = [('CHROM', 'S32', b''), ('POS', 'i4', 0), ('ID', 'S20', b''), ('REF', 'S12', b''), ('QUAL', 'f4', np.nan),
+         ('num_alleles', 'i1', 0), ('is_snp', '?', False)]
+# Target uncompressed size of a chunk
+CHUNK_BYTES = 2**20
+# Genotypes parsed at once, blocks are this many genotypes or 100 records whichever is more
+BLOCK_GENOTYPES = 2**19
+
+Field = collections.namedtuple('Field', ['name', 'dtype', 'arity', 'fill'])
+_META = re.compile(rb'##(INFO|FORMAT|FILTER)=<ID=([^,>]+)(?:,Number=([^,>]+))?(?:,Type=([^,>]+))?')
+
+
+class Spec():
+    '''The fields to extract from a VCF, from its header
+
+       :param header: header lines of the VCF, as bytes
+       :param arity: values per record of fields with Number=A/R/G, ALT and any others, see ARITY
+       :param ploidy: alleles per genotype
+       :param exclude: INFO/FORMAT fields not to extract'''
+
+    def __init__(self, header, arity=ARITY, ploidy=2, exclude=EXCLUDE):
+        self.ploidy = ploidy
+        self.samples = []
+        self.filters = ['PASS']
+        info, fmt = [], []
+        for line in header:
+            m = _META.match(line)
+            if m:
+                kind, id, number, type = [x.decode() if x else x for x in m.groups()]
+                if kind == 'FILTER':
+                    if id not in self.filters:
+                        self.filters.append(id)
+                elif id not in exclude and id != 'GT':
+                    (info if kind == 'INFO' else fmt).append(self.field(id, number, type, arity))
+            elif line.startswith(b'#CHROM'):
+                self.samples = [s.decode() for s in line.rstrip(b'\r\n').split(b'\t')[9:]]
+
+        alts = arity['ALT']
+        self.variants = [Field(n, d, 1, f) for n, d, f in FIXED]
+        self.variants += [Field('ALT', 'S12', alts, b''), Field('svlen', 'i4', alts, 0)]
+        self.variants += [Field('FILTER_' + f, '?', 1, False) for f in self.filters]
+        self.variants += info
+        self.calldata = [Field('genotype', 'i1', ploidy, -1), Field('is_called', '?', 1, False),
+                         Field('is_phased', '?', 1, False)] + fmt
+        self.info = {f.name.encode(): f for f in info}
+        self.format = {f.name.encode(): f for f in fmt}
+
+    @staticmethod
+    def field(id, number, type, arity):
+        dtype, fill = TYPES.get(type, TYPES['String'])
+        if id in arity:
+            n = arity[id]
+        elif number in arity:
+            n = arity[number]
+        elif number and number.isdigit():
+            n = max(int(number), 1)
+        else:
+            n = 1
+        # Flags take no values
+        return Field(id, dtype, 1 if type == 'Flag' else n, fill)
+
+    def shape(self, group, field, n):
+        '''Shape of ``n`` records of ``field`` in ``group``'''
+        shape = (n,) if group == 'variants' else (n, len(self.samples))
+        return shape + ((field.arity,) if field.arity > 1 else ())
+
+
+def _number(v, dtype):
+    try:
+        return float(v) if dtype[0] == 'f' else int(v)
+    except ValueError:
+        return None
+
+
+def split_values(values, arity, sep=b','):
+    '''Split each of the bytes ``values`` at ``sep`` into an array of ``arity`` columns, padded with missing values'''
+    joined = b'\0'.join(values)
+    # Count the separators in each value from the whole buffer at once
+    buf = np.frombuffer(joined, dtype=np.uint8)
+    value = np.cumsum(buf == 0)
+    sizes = np.bincount(value[buf == ord(sep)], minlength=len(values)) + 1
+    tokens = np.array(joined.replace(b'\0', sep).split(sep), dtype='S')
+    rows = np.repeat(np.arange(len(values)), sizes)
+    cols = np.arange(len(tokens)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    keep = cols < arity
+    out = np.full((len(values), arity), b'.', dtype=tokens.dtype if tokens.itemsize else 'S1')
+    out[rows[keep], cols[keep]] = tokens[keep]
+    return out
+
+
+def convert(values, field, shape, sep=b','):
+    '''Convert the list of bytes ``values`` of ``field``, with the values for fields of arity more than one
+       separated by ``sep``, to an array of ``shape``. Missing values ('.' or empty) are filled'''
+    if len(values) == 0:
+        return np.full(shape, field.fill, dtype=field.dtype)
+    if field.arity > 1:
+        a = split_values(values, field.arity, sep)
+    elif sep in b'\0'.join(values):
+        a = np.array([v.partition(sep)[0] for v in values], dtype='S')
+    else:
+        a = np.array(values, dtype='S')
+    missing = (a == b'.') | (a == b'')
+    kind = np.dtype(field.dtype).kind
+    if kind == 'S':
+        a[missing] = b''
+        out = a.astype(field.dtype)
+    else:
+        a[missing] = b'0'
+        try:
+            out = a.astype(field.dtype)
+        except ValueError:
+            # Slow path, eg a float in an Integer field
+            out = np.array([_number(v, field.dtype) for v in a.flat], dtype=object).reshape(a.shape)
+            missing |= np.equal(out, None)
+            out[missing] = 0
+            out = out.astype(field.dtype)
+        out[missing] = field.fill
+    return out.reshape(shape)
+
+
+def parse_block(lines, spec):
+    '''Parse the VCF records ``lines`` into {path: array}, see :class:`Spec`'''
+    n, n_samples = len(lines), len(spec.samples)
+    alt_field = spec.variants[len(FIXED)]
+    fixed = {k: [] for k in ('CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER')}
+    info = {k: [b'.'] * n for k in spec.info}
+    flags = {k: np.zeros(n, dtype='?') for k, f in spec.info.items() if f.dtype == '?'}
+    calldata = {k: [] for k in [b'GT'] + list(spec.format)}
+    missing = [b'.'] * n_samples
+
+    for i, line in enumerate(lines):
+        cols = line.rstrip(b'\r\n').split(b'\t')
+        for k, v in zip(('CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER'), cols):
+            fixed[k].append(v)
+        if cols[7] != b'.':
+            for kv in cols[7].split(b';'):
+                k, _, v = kv.partition(b'=')
+                if k in flags:
+                    flags[k][i] = True
+                elif k in info:
+                    info[k][i] = v
+
+        if n_samples == 0:
+            continue
+        keys = cols[8].split(b':') if len(cols) > 9 else []
+        # One tuple per key across the samples, trailing fields can be dropped
+        parts = list(itertools.zip_longest(*[s.split(b':') for s in cols[9:9 + n_samples]], fillvalue=b'.'))
+        for k, values in calldata.items():
+            if k in keys and keys.index(k) < len(parts):
+                values.extend(parts[keys.index(k)])
+            else:
+                values.extend(missing)
+
+    out = {}
+    chrom, pos, ref = fixed['CHROM'], fixed['POS'], fixed['REF']
+    alts = [[] if a == b'.' else a.split(b',') for a in fixed['ALT']]
+    out['variants/CHROM'] = np.array(chrom, dtype='S32')
+    out['variants/POS'] = np.array(pos, dtype='S').astype('i4') if n else np.zeros(0, dtype='i4')
+    out['variants/ID'] = convert(fixed['ID'], Field('ID', 'S20', 1, b''), (n,))
+    out['variants/REF'] = np.array(ref, dtype='S12')
+    out['variants/QUAL'] = convert(fixed['QUAL'], Field('QUAL', 'f4', 1, np.nan), (n,))
+    out['variants/num_alleles'] = np.array([1 + len(a) for a in alts], dtype='i1')
+    out['variants/is_snp'] = np.array([len(r) == 1 and bool(a) and all(len(x) == 1 and x in b'ACGTN' for x in a)
+                                       for r, a in zip(ref, alts)], dtype='?')
+    shape = spec.shape('variants', alt_field, n)
+    out['variants/ALT'] = convert([b','.join(a) if a else b'.' for a in alts], alt_field, shape)
+    pad = [0] * alt_field.arity
+    out['variants/svlen'] = np.array([([len(x) - len(r) for x in a] + pad)[:alt_field.arity]
+                                      for r, a in zip(ref, alts)], dtype='i4').reshape(shape)
+    filters = [set(f.split(b';')) for f in fixed['FILTER']]
+    for f in spec.filters:
+        out['variants/FILTER_' + f] = np.array([f.encode() in x for x in filters], dtype='?')
+
+    for k, f in spec.info.items():
+        if k in flags:
+            out['variants/' + f.name] = flags[k]
+        else:
+            out['variants/' + f.name] = convert(info[k], f, spec.shape('variants', f, n))
+
+    genotype = spec.calldata[0]
+    if n_samples:
+        gt = calldata[b'GT']
+        if b'|' in b'\0'.join(gt):
+            phased = np.array([b'|' in v for v in gt], dtype='?')
+            gt = [v.replace(b'|', b'/') for v in gt]
+        else:
+            phased = np.zeros(len(gt), dtype='?')
+        out['calldata/genotype'] = convert(gt, genotype, spec.shape('calldata', genotype, n), sep=b'/')
+        out['calldata/is_phased'] = phased.reshape(n, n_samples)
+        # Every allele called
+        out['calldata/is_called'] = (out['calldata/genotype'] >= 0).reshape(n, n_samples, -1).all(axis=-1)
+        for k, f in spec.format.items():
+            out['calldata/' + f.name] = convert(calldata[k], f, spec.shape('calldata', f, n))
+    else:
+        for f in spec.calldata:
+            out['calldata/' + f.name] = np.full(spec.shape('calldata', f, n), f.fill, dtype=f.dtype)
+    return out
+
+
+def read_header(f):
+    '''Returns the header lines of the VCF file object ``f`` and its first record, None if it has none'''
+    header = []
+    for line in f:
+        if not line.startswith(b'#'):
+            return header, line
+        header.append(line)
+    return header, None
+
+
+def read_blocks(f, first, block_size):
+    '''Yield lists of up to ``block_size`` record lines, ``first`` then the rest of the file object ``f``'''
+    if first is None:
+        return
+    block = [first]
+    for line in f:
+        block.append(line)
+        if len(block) == block_size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def create_datasets(fout, spec, compression='gzip', compression_opts=1):
+    '''Create the empty, resizable datasets for ``spec`` in the h5py File ``fout``'''
+    fout.create_dataset('samples', data=np.array([s.encode() for s in spec.samples], dtype='S'))
+    datasets = {}
+    for group, fields in (('variants', spec.variants), ('calldata', spec.calldata)):
+        for f in fields:
+            shape = spec.shape(group, f, 0)
+            row_bytes = np.dtype(f.dtype).itemsize * int(np.prod(shape[1:]))
+            rows = max(1, min(2**16, CHUNK_BYTES // max(row_bytes, 1)))
+            datasets[group + '/' + f.name] = fout.create_dataset(
+                group + '/' + f.name, shape=shape, maxshape=(None,) + shape[1:], dtype=f.dtype,
+                chunks=(rows,) + shape[1:], compression=compression, compression_opts=compression_opts, shuffle=True)
+    return datasets
+
+
+def _append(datasets, arrays):
+    for path, a in arrays.items():
+        d = datasets[path]
+        n = d.shape[0]
+        d.resize(n + a.shape[0], axis=0)
+        d[n:] = a
+
+
+def parsed_blocks(f, block_size=None, processes=1, **kwargs):
+    '''Returns the :class:`Spec` of the VCF file object ``f`` and a generator of its records parsed into
+       {path: array} in blocks of ``block_size`` (by default from BLOCK_GENOTYPES) by ``processes`` processes.
+       Any other arguments are passed to :class:`Spec`'''
+    header, first = read_header(f)
+    spec = Spec(header, **kwargs)
+    block_size = block_size or max(100, BLOCK_GENOTYPES // max(len(spec.samples), 1))
+    return spec, _parse(read_blocks(f, first, block_size), spec, processes)
+
+
+def _parse(blocks, spec, processes):
+    if processes <= 1:
+        for block in blocks:
+            yield parse_block(block, spec)
+        return
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        # Keep a few blocks per process in flight, in order
+        pending = collections.deque()
+        for block in blocks:
+            pending.append(pool.submit(parse_block, block, spec))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def vcf_to_hd5(vcf, output, block_size=None, processes=1, **kwargs):
+    '''Convert the VCF ``vcf`` (a path, plain or gzipped, or a binary file object eg sys.stdin.buffer)
+       into the HDF5 file ``output``, see :func:`parsed_blocks` for the other arguments.
+       Written to a temporary file and moved into place'''
+    import h5py
+    from fieldpathogenomics.bgzf import _open_vcf
+
+    f = _open_vcf(vcf) if isinstance(vcf, str) else vcf
+    temp = output + '.temp'
+    try:
+        spec, blocks = parsed_blocks(f, block_size, processes, **kwargs)
+        n = 0
+        with h5py.File(temp, 'w') as fout:
+            datasets = create_datasets(fout, spec)
+            for arrays in blocks:
+                _append(datasets, arrays)
+                n += len(arrays['variants/POS'])
+        os.rename(temp, output)
+        logger.info("Converted {0} records of {1} samples to {2}".format(n, len(spec.samples), output))
+    finally:
+        if isinstance(vcf, str):
+            f.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert a VCF to HDF5")
+    parser.add_argument('vcf', help="VCF, plain or gzipped, - for stdin")
+    parser.add_argument('output')
+    parser.add_argument('--block-size', type=int, default=None)
+    parser.add_argument('--processes', type=int, default=1)
+    args = parser.parse_args()
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+    vcf_to_hd5(sys.stdin.buffer if args.vcf == '-' else args.vcf, args.output,
+               block_size=args.block_size, processes=args.processes)
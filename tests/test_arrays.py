@@ -0,0 +1,179 @@
+import unittest
+import glob
+import threading
+import subprocess
+import shutil
+import tempfile
+import luigi
+import os
+from unittest import mock
+
+from bioluigi.slurm import SlurmExecutableTask
+import fieldpathogenomics.luigi.arrays as arrays
+from fieldpathogenomics.luigi.arrays import ArrayTask, ArrayConfig, ArraySpool, _job_state
+
+test_dir = os.path.split(__file__)[0]
+# Set by TestArrayTask.setUp, the tasks' outputs go there
+scratch = None
+
+# Runs the array's elements one after another, counting submissions
+FAKE_SBATCH = '''#!/bin/bash
+echo submitted >> {scratch}/submissions
+range=$(echo "$@" | grep -o -- '--array=[0-9]*-[0-9]*' | cut -d= -f2)
+for i in $(seq ${{range%-*}} ${{range#*-}}); do SLURM_ARRAY_TASK_ID=$i bash "${{@: -1}}"; done
+echo 4242
+'''
+
+# Submits without running anything
+QUEUED_SBATCH = '''#!/bin/bash
+echo 4242
+'''
+
+
+class Echo(ArrayTask, luigi.Task):
+    n = luigi.IntParameter()
+    run_locally = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mem = 100
+        self.n_cpu = 1
+        self.partition = 'nbi-short'
+
+    def output(self):
+        return luigi.LocalTarget(os.path.join(scratch, 'echo_{0}.txt'.format(self.n)))
+
+    def work_script(self):
+        return '''#!/bin/bash
+                  set -euo pipefail
+                  test {n} -ne 3
+                  echo {n} > {output}
+                  '''.format(n=self.n, output=self.output().path)
+
+
+class Committed():
+    def on_success(self):
+        self.committed = True
+
+
+class Hooked(ArrayTask, Committed, SlurmExecutableTask):
+    pass
+
+
+class TestArrayTask(unittest.TestCase):
+
+    def setUp(self):
+        global scratch
+        scratch = tempfile.mkdtemp()
+        sbatch = os.path.join(scratch, 'sbatch')
+        with open(sbatch, 'w') as f:
+            f.write(FAKE_SBATCH.format(scratch=scratch))
+        config = luigi.configuration.get_config()
+        config.set('ArrayConfig', 'enabled', 'true')
+        config.set('ArrayConfig', 'spool_dir', os.path.join(scratch, 'spool'))
+        config.set('ArrayConfig', 'sbatch', 'bash ' + sbatch)
+        config.set('ArrayConfig', 'window', '1')
+        config.set('ArrayConfig', 'poll_time', '0.1')
+
+    def run_tasks(self, tasks):
+        errors = {}
+
+        def run(task):
+            try:
+                task.run()
+            except subprocess.CalledProcessError as e:
+                errors[task.n] = e
+        threads = [threading.Thread(target=run, args=(t,)) for t in tasks]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return errors
+
+    def test_array(self):
+        errors = self.run_tasks([Echo(n=i) for i in range(5)])
+        # One submission for all the tasks, each of which succeeds or fails independently
+        with open(os.path.join(scratch, 'submissions')) as f:
+            self.assertEqual(len(f.readlines()), 1)
+        self.assertEqual(list(errors), [3])
+        for i in [0, 1, 2, 4]:
+            with Echo(n=i).output().open() as f:
+                self.assertEqual(f.read(), "{0}\n".format(i))
+
+    def test_hooks(self):
+        # Tasks run in an array skip SlurmExecutableTask's hooks but not the other mixins'
+        task = Hooked()
+        task.in_array = True
+        with mock.patch.object(SlurmExecutableTask, 'on_success') as success, \
+                mock.patch.object(SlurmExecutableTask, 'on_failure') as failure:
+            task.on_success()
+            task.on_failure(Exception())
+        self.assertTrue(task.committed)
+        self.assertFalse(success.called or failure.called)
+
+    def use_sbatch(self, script):
+        sbatch = os.path.join(scratch, 'sbatch')
+        with open(sbatch, 'w') as f:
+            f.write(script)
+
+    def test_never_started(self):
+        # Gone from the queue without ever running, so there is no .err
+        self.use_sbatch(QUEUED_SBATCH)
+        with mock.patch.object(arrays, '_job_state', return_value='finished'):
+            errors = self.run_tasks([Echo(n=0)])
+        self.assertIsInstance(errors[0], subprocess.CalledProcessError)
+
+    def test_unknown_state(self):
+        # squeue failing, or the job briefly looking finished, doesn't end the wait while it's still queued
+        self.use_sbatch(QUEUED_SBATCH)
+        spool = ArraySpool(os.path.join(scratch, 'spool', 'test'), 100, 1, 'nbi-short')
+        spool.add('key', 'true')
+        states = [None, 'finished', 'finished', 'queued', None, 'finished', 'finished', None, None]
+
+        def state(jobid):
+            if not states:
+                # Finally runs
+                batch = glob.glob(os.path.join(spool.path, 'batch_*'))[0]
+                with open(os.path.join(batch, '0.exit'), 'w') as f:
+                    f.write('0\n')
+                return 'queued'
+            return states.pop(0)
+        with mock.patch.object(arrays, '_job_state', side_effect=state):
+            status, batch, index, jobid = spool.wait('key', ArrayConfig())
+        self.assertEqual((status, index, jobid), (0, 0, '4242'))
+
+    def test_job_state(self):
+        def fake(squeue, sacct):
+            def run(cmd, **kwargs):
+                rc, out = squeue if cmd[0] == 'squeue' else sacct
+                return subprocess.CompletedProcess(cmd, rc, stdout=out)
+            return run
+        cases = [((0, 'RUNNING\n'), None, 'queued'),
+                 ((1, ''), (0, 'RUNNING\n'), 'queued'),
+                 ((1, ''), (0, 'COMPLETED\n'), 'finished'),
+                 ((0, ''), (0, 'FAILED\n'), 'finished'),
+                 ((1, ''), (1, ''), None),
+                 ((0, ''), (0, ''), None)]
+        for squeue, sacct, expected in cases:
+            with mock.patch.object(arrays.subprocess, 'run', side_effect=fake(squeue, sacct)):
+                self.assertEqual(_job_state('4242_0'), expected)
+
+    def test_stuck_submission(self):
+        # Another process holds the lock and never submits
+        config = luigi.configuration.get_config()
+        config.set('ArrayConfig', 'submit_timeout', '0.1')
+        spool = ArraySpool(os.path.join(scratch, 'spool', 'test'), 100, 1, 'nbi-short')
+        spool.add('key', 'true')
+        with mock.patch.object(ArraySpool, 'try_submit'):
+            with self.assertRaises(Exception):
+                spool.wait('key', ArrayConfig())
+        self.assertEqual(os.listdir(os.path.join(spool.path, 'pending')), [])
+
+    def tearDown(self):
+        config = luigi.configuration.get_config()
+        config.remove_section('ArrayConfig')
+        shutil.rmtree(scratch)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+import gzip
+import os
+import shutil
+import tempfile
+import glob
+
+from fieldpathogenomics.bgzf import BgzfWriter, gather_vcfs, concat_vcfs, merge_plain_vcfs, OutOfOrder
+from fieldpathogenomics.SGUtils import read_tabix_index
+
+test_dir = os.path.split(__file__)[0]
+
+HEADER = (b'##fileformat=VCFv4.2\n##contig=<ID=ctg0,length=100000>\n##contig=<ID=ctg1,length=100000>\n'
+          b'#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+RECORDS = [b'ctg' + str(c).encode() + b'\t' + str(p).encode() + b'\t.\tA\tG\t50\tPASS\tDP=' + str(p % 97).encode() + b'\n'
+           for c in range(2) for p in range(1, 100000, 7)]
+
+
+class TestGatherVCF(unittest.TestCase):
+
+    def setUp(self):
+        self.out = tempfile.mkdtemp()
+
+    def write_shards(self, shards, bgzf=True):
+        paths = []
+        for i, records in enumerate(shards):
+            path = os.path.join(self.out, 'shard_{0}.vcf.gz'.format(i))
+            if bgzf:
+                writer = BgzfWriter(path)
+                writer.write(HEADER + b''.join(records))
+                writer.close()
+            else:
+                with gzip.open(path, 'wb') as f:
+                    f.write(HEADER + b''.join(records))
+            paths.append(path)
+        return paths
+
+    def check(self, path):
+        with gzip.open(path, 'rb') as f:
+            self.assertEqual(f.read(), HEADER + b''.join(RECORDS))
+        self.assertEqual(read_tabix_index(path + '.tbi', exact=True),
+                         [('ctg0', len(RECORDS) // 2), ('ctg1', len(RECORDS) // 2)])
+        self.assertEqual(glob.glob(os.path.join(self.out, '*temp*')), [])
+
+    def test_concat(self):
+        n = len(RECORDS) // 3
+        shards = self.write_shards([RECORDS[:n], RECORDS[n:2 * n], RECORDS[2 * n:]])
+        output = os.path.join(self.out, 'gathered.vcf.gz')
+        gather_vcfs(shards, output)
+        self.check(output)
+
+    def test_merge(self):
+        output = os.path.join(self.out, 'gathered.vcf.gz')
+        # Interleaved shards can't be concatenated
+        shards = self.write_shards([RECORDS[0::2], RECORDS[1::2]])
+        with self.assertRaises(OutOfOrder):
+            concat_vcfs(shards, output)
+        gather_vcfs(shards, output)
+        self.check(output)
+
+        # Nor can plain gzip
+        shards = self.write_shards([RECORDS[:100], RECORDS[100:]], bgzf=False)
+        gather_vcfs(shards, output)
+        self.check(output)
+
+    def test_merge_many(self):
+        # Regions dealt round robin to 50 shards, each region repeating the first record of the next
+        # like a variant called in both shards where two regions meet
+        regions = [RECORDS[i:i + 201] for i in range(0, len(RECORDS), 200)]
+        shards = [sum(regions[i::50], []) for i in range(50)]
+        output = os.path.join(self.out, 'gathered.vcf.gz')
+        gather_vcfs(self.write_shards(shards), output)
+        self.check(output)
+
+    def test_overlap(self):
+        # Contiguous shards that repeat a record where they meet can't be concatenated
+        n = len(RECORDS) // 2
+        shards = self.write_shards([RECORDS[:n], RECORDS[n - 1:]])
+        output = os.path.join(self.out, 'gathered.vcf.gz')
+        with self.assertRaises(OutOfOrder):
+            concat_vcfs(shards, output)
+        gather_vcfs(shards, output)
+        self.check(output)
+
+    def test_merge_plain(self):
+        # eg gVCFs from HaplotypeCaller over shards of whole contigs
+        paths = []
+        for i, records in enumerate([RECORDS[len(RECORDS) // 2:], RECORDS[:len(RECORDS) // 2]]):
+            paths.append(os.path.join(self.out, 'shard_{0}.g.vcf'.format(i)))
+            with open(paths[-1], 'wb') as f:
+                f.write(HEADER + b''.join(records))
+        output = os.path.join(self.out, 'gathered.g.vcf')
+        merge_plain_vcfs(paths, output)
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), HEADER + b''.join(RECORDS))
+        self.assertEqual(glob.glob(os.path.join(self.out, '*temp*')), [])
+
+    def tearDown(self):
+        shutil.rmtree(self.out)
+
+
+if __name__ == '__main__':
+    unittest.main()
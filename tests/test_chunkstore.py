@@ -0,0 +1,84 @@
+import unittest
+import gzip
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import h5py
+
+from fieldpathogenomics.chunkstore import write_store, gather_stores, open_callset, Store
+from fieldpathogenomics.vcf2hd5 import vcf_to_hd5
+
+from test_vcf2hd5 import HEADER, RECORDS
+
+test_dir = os.path.split(__file__)[0]
+
+
+class TestChunkStore(unittest.TestCase):
+
+    def setUp(self):
+        self.out = tempfile.mkdtemp()
+
+    def write_vcf(self, records, name):
+        path = os.path.join(self.out, name)
+        with gzip.open(path, 'wb') as f:
+            f.write(HEADER + b''.join(records))
+        return path
+
+    def test_same_as_hd5(self):
+        vcf = self.write_vcf(RECORDS * 5, 'same.vcf.gz')
+        hd5, store = os.path.join(self.out, 'same.hd5'), os.path.join(self.out, 'same.store')
+        vcf_to_hd5(vcf, hd5)
+        write_store(vcf, store, block_size=4)
+        self.assertEqual(len(os.listdir(os.path.join(store, '0', 'variants', 'POS'))), 4)
+
+        with h5py.File(hd5, 'r') as h, open_callset(os.path.join(store, 'meta.json')) as s:
+            self.assertIsInstance(s, Store)
+            np.testing.assert_array_equal(s['samples'], h['samples'][:])
+            self.assertEqual(s['variants'].keys(), sorted(h['variants'].keys()))
+            self.assertEqual(s['calldata'].keys(), sorted(h['calldata'].keys()))
+            for group in ('variants', 'calldata'):
+                for name in h[group]:
+                    a, b = s[group][name], h[group][name]
+                    self.assertEqual((a.shape, a.dtype), (b.shape, b.dtype))
+                    np.testing.assert_array_equal(a[:], b[:])
+
+    def test_gather(self):
+        shards = [RECORDS[:2], RECORDS[2:], RECORDS * 3]
+        stores = []
+        for i, records in enumerate(shards):
+            stores.append(os.path.join(self.out, 'shard_{0}.store'.format(i)))
+            write_store(self.write_vcf(records, 'shard_{0}.vcf.gz'.format(i)), stores[-1], block_size=2)
+        output = os.path.join(self.out, 'gathered.store')
+        gather_stores(stores, output)
+        self.assertFalse(any(os.path.exists(x) for x in stores))
+
+        s = open_callset(output)
+        pos = np.array([10, 20, 5])
+        expected = np.concatenate([pos[:2], pos[2:], np.tile(pos, 3)])
+        np.testing.assert_array_equal(s['variants/POS'][:], expected)
+        self.assertEqual(s['calldata']['genotype'].shape, (len(expected), 2, 2))
+
+    def test_indexing(self):
+        write_store(self.write_vcf(RECORDS * 7, 'index.vcf.gz'), os.path.join(self.out, 'index.store'), block_size=3)
+        gt = open_callset(os.path.join(self.out, 'index.store'))['calldata']['genotype']
+        full = gt[:]
+        self.assertEqual(full.shape, (21, 2, 2))
+        np.testing.assert_array_equal(np.asarray(gt), full)
+        np.testing.assert_array_equal(gt[2:11], full[2:11])
+        np.testing.assert_array_equal(gt[1:20:4, 1], full[1:20:4, 1])
+        np.testing.assert_array_equal(gt[::-2], full[::-2])
+        np.testing.assert_array_equal(gt[-1], full[-1])
+        np.testing.assert_array_equal(gt[[17, 0, 4]], full[[17, 0, 4]])
+        mask = np.arange(21) % 5 == 0
+        np.testing.assert_array_equal(gt[mask, :, 0], full[mask, :, 0])
+        with self.assertRaises(IndexError):
+            gt[21]
+
+    def tearDown(self):
+        shutil.rmtree(self.out)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,21 +1,26 @@
 import unittest
 import luigi
 import os
+import shutil
+import tempfile
+import datetime
 
 from bioluigi.slurm import SlurmExecutableTask
-from fieldpathogenomics.luigi.commit import CommittedTarget, CommittedTask
+from fieldpathogenomics.luigi.commit import CommittedTarget, CommittedTask, FileTable
 
 test_dir = os.path.split(__file__)[0]
 
 
 class TestTask(CommittedTask, SlurmExecutableTask):
+    out = None
+
     def __init__(self):
         super().__init__()
         self.n_cpu = 1
         self.mem = 100
 
     def output(self):
-        return CommittedTarget(os.path.join(test_dir, 'scratch', "TestCommit.txt"))
+        return CommittedTarget(os.path.join(self.out, "TestCommit.txt"))
 
     def run(self):
         with self.output().open('w') as f:
@@ -23,10 +28,44 @@ class TestTask(CommittedTask, SlurmExecutableTask):
 
 
 class TestCommit(unittest.TestCase):
+    def setUp(self):
+        TestTask.out = tempfile.mkdtemp()
+
     def test_Ok(self):
         task = TestTask()
         luigi.build([task], local_scheduler=True)
 
+    def tearDown(self):
+        shutil.rmtree(TestTask.out)
+
+
+class TestFileTable(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.table = FileTable('sqlite:///' + os.path.join(self.tmp, 'TestFileTable.db'))
+
+    def rows(self):
+        with self.table.engine.connect() as conn:
+            return sorted((r.path, r.checksum) for r in conn.execute(self.table.table.select()))
+
+    def row(self, path, checksum):
+        return (path, checksum, datetime.datetime.now(), 'TestTask', 'commit', 'hash')
+
+    def test_write(self):
+        # Written straight away
+        self.table.write([self.row('/a', 1), self.row('/b', 2)])
+        self.assertEqual(self.rows(), [('/a', 1), ('/b', 2)])
+
+    def test_replace(self):
+        self.table.write([self.row('/a', 1)])
+        self.table.write([self.row('/a', 2), self.row('/a', 3)])
+        self.assertEqual(self.rows(), [('/a', 3)])
+
+    def tearDown(self):
+        # Engines are shared per database, close the pooled connections to the deleted file
+        self.table.engine.dispose()
+        shutil.rmtree(self.tmp)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+import gzip
+import os
+import shutil
+import tempfile
+import glob
+from unittest import mock
+
+from fieldpathogenomics.scripts.fastq_filter import (FastqFilter, ReadBlock, apply_filters,
+                                                     no_Ns, exact_length, mean_quality, homopolymer)
+from fieldpathogenomics.scripts.fastq_stats import fastq_pair_stats
+from fieldpathogenomics.compression import get_codec
+
+test_dir = os.path.split(__file__)[0]
+R1 = os.path.join(test_dir, 'data', 'test_R1.fastq.gz')
+R2 = os.path.join(test_dir, 'data', 'test_R2.fastq.gz')
+
+
+def read(path):
+    with gzip.open(path, 'rt') as f:
+        return f.read()
+
+
+class TestFastqFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.out = tempfile.mkdtemp()
+        FastqFilter(R1, R2, os.path.join(self.out, 'buffered_R1.fastq.gz'), os.path.join(self.out, 'buffered_R2.fastq.gz'),
+                    [no_Ns(), exact_length(100)])
+        self.expected = [read(os.path.join(self.out, 'buffered_R1.fastq.gz')),
+                         read(os.path.join(self.out, 'buffered_R2.fastq.gz'))]
+
+    def check(self, prefix, filters):
+        self.assertEqual(read(os.path.join(self.out, prefix + '_R1.fastq.gz')), self.expected[0])
+        self.assertEqual(read(os.path.join(self.out, prefix + '_R2.fastq.gz')), self.expected[1])
+        self.assertEqual([str(f) for f in filters], ["No N's: 0", "Exact length: 83"])
+        self.assertEqual(glob.glob(os.path.join(self.out, '*.temp')), [])
+
+    def test_stream(self):
+        filters = [no_Ns(), exact_length(100)]
+        FastqFilter(R1, R2, os.path.join(self.out, 'stream_R1.fastq.gz'), os.path.join(self.out, 'stream_R2.fastq.gz'),
+                    filters, stream=True)
+        self.check('stream', filters)
+
+    def test_stream_cleanup(self):
+        # The R2 output can't be opened, the R1 temp file is removed
+        with self.assertRaises(OSError):
+            FastqFilter(R1, R2, os.path.join(self.out, 'failed_R1.fastq.gz'),
+                        os.path.join(self.out, 'missing', 'failed_R2.fastq.gz'), [no_Ns()], stream=True)
+        self.assertEqual(glob.glob(os.path.join(self.out, '*.temp')), [])
+
+        # Closing R1 fails, R2 is still closed and neither temp file is left
+        codec, handles = get_codec('gzip'), []
+        codec_open = codec.open
+
+        def failing_open(path, mode='rb'):
+            fh = codec_open(path, mode)
+            if path.endswith('_R1.fastq.gz.temp'):
+                fh.close = mock.Mock(side_effect=OSError("No space left on device"))
+            handles.append(fh)
+            return fh
+        codec.open = failing_open
+
+        with self.assertRaises(OSError):
+            FastqFilter(R1, R2, os.path.join(self.out, 'failed_R1.fastq.gz'), os.path.join(self.out, 'failed_R2.fastq.gz'),
+                        [no_Ns()], stream=True, codec=codec)
+        self.assertTrue(handles[-1].closed)
+        self.assertEqual(glob.glob(os.path.join(self.out, 'failed*')), [])
+
+    def test_parallel(self):
+        filters = [no_Ns(), exact_length(100)]
+        FastqFilter(R1, R2, os.path.join(self.out, 'parallel_R1.fastq.gz'), os.path.join(self.out, 'parallel_R2.fastq.gz'),
+                    filters, threads=2)
+        self.check('parallel', filters)
+
+    def test_inline_qc(self):
+        ff = FastqFilter(R1, R2, os.path.join(self.out, 'qc_R1.fastq.gz'), os.path.join(self.out, 'qc_R2.fastq.gz'),
+                         [no_Ns(), exact_length(100)], threads=2, qc=True)
+        stats = fastq_pair_stats(R1, R2)
+        self.assertEqual(ff.qc.r1.fastx_table(), stats.r1.fastx_table())
+        self.assertEqual(ff.qc.r2.summary(), stats.r2.summary())
+
+        table = stats.r1.fastx_table().splitlines()
+        self.assertEqual(table[0].split('\t')[:3], ['column', 'count', 'min'])
+        self.assertEqual(len(table), 1 + 101)
+        self.assertEqual(dict(stats.r1.summary())['reads'], 84)
+
+    def tearDown(self):
+        shutil.rmtree(self.out)
+
+
+class TestBatchFilters(unittest.TestCase):
+
+    def setUp(self):
+        seqs = [b'ACGTTTTTA\n', b'AAAAAC\n', b'CANAA\n', b'ACGTA\n']
+        quals = [b'IIII#IIII\n', b'!!!!!!\n', b'IIIII\n', b'IIIII\n']
+        self.block = ReadBlock(seqs, quals)
+        self.lines = [l for s, q in zip(seqs, quals) for l in [b'@read\n', s, b'+\n', q]]
+
+    def test_masks(self):
+        self.assertEqual(list(self.block.lengths), [9, 6, 5, 5])
+        self.assertEqual(list(no_Ns().mask(self.block, self.block)), [True, True, False, True])
+        self.assertEqual(list(exact_length(5).mask(self.block, self.block)), [False, False, True, True])
+        self.assertEqual(list(mean_quality(20).mask(self.block, self.block)), [True, False, True, True])
+        self.assertEqual(list(homopolymer(5).mask(self.block, self.block)), [False, False, True, True])
+
+    def test_short_circuit(self):
+        filters = [no_Ns(), exact_length(5), homopolymer(5)]
+        keep = apply_filters(filters, self.lines, self.lines)
+        self.assertEqual(list(keep), [3])
+        self.assertEqual([f.failures for f in filters], [1, 2, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+import glob
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+import numpy as np
+import h5py
+
+import fieldpathogenomics.hd5 as hd5
+from fieldpathogenomics.hd5 import gather_hd5s
+
+test_dir = os.path.split(__file__)[0]
+
+SAMPLES = np.array([b'LIB001', b'LIB002', b'LIB003'])
+
+
+class TestGatherHD5s(unittest.TestCase):
+
+    def setUp(self):
+        self.out = tempfile.mkdtemp()
+        rng = np.random.RandomState(42)
+        self.pos = np.arange(10000, dtype='i4')
+        self.gt = rng.randint(-1, 2, size=(10000, 3, 2)).astype('i1')
+
+    def write_shards(self, sizes, chunks=1000, **kwargs):
+        paths, start = [], 0
+        for i, n in enumerate(sizes):
+            path = os.path.join(self.out, 'shard_{0}.hd5'.format(i))
+            with h5py.File(path, 'w') as f:
+                f.create_dataset('samples', data=SAMPLES)
+                f.create_dataset('variants/POS', data=self.pos[start:start + n],
+                                 chunks=(chunks,), compression='gzip', **kwargs)
+                f.create_dataset('calldata/genotype', data=self.gt[start:start + n],
+                                 chunks=(chunks, 3, 2), compression='gzip', **kwargs)
+            paths.append(path)
+            start += n
+        return paths
+
+    def check(self, path):
+        with h5py.File(path, 'r') as f:
+            np.testing.assert_array_equal(f['samples'][:], SAMPLES)
+            np.testing.assert_array_equal(f['variants/POS'][:], self.pos)
+            np.testing.assert_array_equal(f['calldata/genotype'][:], self.gt)
+        self.assertEqual(glob.glob(os.path.join(self.out, '*temp*')), [])
+
+    def test_aligned(self):
+        shards = self.write_shards([3000, 4000, 3000])
+        output = os.path.join(self.out, 'gathered.hd5')
+        with self.assertLogs('luigi-interface') as logs:
+            gather_hd5s(shards, output, mode='chunks')
+        # Every chunk is copied without decoding
+        self.assertIn('copied 20/20 chunks', logs.output[0])
+        self.check(output)
+        with h5py.File(output, 'r') as f:
+            self.assertEqual(f['calldata/genotype'].chunks, (1000, 3, 2))
+
+    def test_unaligned(self):
+        shards = self.write_shards([2500, 5000, 2500], shuffle=True)
+        output = os.path.join(self.out, 'gathered.hd5')
+        with self.assertLogs('luigi-interface') as logs:
+            gather_hd5s(shards, output, mode='chunks')
+        # Only the whole chunks of the first shard line up with the output, the rest are decoded
+        self.assertIn('copied 4/22 chunks', logs.output[0])
+        self.check(output)
+
+    def test_virtual(self):
+        shards = self.write_shards([2500, 5000, 2500])
+        output = os.path.join(self.out, 'gathered.hd5')
+        gather_hd5s(shards, output, mode='virtual')
+        self.check(output)
+        with h5py.File(output, 'r') as f:
+            self.assertTrue(f['variants/POS'].is_virtual)
+
+    def test_old_h5py(self):
+        # Without Virtual Datasets or direct chunk access everything is decoded and copied
+        shards = self.write_shards([3000, 4000, 3000])
+        output = os.path.join(self.out, 'gathered.hd5')
+        with mock.patch.object(hd5, 'has_virtual', return_value=False), \
+                mock.patch.object(hd5, 'has_direct_chunks', return_value=False):
+            with self.assertLogs('luigi-interface') as logs:
+                gather_hd5s(shards, output, mode='virtual')
+        self.assertIn('copied 0/20 chunks', logs.output[-1])
+        self.check(output)
+        with h5py.File(output, 'r') as f:
+            self.assertFalse(f['variants/POS'].is_virtual)
+
+    def test_mismatch(self):
+        shards = self.write_shards([5000, 5000])
+        with h5py.File(shards[1], 'a') as f:
+            del f['samples']
+            f.create_dataset('samples', data=SAMPLES[::-1])
+        with self.assertRaises(Exception):
+            gather_hd5s(shards, os.path.join(self.out, 'gathered.hd5'))
+
+    def tearDown(self):
+        shutil.rmtree(self.out)
+
+
+if __name__ == '__main__':
+    unittest.main()
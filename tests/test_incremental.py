@@ -0,0 +1,90 @@
+import unittest
+import gzip
+import os
+import shutil
+import tempfile
+
+from fieldpathogenomics.incremental import (vcf_samples, new_libraries, gvcf_variant_sites, affected_intervals,
+                                            write_affected, split_shard, stale_info, write_header)
+
+test_dir = os.path.split(__file__)[0]
+
+GVCF = (b'##fileformat=VCFv4.2\n'
+        b'#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tLIB3\n'
+        b'ctg0\t1\t.\tA\t<NON_REF>\t.\t.\tEND=99\tGT:DP:GQ:MIN_DP:PL\t0/0:5:15:5:0,15,150\n'
+        b'ctg0\t100\t.\tA\tG,<NON_REF>\t50\t.\t.\tGT:AD:DP:GQ:PL:SB\t0/1:2,3,0:5:40:40,0,60,50,70,99:1,1,2,1\n'
+        b'ctg0\t101\t.\tC\t<NON_REF>\t.\t.\tEND=1000\tGT:DP:GQ:MIN_DP:PL\t0/0:5:15:5:0,15,150\n'
+        b'ctg1\t500\t.\tACGT\tA,<NON_REF>\t50\t.\t.\tGT:AD:DP:GQ:PL:SB\t1/1:0,5,0:5:40:90,40,0,90,40,90:0,0,3,2\n')
+
+MASK = 'ctg0\t0\t50\nctg0\t90\t100\nctg0\t100\t200\nctg1\t400\t501\nctg1\t502\t600\nctg2\t0\t100\n'
+
+
+class TestIncremental(unittest.TestCase):
+
+    def setUp(self):
+        self.out = tempfile.mkdtemp()
+        self.gvcf = os.path.join(self.out, 'LIB3.g.vcf')
+        with open(self.gvcf, 'wb') as f:
+            f.write(GVCF)
+        self.mask = os.path.join(self.out, 'mask.bed')
+        with open(self.mask, 'w') as f:
+            f.write(MASK)
+
+    def test_samples(self):
+        previous = os.path.join(self.out, 'previous.vcf.gz')
+        with gzip.open(previous, 'wb') as f:
+            f.write(b'##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tLIB1\tLIB2\n')
+        self.assertEqual(vcf_samples(previous), ['LIB1', 'LIB2'])
+        self.assertEqual(new_libraries(previous, ['LIB4', 'LIB1', 'LIB3', 'LIB2']), ['LIB3', 'LIB4'])
+        with self.assertRaises(ValueError):
+            new_libraries(previous, ['LIB1', 'LIB3'])
+        with self.assertRaises(ValueError):
+            new_libraries(previous, ['LIB1', 'LIB2'])
+
+    def test_stale(self):
+        previous = os.path.join(self.out, 'previous.vcf.gz')
+        with gzip.open(previous, 'wb') as f:
+            f.write(b'##fileformat=VCFv4.2\n'
+                    b'##INFO=<ID=AC,Number=A,Type=Integer,Description="Allele count">\n'
+                    b'##INFO=<ID=QD,Number=1,Type=Float,Description="Variant Confidence/Quality by Depth">\n'
+                    b'##INFO=<ID=FS,Number=1,Type=Float,Description="Phred-scaled p-value using Fisher\'s exact test">\n'
+                    b'#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tLIB1\n')
+        self.assertEqual(stale_info(previous), ['FS', 'QD'])
+
+    def test_affected(self):
+        sites = list(gvcf_variant_sites(self.gvcf))
+        self.assertEqual(sites, [('ctg0', 99, 100), ('ctg1', 499, 503)])
+        intervals = [('ctg0', 0, 50), ('ctg0', 90, 100), ('ctg0', 100, 200), ('ctg1', 400, 501), ('ctg1', 502, 600),
+                     ('ctg2', 0, 100)]
+        self.assertEqual(affected_intervals(intervals, sites), [1, 3, 4])
+        # A long interval ahead of the one the site lands in
+        self.assertEqual(affected_intervals([('ctg0', 0, 1000), ('ctg0', 10, 20)], [('ctg0', 500, 501)]), [0])
+
+    def test_split(self):
+        affected = os.path.join(self.out, 'affected.bed')
+        write_affected(self.mask, [self.gvcf], affected)
+        with open(affected) as f:
+            self.assertEqual(f.read(), 'ctg0\t90\t100\nctg1\t400\t501\nctg1\t502\t600\n')
+
+        shard = os.path.join(self.out, 'shard.bed')
+        with open(shard, 'w') as f:
+            f.write('ctg0\t0\t50\nctg0\t90\t100\nctg2\t0\t100')
+        yes, no = os.path.join(self.out, 'yes.bed'), os.path.join(self.out, 'no.bed')
+        self.assertEqual(split_shard(shard, affected, yes, no), (1, 2))
+        with open(no) as f:
+            self.assertEqual(f.read(), 'ctg0\t0\t50\nctg2\t0\t100\n')
+
+    def test_header(self):
+        out = os.path.join(self.out, 'empty.vcf.gz')
+        write_header(self.gvcf, ['LIB1', 'LIB3'], out)
+        with gzip.open(out, 'rb') as f:
+            self.assertEqual(f.read(), b'##fileformat=VCFv4.2\n'
+                                       b'#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tLIB1\tLIB3\n')
+        self.assertFalse(os.path.exists(out + '.temp'))
+
+    def tearDown(self):
+        shutil.rmtree(self.out)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+import luigi
+import os
+import shutil
+import tempfile
+
+from fieldpathogenomics.luigi.local import LocalTask, runs_locally, predict_runtime
+import fieldpathogenomics.luigi.history as history
+from fieldpathogenomics.luigi.history import task_history
+
+test_dir = os.path.split(__file__)[0]
+
+
+class Small(LocalTask, luigi.Task):
+    expected_runtime = 10
+    run_locally = False
+    # Routing is decided once per instance
+    n = luigi.IntParameter(default=0)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mem = 100
+        self.n_cpu = 1
+
+
+class Big(Small):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mem = 32000
+
+
+class TestLocalTask(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        luigi.configuration.get_config().set('HistoryConfig', 'connection_string',
+                                             'sqlite:///' + os.path.join(self.tmp, 'task_history.db'))
+        luigi.configuration.get_config().set('LocalConfig', 'enabled', 'true')
+
+    def test_route(self):
+        self.assertTrue(runs_locally(Small()))
+        self.assertEqual(Small().resources, {'local': 1})
+        self.assertFalse(runs_locally(Big()))
+        self.assertEqual(Big().resources, {})
+
+    def test_history(self):
+        task = Small()
+        task.run()
+        self.assertTrue(task.run_locally)
+        self.assertLess(predict_runtime(task), 10)
+
+        # Once it's been seen to be slow it goes to SLURM
+        for i in range(3):
+            task_history().record(task, 'local', 3600)
+        self.assertEqual(predict_runtime(task), 3600)
+        self.assertFalse(runs_locally(Small(n=1)))
+
+    def test_disabled(self):
+        luigi.configuration.get_config().set('LocalConfig', 'enabled', 'false')
+        self.assertFalse(runs_locally(Small()))
+
+    def tearDown(self):
+        task_history().engine.dispose()
+        history._histories.clear()
+        luigi.configuration.get_config().remove_section('LocalConfig')
+        shutil.rmtree(self.tmp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+import luigi
+
+from fieldpathogenomics.luigi.passthrough import PassThroughTask
+
+
+class Job(luigi.Task):
+    '''Stands in for a SlurmExecutableTask'''
+
+    def run(self):
+        self.events.append('submitted')
+
+    def on_success(self):
+        self.events.append('slurm success')
+
+    def on_failure(self, e):
+        self.events.append('slurm failure')
+
+
+class Optional(PassThroughTask, Job):
+    skip = luigi.BoolParameter(default=False)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.events = []
+
+    def passes_through(self):
+        return self.skip
+
+    def pass_through(self):
+        self.events.append('passed')
+
+
+class TestPassThroughTask(unittest.TestCase):
+
+    def test_skipped(self):
+        task = Optional(skip=True)
+        task.run()
+        task.on_success()
+        task.on_failure(Exception())
+        self.assertEqual(task.events, ['passed'])
+
+    def test_run(self):
+        task = Optional(skip=False)
+        task.run()
+        task.on_success()
+        task.on_failure(Exception())
+        self.assertEqual(task.events, ['submitted', 'slurm success', 'slurm failure'])
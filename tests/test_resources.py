@@ -0,0 +1,101 @@
+import unittest
+import datetime
+import luigi
+import os
+import shutil
+import tempfile
+
+import fieldpathogenomics.luigi.history as history
+from fieldpathogenomics.luigi.history import TaskHistory, task_history
+from fieldpathogenomics.luigi.passthrough import PassThroughTask
+from bioluigi.slurm import SlurmTask
+from fieldpathogenomics.luigi.resources import (recommend, predict, parse_slurm_time, parse_size, _record,
+                                                register, _on_start)
+
+test_dir = os.path.split(__file__)[0]
+
+
+class Align(luigi.Task):
+    n = luigi.IntParameter(default=0)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mem = 16000
+        self.n_cpu = 4
+        self.partition = 'nbi-long'
+
+
+class Optional(PassThroughTask, Align):
+    skip = luigi.BoolParameter(default=False)
+
+    def passes_through(self):
+        return self.skip
+
+
+class TestResources(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = 'sqlite:///' + os.path.join(self.tmp, 'resource_history.db')
+        self.history = TaskHistory(self.db)
+
+    def add(self, task, size, **values):
+        row = dict(task_family=task.task_family, task_id=task.task_id, executor='slurm', input_bytes=size,
+                   mem=task.mem, n_cpu=task.n_cpu, datetime=datetime.datetime.now(), **values)
+        with self.history.engine.begin() as conn:
+            conn.execute(self.history.table.insert(), [row])
+
+    def test_predict(self):
+        # Memory is 1000MB + 1MB per 10^6 bytes of input
+        self.assertAlmostEqual(predict([10**9, 2 * 10**9], [2000, 3000], 3 * 10**9, 0), 4000)
+        self.assertAlmostEqual(predict([10**9, 10**9], [2000, 3000], 10**9, 0.5), 4500)
+
+    def test_recommend(self):
+        task = Align()
+        self.assertEqual(recommend(task, self.history, size=10**9), {})
+
+        for i in range(1, 4):
+            self.add(Align(n=i), i * 10**9, state='COMPLETED', max_rss=1000 + 1000 * i,
+                     elapsed=600 * i, cpu_time=1200 * i)
+        rec = recommend(task, self.history, size=4 * 10**9)
+        # 5000MB + 25% over the 3 CPUs needed, 2 CPU-seconds/second + 25%
+        self.assertEqual(rec, {'mem': 2084, 'n_cpu': 3, 'partition': 'nbi-short'})
+
+        # Failed attempts get more memory
+        self.add(task, 4 * 10**9, state='OUT_OF_MEMORY')
+        self.assertEqual(recommend(task, self.history, size=4 * 10**9), {'mem': 32000})
+
+    def test_sacct(self):
+        self.assertEqual(parse_slurm_time('1-02:03:04'), 93784)
+        self.assertEqual(parse_slurm_time('05:06.5'), 306.5)
+        self.assertEqual(parse_size('2048K'), 2)
+        self.assertIsNone(parse_size(''))
+
+    def test_record(self):
+        config = luigi.configuration.get_config()
+        config.set('HistoryConfig', 'connection_string', self.db)
+        config.set('ResourceConfig', 'enabled', 'true')
+        for task in [Optional(skip=True), Optional(skip=False)]:
+            task._input_bytes = 10**9
+            _record(task, 'COMPLETED')
+        # Skipped tasks never ran on SLURM
+        t = self.history.table
+        self.assertEqual([r.task_id for r in self.history.runs(t.c.executor == 'slurm')], [Optional(skip=False).task_id])
+
+        task_history().engine.dispose()
+        history._histories.clear()
+        config.remove_section('ResourceConfig')
+        config.remove_section('HistoryConfig')
+
+    def test_register(self):
+        register()
+        register()
+        self.assertIn(_on_start, SlurmTask._event_callbacks[SlurmTask][luigi.Event.START])
+
+    def tearDown(self):
+        self.history.engine.dispose()
+        shutil.rmtree(self.tmp)
+
+
+if __name__ == '__main__':
+    unittest.main()
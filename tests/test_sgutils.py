@@ -0,0 +1,235 @@
+import unittest
+from unittest import mock
+import gzip
+import io
+import os
+import shutil
+import tempfile
+
+from fieldpathogenomics.SGUtils import (split_vcf, split_contiguous, read_tabix_index, vcf_contig_lengths, vcf_shard,
+                                        SHARD_MAGIC, interval_weights, contiguous_partition, imbalance,
+                                        scatter_width, count_records, concat_files, reduction_tree, node_items,
+                                        node_name, is_leaf, _copy_range)
+from fieldpathogenomics.bgzf import BgzfWriter, read_blocks
+
+test_dir = os.path.split(__file__)[0]
+VCF = os.path.join(test_dir, 'data', 'test_regions.vcf.gz')
+
+
+class TestScatterVCF(unittest.TestCase):
+
+    def setUp(self):
+        self.out = tempfile.mkdtemp()
+        self.vcf = os.path.join(self.out, 'test_scatter.vcf.gz')
+        self.header = b'##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+        self.records = [b'ctg0\t' + str(i).encode() + b'\t.\tA\tG\t50\tPASS\tDP=' + str(i * 7919 % 997).encode() + b'\n'
+                        for i in range(1, 100000)]
+        with gzip.open(self.vcf, 'wb') as f:
+            f.write(self.header + b''.join(self.records))
+
+    def test_split(self):
+        outs = [io.BytesIO() for i in range(4)]
+        with open(self.vcf, 'rb') as raw:
+            split_vcf(gzip.GzipFile(fileobj=raw), raw, outs, block_size=2**14)
+
+        shards = [o.getvalue() for o in outs]
+        for s in shards:
+            self.assertTrue(s.startswith(self.header))
+        self.assertEqual(b''.join(s[len(self.header):] for s in shards), b''.join(self.records))
+        # Balanced to within a block or so
+        counts = [s.count(b'\n') - 2 for s in shards]
+        self.assertLess(max(counts) - min(counts), len(self.records) // 10)
+
+    def test_small(self):
+        # Much smaller than one block, read in a single go
+        records = self.records[:50]
+        with gzip.open(self.vcf, 'wb') as f:
+            f.write(self.header + b''.join(records))
+        outs = [io.BytesIO() for i in range(4)]
+        with open(self.vcf, 'rb') as raw:
+            split_vcf(gzip.GzipFile(fileobj=raw), raw, outs)
+
+        shards = [o.getvalue()[len(self.header):] for o in outs]
+        self.assertEqual(b''.join(shards), b''.join(records))
+        self.assertEqual([s.count(b'\n') for s in shards], [13, 13, 12, 12])
+
+    def tearDown(self):
+        shutil.rmtree(self.out)
+
+
+class TestScatterVCFRegions(unittest.TestCase):
+
+    def test_index(self):
+        weights = read_tabix_index(VCF + '.tbi')
+        # ctg3 has no records so isn't in the index
+        self.assertEqual(weights, [('ctg' + str(i), 20 * (i + 1)) for i in [0, 1, 2, 4, 5, 6, 7]])
+        self.assertEqual(vcf_contig_lengths(VCF)['ctg7'], 8000)
+
+    def test_split_contiguous(self):
+        weights = read_tabix_index(VCF + '.tbi')
+        runs = split_contiguous(weights, 3)
+        self.assertEqual(sum(runs, []), [c for c, w in weights])
+        self.assertEqual(runs, [['ctg0', 'ctg1', 'ctg2', 'ctg4'], ['ctg5', 'ctg6'], ['ctg7']])
+        self.assertEqual(split_contiguous([('a', 100), ('b', 1), ('c', 1)], 3), [['a'], ['b'], ['c']])
+
+    def test_shard(self):
+        self.assertEqual(vcf_shard(VCF), (VCF, None))
+
+        out = tempfile.mkdtemp()
+        shard = os.path.join(out, 'test_regions_0.vcf.gz')
+        with open(shard, 'w') as f:
+            f.write(SHARD_MAGIC + VCF + '\n')
+        self.assertEqual(vcf_shard(shard), (VCF, shard + '.bed'))
+        shutil.rmtree(out)
+
+
+class TestScatterBED(unittest.TestCase):
+
+    def test_partition(self):
+        weights = [7, 5, 4, 4, 3, 3, 2, 2]
+        shards, loads = contiguous_partition(weights, 3)
+        # Runs of consecutive intervals, in order
+        self.assertEqual(sum(shards, []), list(range(len(weights))))
+        self.assertEqual(shards, [[0, 1], [2, 3], [4, 5, 6, 7]])
+        self.assertEqual(loads, [12, 8, 10])
+        self.assertLess(imbalance(loads), 1.25)
+
+        shards, loads = contiguous_partition([1, 1], 3)
+        self.assertEqual(shards, [[0], [1], []])
+
+    def test_weights(self):
+        intervals = [('ctg0', 0, 1000), ('ctg0', 500, 1000), ('ctg7', 0, 4000), ('other', 0, 100)]
+        self.assertEqual(interval_weights(intervals), [1000, 500, 4000, 100])
+
+        # 20 variants on ctg0 (1000bp), 160 on ctg7 (8000bp), ctg3 is empty
+        weights = interval_weights(intervals, VCF)
+        self.assertEqual(weights[:3], [20, 10, 80])
+        # Contigs not in the index get the average, 640 variants over 32000bp
+        self.assertAlmostEqual(weights[3], 2.0)
+
+
+class TestScatterWidth(unittest.TestCase):
+
+    def test_width(self):
+        self.assertEqual(scatter_width(), 5)
+        self.assertEqual(scatter_width(10**6, 10), 1)
+        self.assertEqual(scatter_width(10**7, 100), 5)
+        self.assertEqual(scatter_width(10**9, 1000), 200)
+        self.assertEqual(scatter_width(10**9, 1000, max_shards=20), 20)
+
+    def test_vcf(self):
+        self.assertEqual(count_records(VCF), 640)
+        # The 640 records counted from the index override the estimate
+        self.assertEqual(scatter_width(10**9, 10**6, vcf=VCF), 4)
+
+
+class TestReductionTree(unittest.TestCase):
+
+    def nodes(self, top):
+        # Every node in the tree under the top nodes
+        out = []
+        for node in top:
+            out.append(node)
+            if not is_leaf(node):
+                out += self.nodes(node)
+        return out
+
+    def test_tree(self):
+        libs = ['LIB{0:05d}'.format(i) for i in range(500)]
+        top = reduction_tree(libs, 8)
+        self.assertLessEqual(len(top), 8)
+        self.assertEqual(sorted(x for node in top for x in node_items(node)), libs)
+        self.assertTrue(all(len(node) <= 8 for node in self.nodes(top)))
+
+    def test_fan_in(self):
+        # No node, including the list of top nodes, has more than fan_in children
+        for fan_in in [2, 3, 8]:
+            for n in [1, 2, 9, 64, 65, 300]:
+                libs = ['LIB{0:05d}'.format(i) for i in range(n)]
+                top = reduction_tree(libs, fan_in)
+                self.assertLessEqual(len(top), fan_in)
+                self.assertTrue(all(len(node) <= fan_in for node in self.nodes(top)))
+                self.assertEqual(sorted(x for node in top for x in node_items(node)), libs)
+
+    def test_stable(self):
+        libs = ['LIB{0:05d}'.format(i) for i in range(500)]
+        before = {node_name(n) for n in self.nodes(reduction_tree(libs, 8))}
+        # Spread through the existing libraries
+        added = ['LIB{0:05d}x'.format(i) for i in range(0, 500, 50)]
+        after = {node_name(n) for n in self.nodes(reduction_tree(libs + added, 8))}
+
+        # New nodes hold the new libraries, or are what's left of a leaf that one split
+        changed = [n for n in self.nodes(reduction_tree(libs + added, 8)) if node_name(n) not in before]
+        self.assertLessEqual(sum(1 for n in changed if not set(node_items(n)) & set(added)), len(added))
+        self.assertGreater(len(before & after), len(before) * 0.6)
+
+    def test_small(self):
+        self.assertEqual(reduction_tree(['LIB1'], 8), [('LIB1',)])
+        self.assertNotEqual(node_name(('LIB1',)), node_name(('LIB1',), salt='other inputs'))
+        with self.assertRaises(ValueError):
+            reduction_tree(['LIB1'], 1)
+
+
+class TestGatherCat(unittest.TestCase):
+
+    def setUp(self):
+        self.out = tempfile.mkdtemp()
+        self.header = b'sample\tvalue\n'
+        self.shards = [[str(i * 10000 + j).encode() + b'\t1\n' for j in range(10000)] for i in range(3)]
+        self.expected = self.header + b''.join(sum(self.shards, []))
+
+    def write(self, opener):
+        paths = []
+        for i, lines in enumerate(self.shards):
+            path = os.path.join(self.out, 'shard_{0}'.format(i))
+            f = opener(path)
+            f.write(self.header + b''.join(lines))
+            f.close()
+            paths.append(path)
+        return paths
+
+    def test_plain(self):
+        paths = self.write(lambda p: open(p, 'wb'))
+        output = os.path.join(self.out, 'gathered.tsv')
+        concat_files(paths, output, header_lines=1)
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), self.expected)
+        concat_files(paths, output)
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read().count(self.header), 3)
+
+    def test_gzip(self):
+        paths = self.write(lambda p: gzip.open(p, 'wb'))
+        output = os.path.join(self.out, 'gathered.tsv.gz')
+        concat_files(paths, output, header_lines=1)
+        with gzip.open(output, 'rb') as f:
+            self.assertEqual(f.read(), self.expected)
+
+    def test_bgzf(self):
+        paths = self.write(BgzfWriter)
+        output = os.path.join(self.out, 'gathered.tsv.gz')
+        concat_files(paths, output, header_lines=1)
+        # Still valid BGZF, with one EOF marker
+        with open(output, 'rb') as f:
+            data = [block for raw, block in read_blocks(f)]
+        self.assertEqual(b''.join(data), self.expected)
+        self.assertEqual(data.count(b''), 1)
+
+    def test_short(self):
+        path = self.write(lambda p: open(p, 'wb'))[0]
+        size = os.path.getsize(path)
+        output = os.path.join(self.out, 'short.tsv')
+        with open(path, 'rb') as fin, open(output, 'wb') as fout:
+            with self.assertRaises(IOError):
+                _copy_range(fin, fout, 0, size + 10)
+        # Same for the read/write fallback
+        with open(path, 'rb') as fin, open(output, 'wb') as fout:
+            with mock.patch('os.sendfile', side_effect=OSError), self.assertRaises(IOError):
+                _copy_range(fin, fout, 0, size + 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.out)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import luigi
+import time
+import os
+import subprocess
+
+import fieldpathogenomics.utils as utils
+
+
+class Step(luigi.Task):
+    '''Ladder DAG where every step depends on both steps below it, 2**n paths to the bottom'''
+    n = luigi.IntParameter()
+    side = luigi.IntParameter(default=0)
+
+    def requires(self):
+        if self.n == 0:
+            return []
+        return [Step(n=self.n - 1, side=0), Step(n=self.n - 1, side=1)]
+
+
+class Top(luigi.Task):
+    def requires(self):
+        return Step(n=40)
+
+
+class TestPipelineHash(unittest.TestCase):
+    def test_ancestor(self):
+        self.assertEqual(len(utils.ancestor(Top())), 1 + 40 * 2)
+
+    def test_hash(self):
+        start = time.time()
+        h = utils.hash_pipeline(Top())
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(h, utils.hash_pipeline(Top()))
+
+        # Same code upstream, same hash
+        self.assertEqual(utils.hash_pipeline(Step(n=10, side=0)), utils.hash_pipeline(Step(n=10, side=1)))
+        self.assertNotEqual(utils.hash_pipeline(Step(n=10)), utils.hash_pipeline(Step(n=9)))
+
+        utils._pipeline_hashes.clear()
+        self.assertEqual(h, utils.hash_pipeline(Top()))
+
+
+class TestGit(unittest.TestCase):
+    def git(self, cmd):
+        return subprocess.run(cmd, shell=True, check=True, stdout=subprocess.PIPE,
+                              universal_newlines=True, cwd=os.path.split(__file__)[0]).stdout.strip()
+
+    def test_file_hash(self):
+        self.assertEqual(utils.file_hash(__file__), self.git("git hash-object " + os.path.basename(__file__)))
+
+    def test_commit_hash(self):
+        self.assertEqual(utils.current_commit_hash(os.path.split(__file__)[0]), self.git("git rev-parse HEAD"))
+
+
+if __name__ == '__main__':
+    unittest.main()
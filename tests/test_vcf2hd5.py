@@ -0,0 +1,103 @@
+import unittest
+import gzip
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import h5py
+
+from fieldpathogenomics.vcf2hd5 import vcf_to_hd5
+from fieldpathogenomics.hd5 import gather_hd5s
+
+test_dir = os.path.split(__file__)[0]
+
+HEADER = (b'##fileformat=VCFv4.2\n'
+          b'##FILTER=<ID=LowQual,Description="Low quality">\n'
+          b'##INFO=<ID=DP,Number=1,Type=Integer,Description="Depth">\n'
+          b'##INFO=<ID=QD,Number=1,Type=Float,Description="Quality by depth">\n'
+          b'##INFO=<ID=DS,Number=0,Type=Flag,Description="Downsampled">\n'
+          b'##INFO=<ID=ANN,Number=.,Type=String,Description="Annotation">\n'
+          b'##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n'
+          b'##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths">\n'
+          b'##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Depth">\n'
+          b'##FORMAT=<ID=PL,Number=G,Type=Integer,Description="Likelihoods">\n'
+          b'#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tLIB001\tLIB002\n')
+RECORDS = [b'ctg0\t10\t.\tA\tG\t50.5\tPASS\tDP=12;QD=4.2;DS;ANN=x\tGT:AD:DP:PL\t0/1:3,4:7:90,0,60\t1|1:0,5:5:120,15,0\n',
+           b'ctg0\t20\t.\tAT\tA,ATT\t.\tLowQual\tDP=3\tGT:AD:DP\t./.:.:.\t0/2:1,0,2:3\n',
+           b'ctg1\t5\t.\tC\t.\t.\t.\t.\tGT:DP\t0/0:8\t0/0\n']
+
+
+class TestVCFtoHDF5(unittest.TestCase):
+
+    def setUp(self):
+        self.out = tempfile.mkdtemp()
+
+    def write_vcf(self, records, name='test.vcf.gz'):
+        path = os.path.join(self.out, name)
+        with gzip.open(path, 'wb') as f:
+            f.write(HEADER + b''.join(records))
+        return path
+
+    def test_fields(self):
+        output = os.path.join(self.out, 'test.hd5')
+        vcf_to_hd5(self.write_vcf(RECORDS), output, block_size=2)
+        with h5py.File(output, 'r') as f:
+            np.testing.assert_array_equal(f['samples'][:], [b'LIB001', b'LIB002'])
+            v, c = f['variants'], f['calldata']
+            self.assertNotIn('ANN', v)
+            np.testing.assert_array_equal(v['CHROM'][:], [b'ctg0', b'ctg0', b'ctg1'])
+            np.testing.assert_array_equal(v['POS'][:], [10, 20, 5])
+            np.testing.assert_array_equal(v['ALT'][:], [b'G', b'A', b''])
+            np.testing.assert_array_equal(v['num_alleles'][:], [2, 3, 1])
+            np.testing.assert_array_equal(v['is_snp'][:], [True, False, False])
+            np.testing.assert_array_equal(v['svlen'][:], [0, -1, 0])
+            np.testing.assert_array_equal(v['FILTER_PASS'][:], [True, False, False])
+            np.testing.assert_array_equal(v['FILTER_LowQual'][:], [False, True, False])
+            np.testing.assert_array_equal(v['DP'][:], [12, 3, -1])
+            np.testing.assert_array_equal(v['DS'][:], [True, False, False])
+            np.testing.assert_allclose(v['QD'][:], [4.2, np.nan, np.nan], rtol=1e-6)
+            np.testing.assert_allclose(v['QUAL'][:], [50.5, np.nan, np.nan])
+
+            np.testing.assert_array_equal(c['genotype'][:], [[[0, 1], [1, 1]], [[-1, -1], [0, 2]], [[0, 0], [0, 0]]])
+            np.testing.assert_array_equal(c['is_called'][:], [[True, True], [False, True], [True, True]])
+            np.testing.assert_array_equal(c['is_phased'][:], [[False, True], [False, False], [False, False]])
+            self.assertEqual(c['AD'].shape, (3, 2, 6))
+            np.testing.assert_array_equal(c['AD'][:, 1, :3], [[0, 5, -1], [1, 0, 2], [-1, -1, -1]])
+            np.testing.assert_array_equal(c['DP'][:], [[7, 5], [-1, 3], [8, -1]])
+            np.testing.assert_array_equal(c['PL'][0], [[90, 0, 60], [120, 15, 0]])
+
+    def test_processes(self):
+        records = [b'ctg0\t' + str(p).encode() + b'\t.\tA\tG\t50\tPASS\tDP=' + str(p % 50).encode() +
+                   b'\tGT:AD:DP\t0/1:1,2:3\t0/0:' + str(p % 7).encode() + b',0:' + str(p % 7).encode() + b'\n'
+                   for p in range(1, 5000)]
+        vcf = self.write_vcf(records)
+        one, four = os.path.join(self.out, 'one.hd5'), os.path.join(self.out, 'four.hd5')
+        vcf_to_hd5(vcf, one, block_size=300)
+        vcf_to_hd5(vcf, four, block_size=300, processes=4)
+        with h5py.File(one, 'r') as f1, h5py.File(four, 'r') as f4:
+            for path in ('variants/POS', 'variants/DP', 'calldata/AD', 'calldata/genotype'):
+                np.testing.assert_array_equal(f1[path][:], f4[path][:])
+            self.assertEqual(f1['variants/POS'].shape, (4999,))
+
+    def test_gather(self):
+        # Shards converted separately gather into the same as converting the whole
+        shards = []
+        for i, records in enumerate([RECORDS[:1], RECORDS[1:]]):
+            shards.append(os.path.join(self.out, 'shard_{0}.hd5'.format(i)))
+            vcf_to_hd5(self.write_vcf(records, 'shard_{0}.vcf.gz'.format(i)), shards[-1])
+        whole = os.path.join(self.out, 'whole.hd5')
+        vcf_to_hd5(self.write_vcf(RECORDS), whole)
+        for mode in ('virtual', 'chunks'):
+            gathered = os.path.join(self.out, mode + '.hd5')
+            gather_hd5s(shards, gathered, mode=mode)
+            with h5py.File(whole, 'r') as f1, h5py.File(gathered, 'r') as f2:
+                for path in ('variants/POS', 'variants/QD', 'calldata/AD', 'calldata/genotype'):
+                    np.testing.assert_array_equal(f1[path][:], f2[path][:])
+
+    def tearDown(self):
+        shutil.rmtree(self.out)
+
+
+if __name__ == '__main__':
+    unittest.main()